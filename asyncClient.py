@@ -0,0 +1,347 @@
+from const import *
+from asyncProtocol import AsyncMessageProtocol
+from protocol import ConnectionBroken, StreamChunk, Control, SUPPORTED_CAPABILITIES
+
+from time import monotonic
+import asyncio
+import os
+import random
+import tempfile
+
+class IncomingStream():
+    """
+    A streamed message being received. Its data is written to a temporary
+    file so memory use doesn't grow with the message, only the first
+    STREAM_PREVIEW_BYTES bytes are kept to be shown.
+    """
+    __slots__ = ("file", "size", "preview")
+
+    def __init__(self, directory=None):
+        """
+        Parameters:
+        directory (str): Directory of the file, None for the temporary directory
+        """
+        self.file = tempfile.NamedTemporaryFile(prefix="chat-stream-", suffix=".txt",
+                                                dir=directory, delete=False)
+        self.size = 0
+        self.preview = bytearray()
+
+    def write(self, data):
+        """
+        Appends received data.
+
+        Parameters:
+        data (bytes): The data
+        """
+        self.file.write(data)
+        self.size += len(data)
+        if len(self.preview) < STREAM_PREVIEW_BYTES:
+            self.preview += data[:STREAM_PREVIEW_BYTES - len(self.preview)]
+
+    def finish(self):
+        """
+        Closes the file and returns the text to show: the whole message if it
+        fits into the preview, which removes the file, otherwise its beginning
+        and the path of the file.
+        """
+        self.file.close()
+        if self.size <= STREAM_PREVIEW_BYTES:
+            os.remove(self.file.name)
+            return str(self.preview, encoding="UTF-8", errors="replace")
+        # The cut may split a character
+        return "{}\n[{} bytes in total, saved to {}]".format(
+            str(self.preview, encoding="UTF-8", errors="ignore"), self.size, self.file.name)
+
+    def discard(self):
+        """Removes the file of a stream that won't be completed"""
+        self.file.close()
+        os.remove(self.file.name)
+
+class AsyncClient():
+    """
+    asyncio client of the chat server. Messages passed to send are written
+    without waiting for anything from the server: sends made in the same event
+    loop iteration go out together, and send only waits while the socket
+    buffer is full. Received messages are read with the async iterator
+    returned by messages.
+
+    A lost connection is reestablished after a random delay growing with every
+    failed attempt. Servers supporting sessions then only send the messages
+    following the last acknowledged sequence numbers. Messages that were
+    queued but not yet written to the lost connection are sent again on the
+    new one. Messages already written can still be lost with the connection,
+    the server doesn't acknowledge what it receives.
+
+    Has to be used from a single event loop, e.g.:
+        client = AsyncClient("bot", "localhost")
+        async for message in client.messages():
+            await client.send("Got " + message)
+    """
+    def __init__(self, username, host=CLIENT_CONNECTION_POINT, port=SERVER_PORT,
+                 capabilities=SUPPORTED_CAPABILITIES, reconnect=True, status=None,
+                 stream_directory=None):
+        """
+        Parameters:
+        username (str): Name of the user
+        host (str): Address of the server
+        port (int): Port of the server
+        capabilities (dict): Capabilities offered in the handshake
+        reconnect (bool): Reconnect after losing the connection
+        status (callable): Called with a text describing connection problems
+        stream_directory (str): Directory streamed messages are saved to, None
+                                for the temporary directory
+        """
+        self.username = username
+        self.host = host
+        self.port = port
+        self.capabilities = capabilities
+        self.reconnect = reconnect
+        self.status = status
+        self.connection = None
+        self.closed = False
+        # Set while connected and once the client is closed
+        self.connected = asyncio.Event()
+        self.closing = asyncio.Event()
+        self.keepalive_task = None
+        self.flush_scheduled = False
+        self.last_sent = monotonic()
+        # Session token given by the server and the channels mapped to the
+        # sequence number of the next message to receive
+        self.token = None
+        self.cursors = {}
+        self.stream_directory = stream_directory
+        # Streamed messages being received, their ids mapped to IncomingStream
+        self.streams = {}
+        # Messages queued on the connection since its flush count was
+        # unsent_flushes, i.e. not written to it yet
+        self.unsent = []
+        self.unsent_flushes = 0
+
+    async def connect(self):
+        """Opens a connection and joins the chat, resuming the session if there is one"""
+        loop = asyncio.get_running_loop()
+        _, connection = await loop.create_connection(AsyncMessageProtocol, self.host, self.port)
+        try:
+            await connection.negotiate(self.capabilities)
+            connection.queue_message(self.username)
+            if connection.capabilities.get("resume"):
+                cursors = ["{}:{}".format(name, seq) for name, seq in self.cursors.items()]
+                connection.queue_control(Control("resume", [self.token or "-"] + cursors))
+            # Sent again after the join, so they are posted with the resumed channel
+            for message in self.unsent:
+                connection.queue_message(message)
+            await connection.flush()
+        except ConnectionBroken:
+            if not connection.pending_frames:
+                # Written before the connection broke
+                self.unsent = []
+            connection.terminate()
+            raise
+        self.unsent = []
+        self.unsent_flushes = connection.write_stats.flushes
+        if self.closed:
+            # Closed while connecting
+            connection.terminate()
+            raise ConnectionBroken("Client closed")
+        self.connection = connection
+        # Streams cut off by a lost connection are never completed
+        self._discard_streams()
+        self.last_sent = monotonic()
+        self.keepalive_task = loop.create_task(self.keepalive(connection))
+        self.connected.set()
+
+    async def send(self, message):
+        """
+        Sends a message. Waits only while the socket buffer is full or the
+        client is reconnecting. Messages longer than STREAM_THRESHOLD are
+        streamed if the server supports it. Raises ConnectionBroken if the
+        client is closed or a stream is cut off. A message that wasn't written
+        before the connection was lost is sent after reconnecting.
+
+        Parameters:
+        message (str): The message to send
+        """
+        while not self.connected.is_set():
+            await self.connected.wait()
+        if self.closed:
+            raise ConnectionBroken("Client closed")
+        connection = self.connection
+        self.last_sent = monotonic()
+        if len(message) > STREAM_THRESHOLD and connection.capabilities.get("streaming"):
+            # Sent in chunks so the server doesn't hold the whole message
+            connection.write_pending()
+            await connection.send_stream([message])
+            return
+        if connection.write_stats.flushes != self.unsent_flushes:
+            # The messages queued before were written since
+            self.unsent = []
+            self.unsent_flushes = connection.write_stats.flushes
+        connection.queue_message(message)
+        self.unsent.append(message)
+        if connection.pending_bytes >= FLUSH_BYTES:
+            self._write(connection)
+        elif not self.flush_scheduled:
+            # Messages sent until the loop gets back to the callbacks go out together
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush, connection)
+        try:
+            await connection.drain()
+        except ConnectionBroken:
+            # The message is either written or sent again after reconnecting
+            pass
+
+    def _flush(self, connection):
+        self.flush_scheduled = False
+        self._write(connection)
+
+    def _write(self, connection):
+        try:
+            connection.write_pending()
+        except ConnectionBroken:
+            # The reading side notices it too, the queued messages stay unsent
+            pass
+
+    async def keepalive(self, connection):
+        """
+        Pings the server when nothing was sent for PING_DELAY seconds.
+
+        Parameters:
+        connection (AsyncMessageProtocol): Connection with the server
+        """
+        try:
+            while True:
+                delay = self.last_sent + PING_DELAY - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                self.last_sent = monotonic()
+                await connection.ping()
+        except ConnectionBroken:
+            connection.terminate()
+
+    async def messages(self):
+        """
+        Async iterator of the received messages, connects first. Ends once the
+        client is closed, raises ConnectionBroken when the connection is lost
+        and reconnecting is off or RECONNECT_ATTEMPTS attempts in a row failed.
+        """
+        failures = 0
+        while not self.closed:
+            try:
+                await self.connect()
+            except (OSError, ConnectionBroken) as e:
+                if self.closed:
+                    return
+                failures += 1
+                self._status("Unable to connect to {}:{}. {}".format(self.host, self.port, str(e)))
+                if not self.reconnect or failures >= RECONNECT_ATTEMPTS:
+                    raise ConnectionBroken(e)
+                await self._backoff(failures)
+                continue
+
+            failures = 0
+            try:
+                while True:
+                    message = await self.receive()
+                    if message:
+                        yield message
+            except ConnectionBroken as e:
+                self._disconnected()
+                if self.closed:
+                    return
+                self._status("Client disonnected with error {}".format(str(e)))
+                if not self.reconnect:
+                    raise
+            await self._backoff(failures)
+
+    async def receive(self):
+        """
+        Waits for the next message from the server. Returns None for pings,
+        session bookkeeping and unfinished streams. Errors are returned as
+        "Server error: code detail".
+        """
+        message = await self.connection.get_message()
+        if isinstance(message, Control):
+            return self._control(message)
+        if isinstance(message, StreamChunk):
+            return self._receive_chunk(message)
+        return message
+
+    def _control(self, control):
+        """
+        Keeps track of the session token and the acknowledged sequence numbers.
+        Returns errors reported by the server as text, otherwise None.
+
+        Parameters:
+        control (Control): Control message from the server
+        """
+        if control.command == "session" and control.arguments:
+            # The server only uses the cursors of channels the session subscribed to
+            self.token = control.arguments[0]
+        elif control.command == "cursor" and len(control.arguments) == 2:
+            self.cursors[control.arguments[0]] = int(control.arguments[1])
+        elif control.command == "error":
+            return "Server error: {}".format(" ".join(control.arguments))
+        return None
+
+    def _receive_chunk(self, chunk):
+        """
+        Saves a part of a streamed message, see IncomingStream. Returns the
+        text to show once the last part arrived, otherwise None.
+
+        Parameters:
+        chunk (StreamChunk): The received part
+        """
+        stream = self.streams.get(chunk.stream_id)
+        if stream is None:
+            stream = self.streams[chunk.stream_id] = IncomingStream(self.stream_directory)
+        stream.write(chunk.data)
+        if not chunk.last:
+            return None
+        del self.streams[chunk.stream_id]
+        return stream.finish()
+
+    def _discard_streams(self):
+        for stream in self.streams.values():
+            stream.discard()
+        self.streams = {}
+
+    async def _backoff(self, failures):
+        """
+        Waits before reconnecting, a random time up to a limit doubling with
+        every failure so that clients of a restarted server don't reconnect
+        all at once. Returns early when the client is closed.
+
+        Parameters:
+        failures (int): Failed attempts in a row
+        """
+        limit = min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2**failures)
+        try:
+            await asyncio.wait_for(self.closing.wait(), random.uniform(0, limit))
+        except asyncio.TimeoutError:
+            pass
+
+    def _status(self, text):
+        if self.status:
+            self.status(text)
+
+    def _disconnected(self):
+        """Forgets the broken connection, senders wait for the next one"""
+        if self.connection:
+            if self.connection.write_stats.flushes != self.unsent_flushes:
+                self.unsent = []
+            self.connection.terminate()
+        if self.keepalive_task:
+            self.keepalive_task.cancel()
+            self.keepalive_task = None
+        if not self.closed:
+            self.connected.clear()
+
+    def close(self):
+        """Closes the connection and stops reconnecting, pending sends fail"""
+        self.closed = True
+        self.closing.set()
+        self._disconnected()
+        self._discard_streams()
+        # Wakes up the senders waiting for a connection
+        self.connected.set()
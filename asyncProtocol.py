@@ -0,0 +1,221 @@
+from protocol import (BaseMessageProtocol, ConnectionBroken, format_hello, parse_hello,
+                      FRAME_PING, FRAMING_DELIMITED, MAX_RECEIVED_FRAMES, STREAM_CHUNK_SIZE,
+                      SUPPORTED_CAPABILITIES)
+
+import asyncio
+import collections
+import time
+
+class AsyncMessageProtocol(BaseMessageProtocol, asyncio.BufferedProtocol):
+    """
+    asyncio counterpart of MessageProtocol. The event loop receives straight into
+    the frame buffer, complete frames are queued until a coroutine awaits them.
+    """
+    def __init__(self, on_connected=None, buffer_size=2**11,
+                 delimiter="<<END>>", ping_tag="<<PING>>", encoding="UTF-8",
+                 framing=FRAMING_DELIMITED):
+        """
+        Parameters:
+        on_connected (callable): Called with the protocol once the connection is made.
+        buffer_size (int): Should be a power of 2. Socket buffer size.
+        delimiter (str): A tag placed at the end of messages when sending.
+        ping_tag (str): A tag signifying that this side of the connection is still respoding.
+        encoding (str): Message encoding.
+        framing (str): FRAMING_DELIMITED or FRAMING_LENGTH. Can be changed by negotiation.
+        """
+        super().__init__(buffer_size, delimiter, ping_tag, encoding, framing)
+        self.on_connected = on_connected
+        self.transport = None
+        self.peername = None
+        self.received = collections.deque()
+        self.error = None
+        self._frame_waiter = None
+        self._drain_waiter = None
+        self._writing_paused = False
+        # Reasons reading from the socket is paused for, see pause_reading
+        self._reading_paused = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peername = transport.get_extra_info("peername")
+        if self.on_connected:
+            self.on_connected(self)
+
+    def connection_lost(self, exc):
+        self.error = ConnectionBroken(exc or "Connection Stopped")
+        self._wake(self._frame_waiter)
+        self._wake(self._drain_waiter)
+
+    def get_buffer(self, sizehint):
+        return self.frames.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.read_stats.reads += 1
+        self.read_stats.bytes += nbytes
+        self.last_read = time.monotonic()
+        self.frames.buffer_updated(nbytes)
+        try:
+            frame = self.frames.next_frame()
+            while frame is not None:
+                for expanded in self.expand_frame(frame):
+                    self.read_stats.add_frame(expanded)
+                    self.received.append(expanded)
+                frame = self.frames.next_frame()
+        except ConnectionBroken as e:
+            self.error = e
+            self.transport.abort()
+        if len(self.received) >= MAX_RECEIVED_FRAMES:
+            # Lets TCP slow the sender down instead of buffering its frames
+            self.pause_reading("full")
+        self._wake(self._frame_waiter)
+
+    def eof_received(self):
+        # Close the transport, connection_lost wakes up the waiting coroutines
+        return False
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._wake(self._drain_waiter)
+
+    def _wake(self, waiter):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def get_frame(self):
+        """Waits for a frame, returns a (frame type, payload bytes) tuple"""
+        while not self.received:
+            if self.error is not None:
+                raise self.error
+            self._frame_waiter = asyncio.get_running_loop().create_future()
+            await self._frame_waiter
+        if len(self.received) <= MAX_RECEIVED_FRAMES // 2:
+            self.resume_reading("full")
+        return self.received.popleft()
+
+    def pause_reading(self, reason):
+        """
+        Stops reading from the socket until resume_reading is called with the
+        same reason, the kernel buffers fill up and TCP slows the sender down.
+
+        Parameters:
+        reason (str): Why reading is paused, e.g. "throttle"
+        """
+        if not self._reading_paused and self.transport and not self.transport.is_closing():
+            self.transport.pause_reading()
+        self._reading_paused.add(reason)
+
+    def resume_reading(self, reason):
+        """
+        Resumes reading paused for a reason once no other reason remains.
+
+        Parameters:
+        reason (str): The reason given to pause_reading
+        """
+        if reason not in self._reading_paused:
+            return
+        self._reading_paused.discard(reason)
+        if not self._reading_paused and self.transport and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    async def get_message(self):
+        """Waits for a message, see MessageProtocol.get_message"""
+        return self.decode_frame(await self.get_frame())
+
+    async def send_stream(self, parts):
+        """
+        Sends a message as a stream of chunks, waits while the transport buffer
+        is full. Requires the streaming capability.
+
+        Parameters:
+        parts (iterable): str or bytes-like parts of the message
+        """
+        for chunk in self.stream_chunks(parts):
+            self.queue_chunk(chunk)
+            if self.pending_bytes >= STREAM_CHUNK_SIZE or chunk.last:
+                await self.flush()
+
+    async def send_message(self, message):
+        """
+        Sends a message, waits while the transport buffer is full
+
+        Parameters:
+        message (str): The message to send
+        """
+        self.queue_message(message)
+        await self.flush()
+
+    async def send_encoded(self, payloads):
+        """
+        Sends messages already encoded with encode_message, see queue_encoded.
+
+        Parameters:
+        payloads (list): Encoded messages, one frame each
+        """
+        self.queue_encoded(payloads)
+        await self.flush()
+
+    async def ping(self):
+        """
+        Sends a ping message to inform the other side that the connection is alive.
+        """
+        self.queue_frame(FRAME_PING, b"")
+        self.write_stats.pings += 1
+        await self.flush()
+
+    async def flush(self):
+        """Writes all queued frames to the transport at once, waits while its buffer is full"""
+        self.write_pending()
+        await self.drain()
+
+    def write_pending(self):
+        """Writes all queued frames to the transport at once without waiting"""
+        if self.error is not None:
+            raise self.error
+        buffers = self.take_pending()
+        if buffers:
+            self.transport.writelines(buffers)
+
+    async def drain(self):
+        """Waits until the transport accepts more data, several coroutines can wait at once"""
+        while self._writing_paused:
+            if self.error is not None:
+                raise self.error
+            if self._drain_waiter is None or self._drain_waiter.done():
+                self._drain_waiter = asyncio.get_running_loop().create_future()
+            # A cancelled waiter mustn't cancel the others
+            await asyncio.shield(self._drain_waiter)
+
+    async def negotiate(self, capabilities=SUPPORTED_CAPABILITIES):
+        """
+        Client side of the handshake, see MessageProtocol.negotiate.
+
+        Parameters:
+        capabilities (dict): Capability names mapped to values in order of preference
+        """
+        await self.send_message(format_hello(capabilities))
+        answer = parse_hello(await self.get_message()) or {}
+        self.apply_capabilities({name: values[0] for name, values in answer.items() if values})
+        return self.capabilities
+
+    async def accept_negotiation(self, supported=SUPPORTED_CAPABILITIES):
+        """
+        Server side of the handshake, see MessageProtocol.accept_negotiation.
+
+        Parameters:
+        supported (dict): Capabilities understood by the server
+        """
+        message = await self.get_message()
+        answer, chosen = self.answer_hello(message, supported)
+        if answer is None:
+            return message
+        await self.send_message(answer)
+        self.apply_capabilities(chosen)
+        return await self.get_message()
+
+    def terminate(self):
+        """ Terminates the connection. """
+        if self.transport is not None:
+            self.transport.close()
@@ -0,0 +1,280 @@
+from const import *
+from asyncProtocol import AsyncMessageProtocol
+from protocol import ConnectionBroken, StreamChunk
+from serverThread import ServerThread, Message
+
+from datetime import datetime
+from time import monotonic
+import asyncio
+import collections
+
+class AsyncOutbox():
+    """
+    Wakes up the writer task of one client when new messages are published and
+    holds messages meant only for that client. Has to be used from the event
+    loop thread.
+    """
+    def __init__(self):
+        self.items = collections.deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        # Time of the first wake up that wasn't flushed yet, for the fan-out latency
+        self.woken_at = None
+        # Bytes of streamed messages queued and not yet taken by the writer
+        self.stream_bytes = 0
+
+    def put(self, item):
+        """
+        Queues an item that isn't part of the history and wakes up the writer.
+
+        Parameters:
+        item: Message, HistoryRange or StreamChunk to send
+        """
+        self.items.append(item)
+        if isinstance(item, StreamChunk):
+            self.stream_bytes += len(item.data)
+        self.wake()
+
+    def wake(self):
+        """Tells the writer that there are new messages in the history"""
+        if self.woken_at is None:
+            self.woken_at = monotonic()
+        self.ready.set()
+
+    async def get(self, timeout=None):
+        """
+        Waits until the outbox is woken up or the timeout passes. Returns a list
+        of the queued items (possibly empty) or None once the outbox is closed.
+
+        Parameters:
+        timeout (float): Maximal time to wait in seconds, None waits indefinitely
+        """
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        if self.closed:
+            return None
+        self.ready.clear()
+        self.stream_bytes = 0
+        items = list(self.items)
+        self.items.clear()
+        return items
+
+    def close(self):
+        """Stops the writer waiting on the outbox"""
+        self.closed = True
+        self.ready.set()
+
+class AsyncServerThread(ServerThread):
+    """
+    Runs the server on a single asyncio event loop inside a thread. Every client
+    connection is handled by a coroutine instead of a separate thread.
+    """
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, log_directory=LOG_DIRECTORY):
+        super().__init__(host, port, log_directory)
+        self.loop = asyncio.new_event_loop()
+        self.stopped = asyncio.Event()
+        self.connections = set()
+        self.tasks = set()
+
+    def deliver(self, message):
+        """
+        Adds a message to the chat history. Messages coming from the message bus
+        are handed over to the event loop thread which owns the outboxes.
+
+        Parameters:
+        message (Message): The new message
+        """
+        if self.bus:
+            self.loop.call_soon_threadsafe(super().deliver, message)
+        else:
+            super().deliver(message)
+
+    def make_outbox(self):
+        """Creates the outbox for a new client"""
+        return AsyncOutbox()
+
+    async def writer_task(self, connection, client):
+        """
+        Sends messages to the client as soon as they are published, coalescing
+        bursts like ServerThread.writer_thread.
+
+        Parameters:
+        connection (AsyncMessageProtocol): Connection with the client
+        client (Client): The client receiving the messages
+        """
+        try:
+            items = await client.outbox.get()
+            while items is not None:
+                for payloads in self.pending_batches(connection, client, items):
+                    connection.queue_encoded(payloads)
+                    if connection.pending_bytes >= FLUSH_BYTES:
+                        with self.profiler.span("protocol.flush"):
+                            await connection.flush()
+                timeout = self.flush_timeout(connection, client)
+                if timeout == 0:
+                    with self.profiler.span("protocol.flush"):
+                        await connection.flush()
+                    client.flush_deadline = timeout = None
+                if timeout is None:
+                    self.record_fanout(client)
+                items = await client.outbox.get(timeout)
+        except ConnectionBroken:
+            connection.terminate()
+
+    async def client_task(self, connection):
+        """
+        Communicates with one client. Messages from the client are read here
+        while a separate writer task sends out the new messages.
+
+        Parameters:
+        connection (AsyncMessageProtocol): Connection with the client
+        """
+        ip = connection.peername[0] if connection.peername else ""
+        client = None
+        writer = None
+        self.watch(connection)
+        try:
+            username = await connection.accept_negotiation()
+            usertag = "{}@{}".format(username, ip)
+            resume = None
+            if connection.capabilities.get("resume"):
+                resume = await connection.get_message()
+            client = self.register(usertag, connection, resume)
+            writer = self.loop.create_task(self.writer_task(connection, client))
+
+            handled = 0
+            while True:
+                # Pings only keep the connection alive
+                received_data = await connection.get_message()
+                if received_data is None:
+                    continue
+                wait = self.admit(client)
+                if wait:
+                    # Lets TCP slow the client down instead of buffering its messages
+                    connection.pause_reading("throttle")
+                    while wait:
+                        await asyncio.sleep(wait)
+                        wait = self.admit(client)
+                    connection.resume_reading("throttle")
+                handled += 1
+                if handled % INBOUND_BATCH == 0:
+                    # get_message doesn't yield while frames are buffered,
+                    # the other connections get their turn
+                    await asyncio.sleep(0)
+                with self.profiler.span("inbound.handle"):
+                    if isinstance(received_data, StreamChunk):
+                        self.handle_chunk(client, received_data)
+                    elif received_data:
+                        self.handle_message(client, received_data)
+        except ConnectionBroken as e:
+            print("Client disonnected with error {}".format(str(e)))
+        finally:
+            # Runs for unexpected errors too, see ServerThread.client_thread
+            self.unwatch(connection)
+            if client:
+                self.unregister(client)
+            connection.terminate()
+            if writer:
+                await writer
+
+    def runtime_stats(self):
+        """Returns the number of tasks serving the clients"""
+        stats = super().runtime_stats()
+        stats["tasks"] = len(self.tasks)
+        return stats
+
+    def reap(self):
+        """
+        Closes the idle connections, runs on the event loop once per tick of
+        the timer wheel instead of in a separate thread.
+        """
+        for connection in self.expire_idle():
+            print("Closing connection idle for {} seconds".format(self.idle_timeout))
+            connection.terminate()
+        if not self.stopped.is_set():
+            self.loop.call_later(max(0, self.timers.next_tick() - monotonic()), self.reap)
+
+    def _connection_made(self, connection):
+        self.connections.add(connection)
+        task = self.loop.create_task(self.client_task(connection))
+        self.tasks.add(task)
+        task.add_done_callback(lambda _: (self.tasks.discard(task),
+                                          self.connections.discard(connection)))
+
+    async def serve(self):
+        """Accepts connections until the server is stopped"""
+        server = await self.loop.create_server(
+            lambda: AsyncMessageProtocol(self._connection_made), sock=self.socket)
+        self.reap()
+        await self.stopped.wait()
+
+        # Clean up code
+        server.close()
+        if self.drain_timeout:
+            await self.drain(self.drain_timeout)
+        for connection in list(self.connections):
+            connection.terminate()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        await server.wait_closed()
+        self.presence.flush()
+        self.profiler.capture("spans")
+        if self.reporter:
+            self.reporter.stop()
+        if self.log:
+            self.log.close()
+
+    def run(self):
+        """
+        Overwrites threading.Thread.run, runs the event loop handling all the
+        client connections.
+        """
+        self.running = True
+        if not self.bind():
+            return
+        self.socket.setblocking(False)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    def call_soon(self, callback, *args):
+        """
+        Calls a callback from another thread on the event loop, which owns the outboxes.
+
+        Parameters:
+        callback (callable): The callback
+        args: Arguments of the callback
+        """
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The loop was closed, the clients are gone
+            pass
+
+    async def drain(self, timeout):
+        """
+        Coroutine version of ServerThread.drain.
+
+        Parameters:
+        timeout (float): Longest wait in seconds
+        """
+        self.deliver(Message("Server", datetime.now(), "Server is shutting down."))
+        deadline = monotonic() + timeout
+        while not self.drained() and monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def stop(self, drain_timeout=0):
+        """
+        Stops the server.
+
+        Parameters:
+        drain_timeout (float): Seconds the clients get to receive the messages
+                               queued for them before being disconnected
+        """
+        self.drain_timeout = drain_timeout
+        self.running = False
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
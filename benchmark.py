@@ -0,0 +1,448 @@
+from const import *
+from asyncProtocol import AsyncMessageProtocol
+from protocol import ConnectionBroken, Control, SUPPORTED_CAPABILITIES
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import sys
+import time
+
+# Text posted by the simulated clients: "bench <sender> <monotonic time> <padding>".
+# The send time travels with the message, so every recipient can measure the
+# delivery latency without a shared clock other than time.monotonic.
+BENCH_TAG = "bench "
+
+def raise_file_limit():
+    """Allows the process to open as many sockets as the hard limit permits"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def percentiles(samples, points=(50, 99, 99.9)):
+    """
+    Returns a dict mapping "p50", "p99", ... to the nearest-rank percentiles of
+    the samples, plus their count, minimum, maximum and mean.
+
+    Parameters:
+    samples (list): Measured values
+    points (tuple): Percentiles to report
+    """
+    result = {"count": len(samples)}
+    if not samples:
+        return result
+    ordered = sorted(samples)
+    for point in points:
+        rank = max(0, min(len(ordered) - 1, int(round(point / 100 * len(ordered))) - 1))
+        result["p" + "{:g}".format(point).replace(".", "")] = ordered[rank]
+    result["min"] = ordered[0]
+    result["max"] = ordered[-1]
+    result["mean"] = sum(ordered) / len(ordered)
+    return result
+
+def process_usage(pid):
+    """
+    Returns {"cpu_seconds", "rss_bytes", "peak_rss_bytes"} of a process and its
+    child processes (e.g. server workers) read from /proc, or None where /proc
+    isn't available.
+
+    Parameters:
+    pid (int): The process
+    """
+    if not os.path.isdir("/proc/{}".format(pid)):
+        return None
+    pids = [pid] + [child for child, parent in _parent_pids().items() if parent == pid]
+    ticks = os.sysconf("SC_CLK_TCK")
+    usage = {"cpu_seconds": 0.0, "rss_bytes": 0, "peak_rss_bytes": 0}
+    for process in pids:
+        try:
+            with open("/proc/{}/stat".format(process)) as stat_file:
+                # The command name may contain spaces, the fields follow the last ")"
+                fields = stat_file.read().rpartition(")")[2].split()
+            with open("/proc/{}/status".format(process)) as status_file:
+                status = dict(line.split(":", 1) for line in status_file if ":" in line)
+        except OSError:
+            # The process ended in the meantime
+            continue
+        usage["cpu_seconds"] += (int(fields[11]) + int(fields[12])) / ticks
+        usage["rss_bytes"] += int(status.get("VmRSS", "0 kB").split()[0]) * 1024
+        usage["peak_rss_bytes"] += int(status.get("VmHWM", "0 kB").split()[0]) * 1024
+    return usage
+
+def _parent_pids():
+    parents = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(name)) as stat_file:
+                parents[int(name)] = int(stat_file.read().rpartition(")")[2].split()[1])
+        except (OSError, IndexError, ValueError):
+            pass
+    return parents
+
+def serve(engine, host, port, workers, ready, stop, rate_limits=False):
+    """
+    Entry point of the server process.
+
+    Parameters:
+    engine (str): Server engine, "thread" or "asyncio"
+    host (str): Interface to listen on
+    port (int): Port to listen on
+    workers (int): Number of worker processes
+    ready (multiprocessing.Event): Set once the server accepts connections
+    stop (multiprocessing.Event): Stops the server when set
+    rate_limits (bool): Keep the per-client rate limits, by default they are
+                        turned off so the senders measure the server
+    """
+    from serverThread import create_server
+    raise_file_limit()
+    # Don't mix the disconnect messages of the server into the report
+    sys.stdout = open(os.devnull, "w")
+    server = create_server(engine, host, port, log_directory=None, workers=workers)
+    if not rate_limits:
+        server.configure(message_rate=None, byte_rate=None)
+    server.start()
+    if server.listening.wait(30):
+        ready.set()
+        stop.wait()
+    server.stop()
+    server.join()
+
+
+class SimulatedClient():
+    """
+    One headless chat client. Connects with the regular handshake, optionally posts
+    messages at a fixed rate and records the latency of every benchmark message
+    it receives.
+    """
+    def __init__(self, benchmark, name, rate):
+        """
+        Parameters:
+        benchmark (Benchmark): The benchmark collecting the results
+        name (str): Username of the client
+        rate (float): Messages posted per second, 0 only listens
+        """
+        self.benchmark = benchmark
+        self.name = name
+        self.rate = rate
+        self.connection = None
+        self.received = 0
+        self.last_sent = time.monotonic()
+
+    async def connect(self, host, port):
+        """Opens the connection and joins the chat, returns the time it took"""
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        _, self.connection = await loop.create_connection(AsyncMessageProtocol, host, port)
+        await self.connection.negotiate(self.benchmark.capabilities)
+        self.connection.queue_message(self.name)
+        if self.connection.capabilities.get("resume"):
+            # Every simulated client starts a new session
+            self.connection.queue_control(Control("resume", ["-"]))
+        await self.connection.flush()
+        return time.monotonic() - started
+
+    async def read(self):
+        """Receives messages until the connection is closed"""
+        benchmark = self.benchmark
+        try:
+            while True:
+                message = await self.connection.get_message()
+                if not message or not isinstance(message, str):
+                    continue
+                now = time.monotonic()
+                for line in message.split("\n"):
+                    position = line.find(BENCH_TAG)
+                    if position < 0:
+                        continue
+                    sent = float(line[position:].split(" ", 3)[2])
+                    if sent >= benchmark.measure_from:
+                        benchmark.latencies.append(now - sent)
+                        self.received += 1
+        except ConnectionBroken:
+            pass
+
+    async def keepalive(self):
+        """Pings the server when the client sent nothing for PING_DELAY seconds"""
+        try:
+            while True:
+                await asyncio.sleep(self.last_sent + PING_DELAY - time.monotonic())
+                if time.monotonic() - self.last_sent >= PING_DELAY:
+                    await self.connection.ping()
+                    self.last_sent = time.monotonic()
+        except ConnectionBroken:
+            pass
+
+    async def post(self, until):
+        """
+        Posts messages at the client's rate.
+
+        Parameters:
+        until (float): time.monotonic at which posting stops
+        """
+        interval = 1 / self.rate
+        next_post = time.monotonic()
+        padding = self.benchmark.padding
+        while next_post < until:
+            delay = next_post - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text = "{}{} {:.6f} {}".format(BENCH_TAG, self.name, time.monotonic(), padding)
+            await self.connection.send_message(text)
+            self.last_sent = time.monotonic()
+            self.benchmark.posted += 1
+            next_post += interval
+
+
+class Benchmark():
+    """
+    Drives a server with simulated clients and measures it. Results are returned
+    by run as a dict ready to be written as JSON.
+    """
+    def __init__(self, host="localhost", port=SERVER_PORT, clients=100, senders=10,
+                 rate=10.0, size=100, duration=10.0, drain=5.0, connect_concurrency=100,
+                 capabilities=SUPPORTED_CAPABILITIES, server_pid=None):
+        """
+        Parameters:
+        host (str): Address of the server
+        port (int): Port of the server
+        clients (int): Number of simulated clients
+        senders (int): How many of the clients post messages
+        rate (float): Messages per second posted by each sender
+        size (int): Size of a posted message in characters
+        duration (float): Seconds the senders post messages
+        drain (float): Seconds to wait for outstanding deliveries after posting stops
+        connect_concurrency (int): Maximal number of connections opened at once
+        capabilities (dict): Capabilities offered in the handshake
+        server_pid (int): Process of the server whose CPU and memory are measured
+        """
+        self.host = host
+        self.port = port
+        self.clients = clients
+        self.senders = min(senders, clients)
+        self.rate = rate
+        self.size = size
+        self.duration = duration
+        self.drain = drain
+        self.connect_concurrency = connect_concurrency
+        self.capabilities = capabilities
+        self.server_pid = server_pid
+
+        header = len("{}client99999 {:.6f} ".format(BENCH_TAG, time.monotonic()))
+        self.padding = "x" * max(0, size - header)
+        self.latencies = []
+        self.posted = 0
+        # Messages sent before this time (e.g. by a previous run) aren't measured
+        self.measure_from = float("inf")
+
+    async def _connect_all(self, clients):
+        limit = asyncio.Semaphore(self.connect_concurrency)
+
+        async def connect(client):
+            async with limit:
+                return await client.connect(self.host, self.port)
+
+        results = await asyncio.gather(*(connect(c) for c in clients), return_exceptions=True)
+        connect_times = [r for r in results if not isinstance(r, BaseException)]
+        errors = [repr(r) for r in results if isinstance(r, BaseException)]
+        return connect_times, errors
+
+    async def run_async(self):
+        """Runs the benchmark on the current event loop, returns the results"""
+        clients = [SimulatedClient(self, "client{}".format(i),
+                                   self.rate if i < self.senders else 0)
+                   for i in range(self.clients)]
+        connect_started = time.monotonic()
+        connect_times, errors = await self._connect_all(clients)
+        connect_duration = time.monotonic() - connect_started
+        connected = [c for c in clients if c.connection is not None and c.connection.error is None]
+        readers = [asyncio.ensure_future(c.read()) for c in connected]
+        keepalives = [asyncio.ensure_future(c.keepalive()) for c in connected]
+
+        usage_before = process_usage(self.server_pid) if self.server_pid else None
+        self.measure_from = started = time.monotonic()
+        until = started + self.duration
+        await asyncio.gather(*(c.post(until) for c in connected if c.rate),
+                             return_exceptions=True)
+        posting_duration = time.monotonic() - started
+
+        # Every posted message is delivered to every connected client
+        expected = self.posted * len(connected)
+        drain_until = time.monotonic() + self.drain
+        while len(self.latencies) < expected and time.monotonic() < drain_until:
+            await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - started
+        usage_after = process_usage(self.server_pid) if self.server_pid else None
+
+        for keepalive in keepalives:
+            keepalive.cancel()
+        for client in connected:
+            client.connection.terminate()
+        await asyncio.gather(*readers, *keepalives, return_exceptions=True)
+
+        server = None
+        if usage_before and usage_after:
+            server = {
+                "cpu_seconds": usage_after["cpu_seconds"] - usage_before["cpu_seconds"],
+                "cpu_percent": 100 * (usage_after["cpu_seconds"]
+                                      - usage_before["cpu_seconds"]) / elapsed,
+                "rss_bytes": usage_after["rss_bytes"],
+                "peak_rss_bytes": usage_after["peak_rss_bytes"],
+            }
+        delivered = len(self.latencies)
+        return {
+            "clients": {"requested": self.clients, "connected": len(connected),
+                        "errors": errors[:10], "error_count": len(errors)},
+            "connect": {"duration": connect_duration,
+                        "latency": percentiles(connect_times)},
+            "posted": self.posted,
+            "expected_deliveries": expected,
+            "delivered": delivered,
+            "lost": expected - delivered,
+            "posting_duration": posting_duration,
+            "post_rate": self.posted / posting_duration if posting_duration else 0,
+            "delivery_rate": delivered / elapsed if elapsed else 0,
+            "latency": percentiles(self.latencies),
+            "server": server,
+        }
+
+    def run(self):
+        """Runs the benchmark on a new event loop, returns the results"""
+        return asyncio.run(self.run_async())
+
+
+def run_benchmark(engine=SERVER_ENGINE, workers=1, host=None, port=None, rate_limits=False,
+                  **options):
+    """
+    Starts a server in a separate process, runs the benchmark against it and
+    returns the results together with the configuration. With a host the
+    benchmark runs against an already running server instead.
+
+    Parameters:
+    engine (str): Server engine, "thread" or "asyncio"
+    workers (int): Number of server worker processes
+    host (str): Address of a running server, None starts a local one
+    port (int): Port of the server, None picks a free one for a local server
+    rate_limits (bool): Keep the per-client rate limits of a local server
+    options: Further arguments of Benchmark
+    """
+    raise_file_limit()
+    process = None
+    stop = None
+    if host is None:
+        host = "localhost"
+        if port is None:
+            with socket.socket() as s:
+                s.bind((host, 0))
+                port = s.getsockname()[1]
+        context = multiprocessing.get_context()
+        ready = context.Event()
+        stop = context.Event()
+        process = context.Process(target=serve, daemon=True,
+                                  args=(engine, host, port, workers, ready, stop, rate_limits))
+        process.start()
+        if not ready.wait(30):
+            process.terminate()
+            raise RuntimeError("Server didn't start listening on port {}".format(port))
+        options.setdefault("server_pid", process.pid)
+
+    benchmark = Benchmark(host, port if port is not None else SERVER_PORT, **options)
+    try:
+        results = benchmark.run()
+    finally:
+        if process:
+            stop.set()
+            process.join(30)
+            if process.is_alive():
+                process.terminate()
+
+    config = {name: getattr(benchmark, name) for name in
+              ("clients", "senders", "rate", "size", "duration", "drain")}
+    config.update(engine=engine, workers=workers, host=host, port=port,
+                  local_server=process is not None, rate_limits=rate_limits)
+    return {
+        "time": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": config,
+        "results": results,
+    }
+
+def summary(report):
+    """
+    Returns a short human readable summary of a report.
+
+    Parameters:
+    report (dict): Report returned by run_benchmark
+    """
+    results = report["results"]
+    latency = results["latency"]
+    lines = [
+        "{connected}/{requested} clients connected".format(**results["clients"]),
+        "connect p50 {:.1f} ms, p99 {:.1f} ms".format(
+            1000 * results["connect"]["latency"].get("p50", 0),
+            1000 * results["connect"]["latency"].get("p99", 0)),
+        "{} posted, {} of {} deliveries ({:.0f}/s)".format(
+            results["posted"], results["delivered"], results["expected_deliveries"],
+            results["delivery_rate"]),
+        "latency p50 {:.2f} ms, p99 {:.2f} ms, p999 {:.2f} ms".format(
+            1000 * latency.get("p50", 0), 1000 * latency.get("p99", 0),
+            1000 * latency.get("p999", 0)),
+    ]
+    if results["server"]:
+        lines.append("server cpu {:.0f}%, rss {:.1f} MiB".format(
+            results["server"]["cpu_percent"], results["server"]["rss_bytes"] / 2**20))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server load benchmark")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default=SERVER_ENGINE)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes of the local server")
+    parser.add_argument("--host", default=None,
+                        help="Address of a running server, by default a local one is started")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--server-pid", type=int, default=None,
+                        help="Process of a running server to measure CPU and memory of")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=10,
+                        help="Number of clients posting messages")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="Messages per second posted by each sender")
+    parser.add_argument("--size", type=int, default=100, help="Message size in characters")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--drain", type=float, default=5.0,
+                        help="Seconds to wait for outstanding deliveries")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="Keep the per-client rate limits of the local server")
+    parser.add_argument("--framing", choices=("length", "delimited"), default=None,
+                        help="Framing offered by the clients, by default all supported")
+    parser.add_argument("--compression", choices=("zlib", "none"), default="zlib",
+                        help="Compression offered by the clients")
+    parser.add_argument("--output", default=None, help="JSON file the report is written to")
+    args = parser.parse_args()
+
+    capabilities = dict(SUPPORTED_CAPABILITIES)
+    if args.framing:
+        capabilities["framing"] = (args.framing,)
+    if args.compression == "none":
+        del capabilities["compression"]
+    options = {}
+    if args.server_pid:
+        options["server_pid"] = args.server_pid
+    report = run_benchmark(args.engine, args.workers, args.host, args.port, args.rate_limits,
+                           clients=args.clients, senders=args.senders, rate=args.rate,
+                           size=args.size, duration=args.duration, drain=args.drain,
+                           connect_concurrency=args.connect_concurrency,
+                           capabilities=capabilities, **options)
+    print(summary(report))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
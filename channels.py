@@ -0,0 +1,77 @@
+from const import *
+from messageHistory import MessageHistory
+from searchIndex import SearchIndex
+
+class Channel():
+    """
+    A named chat room. Keeps its own history with its own sequence numbers, a
+    search index of the history and the set of subscribed clients, so
+    publishing to a channel only concerns its members.
+
+    Isn't thread safe, the server guards it with its messages lock.
+    """
+    def __init__(self, name, history=None):
+        """
+        Parameters:
+        name (str): Name of the channel
+        history (MessageHistory): History of the channel, by default one capped
+                                  at CHANNEL_HISTORY_MESSAGES messages and
+                                  CHANNEL_HISTORY_BYTES bytes
+        """
+        self.name = name
+        if history is None:
+            history = MessageHistory(min(CHANNEL_HISTORY_MESSAGES, HISTORY_MAX_MESSAGES),
+                                     min(CHANNEL_HISTORY_BYTES, HISTORY_MAX_BYTES))
+        self.history = history
+        self.index = SearchIndex(history.next_seq)
+        # Dict used as an ordered set of the subscribed clients
+        self.subscribers = {}
+        # Disconnected sessions that can still resume in the channel, an
+        # empty channel is kept for them
+        self.sessions = 0
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def append(self, message):
+        """
+        Adds a message to the history and the search index, the index forgets
+        the messages the history drops.
+
+        Parameters:
+        message (Message): The new message
+        """
+        self.history.append(message)
+        self.index.add(message)
+        self.index.evict(self.history.first_seq)
+
+    def subscribe(self, client):
+        """
+        Adds a client to the channel. Returns False if it already was subscribed.
+
+        Parameters:
+        client (Client): The client
+        """
+        if client in self.subscribers:
+            return False
+        self.subscribers[client] = None
+        return True
+
+    def unsubscribe(self, client):
+        """
+        Removes a client from the channel. Returns False if it wasn't subscribed.
+
+        Parameters:
+        client (Client): The client
+        """
+        return self.subscribers.pop(client, False) is None
+
+def valid_channel_name(name):
+    """
+    Returns True if the name can be used for a channel: up to 32 letters,
+    digits, "-" or "_".
+
+    Parameters:
+    name (str): Requested name without the leading "#"
+    """
+    return 0 < len(name) <= 32 and all(c.isalnum() or c in "-_" for c in name)
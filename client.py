@@ -1,6 +1,8 @@
+from const import *
 from clientThread import ClientThread
 
 import tkinter as tk
+import queue
 import re
 
 WIDTH = 400
@@ -62,11 +64,15 @@ class ClientApp(tk.Frame):
         super().__init__(master, bg=BACKGROUND)
         self.client = ClientThread(username)
         self.client.add_observer(self)
+        # Messages passed by the client thread, displayed by the Tk main loop
+        self.incoming = queue.Queue()
+        self.scrollback = CHAT_SCROLLBACK_LINES
         self.create_elements()
 
     def start(self):
         """Starts the client thread and the GUI"""         
         self.client.start()
+        self.after(RENDER_INTERVAL, self.render)
         self.mainloop()
 
     def stop(self):
@@ -118,16 +124,43 @@ class ClientApp(tk.Frame):
 
     def notify(self, messages):
         """
-        Function used by the ClientThread to pass new messages to the display
+        Function used by the ClientThread to pass new messages to the display.
+        Runs in the client thread, so the messages are only queued here and
+        displayed by render.
         
         Parameters:
         messages (list): List of strings containing the new chat messages
         """
-        self.chat.configure(state=tk.NORMAL)
-        for message in messages:
-            self.chat.insert(tk.END, message + "\n")
-        self.chat.configure(state=tk.DISABLED)
-        self.chat.see(tk.END)
+        self.incoming.put(messages)
+
+    def render(self):
+        """
+        Displays the queued messages with a single insert, every RENDER_INTERVAL
+        milliseconds on the Tk main loop. Lines above the scrollback limit are
+        removed and the chat only follows new messages if it was scrolled to
+        the bottom.
+        """
+        lines = []
+        try:
+            while True:
+                lines.extend(self.incoming.get_nowait())
+        except queue.Empty:
+            pass
+
+        if lines:
+            # Lines that would be trimmed right away aren't inserted at all
+            lines = lines[-self.scrollback:]
+            at_bottom = self.chat.yview()[1] >= 1.0
+            self.chat.configure(state=tk.NORMAL)
+            self.chat.insert(tk.END, "\n".join(lines) + "\n")
+            # The text always ends with an extra newline, so it has one more line
+            excess = int(self.chat.index(tk.END).split(".")[0]) - 2 - self.scrollback
+            if excess > 0:
+                self.chat.delete("1.0", "{}.0".format(excess + 1))
+            self.chat.configure(state=tk.DISABLED)
+            if at_bottom:
+                self.chat.see(tk.END)
+        self.after(RENDER_INTERVAL, self.render)
 
 
 if __name__ == "__main__":
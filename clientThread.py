@@ -1,10 +1,10 @@
 from const import *
 
-from protocol import MessageProtocol, ConnectionBroken
+from asyncClient import AsyncClient
+from protocol import ConnectionBroken
 
-import socket
+import asyncio
 import threading
-import queue
 
 class ClientThread(threading.Thread):    
     """
@@ -12,61 +12,74 @@ class ClientThread(threading.Thread):
     The messages received by the client can be aquired by registering observers
     (Client.add_observer). Observers need to have a notify method takes 1 argument
     through which newly received messages will be passed.
+
+    Runs an AsyncClient on an event loop of its own, so queued messages are
+    sent right away and reconnecting works the same way.
     """
      
-    def __init__(self, username):
+    def __init__(self, username, host=CLIENT_CONNECTION_POINT, port=SERVER_PORT):
+        """
+        Parameters:
+        username (str): Name of the user
+        host (str): Address of the server
+        port (int): Port of the server
+        """
         threading.Thread.__init__(self)
         self.username = username
+        self.host = host
+        self.port = port
         self.observers = []        
-        self.connection = None
-        self.thread = None
-        self.message_queue = queue.Queue()
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncClient(username, host, port,
+                                  status=lambda text: self._notify_observers([text]))
 
     def run(self):
         """
-        Overwrites threading.Thread.run, makes a connection to the server, then
-        receives and sends messages in a loop inside a thread
+        Overwrites threading.Thread.run, runs the event loop of the client
+        until it is stopped or gives up reconnecting.
         """
         try:
-            opened_socket = socket.socket()
-            opened_socket.connect((CLIENT_CONNECTION_POINT, SERVER_PORT))            
-            self.connection = MessageProtocol(opened_socket)
-        except OSError as e:
-            self._notify_observers(["Unable to connect to {}:{}. {}"
-                .format(CLIENT_CONNECTION_POINT, SERVER_PORT, str(e))])
-            return
+            self.loop.run_until_complete(self._receive())
+        finally:
+            self.loop.close()
 
-        try:            
-            self.connection.send_message(self.username)            
-            while True:
-                received_data = self.connection.get_message()                
-                if received_data:
-                    messages = received_data.split("\n")
-                    self._notify_observers(messages)                
-                try:
-                    self.connection.send_message(self.message_queue.get(timeout=PING_DELAY))
-                except queue.Empty:
-                    self.connection.ping()
-
-        except ConnectionBroken as e:
-            self.connection.terminate()
-            self._notify_observers(["Client disonnected with error {}".format(str(e))])            
+    async def _receive(self):
+        """Passes the received messages to the observers"""
+        try:
+            async for message in self.client.messages():
+                self._notify_observers(message.split("\n"))
+        except ConnectionBroken:
+            # The observers were told about the failures already
+            pass
+        finally:
+            self.client.close()
+            # Lets the sends still waiting fail
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     def stop(self):
         """
         Stops the socket connection, in effect also stopping the thread.
         """
-        if self.connection:
-            self.connection.terminate()
+        try:
+            self.loop.call_soon_threadsafe(self.client.close)
+        except RuntimeError:
+            # The loop is closed already
+            pass
 
     def send_message(self, message):
         """
-        Queues up a message to send to the server.
+        Queues up a message to send to the server. Can be called from any thread.
 
         Parameters:
         message (str): A message to send
         """
-        self.message_queue.put(message)
+        send = self.client.send(message)
+        try:
+            asyncio.run_coroutine_threadsafe(send, self.loop)
+        except RuntimeError:
+            # The loop is closed already, the message can't be sent
+            send.close()
 
     def add_observer(self, observer):
         """
@@ -1,5 +1,57 @@
 SERVER_HOST = "" # Empty host means binding to all available interfaces
 SERVER_PORT = 12345
+SERVER_ENGINE = "thread" # "thread" (thread per client) or "asyncio" (single event loop)
+SERVER_WORKERS = 1 # Worker processes sharing the server port
+
+HISTORY_MAX_MESSAGES = 10000 # Messages retained in memory by the server
+HISTORY_MAX_BYTES = 16 * 2**20 # Total size of the retained messages
+HISTORY_READ_BATCH = 256 # Messages sent to a client at once
+JOIN_HISTORY_MESSAGES = 1000 # Messages sent to a client after joining
+DEFAULT_CHANNEL = "general" # Channel every client joins on connecting
+CHANNEL_HISTORY_MESSAGES = 1000 # Messages retained in memory by every other channel
+CHANNEL_HISTORY_BYTES = 256 * 2**10 # Their total size, at most MAX_CHANNELS times this in all
+MAX_CHANNELS = 1000 # Channels a server keeps at most
+SEARCH_PAGE_SIZE = 20 # Results returned by one search
+SEARCH_MAX_TERM_LENGTH = 32 # Longer words are indexed by their beginning
+FLUSH_DELAY = 0.002 # Seconds outgoing messages may wait to be sent together
+FLUSH_BYTES = 64 * 2**10 # Outgoing bytes that are sent right away
+CLIENT_MESSAGE_RATE = 100 # Messages per second a client may send on average, None for no limit
+CLIENT_MESSAGE_BURST = 200 # Messages a client may send at once
+CLIENT_BYTE_RATE = 2**20 # Bytes per second a client may send on average, None for no limit
+CLIENT_BYTE_BURST = 4 * 2**20 # Bytes a client may send at once
+INBOUND_BATCH = 16 # Messages handled from one connection before the asyncio engine serves the others
+PRESENCE_DELAY = 0.1 # Seconds joins and leaves are collected before notifying observers
+STREAM_THRESHOLD = 2**20 # Messages larger than this (in characters) are sent as a stream of chunks
+STREAM_MAX_BYTES = 2**30 # Largest streamed message the server relays
+STREAM_BUFFER_BYTES = 4 * 2**20 # Streamed bytes queued for a recipient before its transfer is interrupted
+IDLE_TIMEOUT = 30 # Seconds without any data from a client before the server closes its connection
+TIMER_TICK = 1 # Precision of the idle timeouts in seconds
+TIMER_WHEEL_SLOTS = 64 # Slots of the timer wheel tracking the idle timeouts
+SESSION_TIMEOUT = 300 # Seconds a disconnected session can be resumed
+DRAIN_TIMEOUT = 5 # Seconds a server stopped by the daemon waits for queued messages to be sent
+
+LOG_DIRECTORY = None # Directory of the persistent message log, None disables it
+LOG_SEGMENT_SIZE = 64 * 2**20 # Size of one log file
+LOG_INDEX_INTERVAL = 64 # Every n-th stored message is indexed
+LOG_SYNC_INTERVAL = 0.2 # Seconds between syncing the log to disk
+
+STATS_HOST = "127.0.0.1" # Interface of the stats endpoint, local only by default
+STATS_PORT = None # Port serving the server statistics as JSON, None disables it
+STATS_FILE = None # File the statistics are appended to periodically, None disables it
+STATS_INTERVAL = 10 # Seconds between two dumps of the statistics
+
+PROFILE_DIRECTORY = None # Directory profiling captures are written to, None disables profiling
+PROFILE_SAMPLE_SECONDS = 10 # Duration of a cpu capture
+PROFILE_SAMPLE_INTERVAL = 0.005 # Seconds between two stack samples
+PROFILE_TRACE_FRAMES = 16 # Frames tracemalloc keeps of every allocation
+PROFILE_TRACE_MEMORY = False # Trace allocations from the start, slows allocating down a lot
+PROFILE_TOP_LINES = 30 # Source lines listed in a memory capture
 
 CLIENT_CONNECTION_POINT = "localhost"
-PING_DELAY = 1 # Ping the server every 1 second
+PING_DELAY = IDLE_TIMEOUT / 3 # Ping the server after sending nothing for this many seconds
+RECONNECT_DELAY = 0.5 # Seconds before the first reconnection attempt, doubled after every failure
+RECONNECT_MAX_DELAY = 30 # Longest wait between reconnection attempts
+RECONNECT_ATTEMPTS = 10 # Failed attempts in a row after which the client gives up
+CHAT_SCROLLBACK_LINES = 5000 # Lines kept in the chat window of the client
+STREAM_PREVIEW_BYTES = 64 * 2**10 # Bytes of a received stream shown, the whole message is saved to a file
+RENDER_INTERVAL = 50 # Milliseconds between displaying batches of received messages
@@ -0,0 +1,111 @@
+from time import monotonic
+# Taken before the other imports, they are part of the startup time
+started = monotonic()
+
+from const import *
+from serverThread import create_server
+
+import argparse
+import os
+import signal
+import sys
+import threading
+
+# Headless entry point of the server for machines without a display. Never
+# imports tkinter, settings come from the command line or from CHAT_*
+# environment variables. SIGTERM and SIGINT stop accepting connections and give
+# the clients DRAIN_TIMEOUT seconds to receive their queued messages.
+# With a profile directory SIGUSR1 writes a cpu capture and SIGUSR2 a memory
+# capture, see profiler.py.
+
+def parse_arguments(argv=None, environ=os.environ):
+    """
+    Parses the settings of the daemon, environment variables are the defaults
+    of the command line options.
+
+    Parameters:
+    argv (list): Command line arguments, by default sys.argv
+    environ (dict): Environment variables
+    """
+    def setting(name, default, convert=str):
+        value = environ.get("CHAT_" + name)
+        return default if value is None else convert(value)
+
+    parser = argparse.ArgumentParser(description="Headless chat server")
+    parser.add_argument("--host", default=setting("HOST", SERVER_HOST),
+                        help="Interface to listen on, empty for all (CHAT_HOST)")
+    parser.add_argument("--port", type=int, default=setting("PORT", SERVER_PORT, int),
+                        help="Port to listen on (CHAT_PORT)")
+    parser.add_argument("--engine", choices=("thread", "asyncio"),
+                        default=setting("ENGINE", SERVER_ENGINE),
+                        help="Server engine (CHAT_ENGINE)")
+    parser.add_argument("--workers", type=int, default=setting("WORKERS", SERVER_WORKERS, int),
+                        help="Number of worker processes sharing the port (CHAT_WORKERS)")
+    parser.add_argument("--log-directory", default=setting("LOG_DIRECTORY", LOG_DIRECTORY),
+                        help="Directory of the persistent message log (CHAT_LOG_DIRECTORY)")
+    parser.add_argument("--idle-timeout", type=float,
+                        default=setting("IDLE_TIMEOUT", IDLE_TIMEOUT, float),
+                        help="Seconds after which silent connections are closed (CHAT_IDLE_TIMEOUT)")
+    parser.add_argument("--message-rate", type=float,
+                        default=setting("MESSAGE_RATE", CLIENT_MESSAGE_RATE, float),
+                        help="Messages per second a client may send, 0 for no limit "
+                             "(CHAT_MESSAGE_RATE)")
+    parser.add_argument("--byte-rate", type=float,
+                        default=setting("BYTE_RATE", CLIENT_BYTE_RATE, float),
+                        help="Bytes per second a client may send, 0 for no limit (CHAT_BYTE_RATE)")
+    parser.add_argument("--stats-port", type=int, default=setting("STATS_PORT", STATS_PORT, int),
+                        help="Local port serving the statistics (CHAT_STATS_PORT)")
+    parser.add_argument("--profile-directory",
+                        default=setting("PROFILE_DIRECTORY", PROFILE_DIRECTORY),
+                        help="Enables profiling, captures are written to this directory "
+                             "(CHAT_PROFILE_DIRECTORY)")
+    parser.add_argument("--drain-timeout", type=float,
+                        default=setting("DRAIN_TIMEOUT", DRAIN_TIMEOUT, float),
+                        help="Seconds the clients get to receive queued messages when "
+                             "stopping (CHAT_DRAIN_TIMEOUT)")
+    args = parser.parse_args(argv)
+    if args.workers > 1 and args.stats_port is not None:
+        parser.error("--stats-port (CHAT_STATS_PORT) needs a single worker")
+    return args
+
+def main(argv=None):
+    """
+    Runs the server until SIGTERM or SIGINT. Returns the exit status.
+
+    Parameters:
+    argv (list): Command line arguments, by default sys.argv
+    """
+    args = parse_arguments(argv)
+    server = create_server(args.engine, args.host, args.port, args.log_directory, args.workers)
+    server.configure(idle_timeout=args.idle_timeout, stats_port=args.stats_port,
+                     message_rate=args.message_rate or None, byte_rate=args.byte_rate or None,
+                     profile_directory=args.profile_directory or None)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    if args.profile_directory and hasattr(signal, "SIGUSR1"):
+        # Captures run in a background thread, the handler returns right away
+        signal.signal(signal.SIGUSR1, lambda signum, frame: server.capture("cpu"))
+        signal.signal(signal.SIGUSR2, lambda signum, frame: server.capture("memory"))
+
+    server.start()
+    while not server.listening.wait(0.01) and server.is_alive():
+        pass
+    if not server.listening.is_set():
+        print("Server failed to start.", flush=True)
+        return 1
+    print("Listening on {}:{} ({} engine, {} workers), started in {:.0f} ms.".format(
+        args.host, args.port, args.engine, args.workers, (monotonic() - started) * 1000),
+        flush=True)
+
+    while server.is_alive() and not stopping.wait(0.5):
+        pass
+    print("Stopping, draining connections for up to {} seconds.".format(args.drain_timeout),
+          flush=True)
+    server.stop(args.drain_timeout)
+    server.join()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+from const import *
+
+class TokenBucket():
+    """
+    Token bucket allowing rate amounts per second on average and bursts of up
+    to burst at once. An amount larger than the burst passes when the bucket
+    is full and leaves it in debt, so oversized messages are slowed down
+    instead of being refused forever.
+    """
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate, burst, now):
+        """
+        Parameters:
+        rate (float): Tokens added per second
+        burst (float): Capacity of the bucket
+        now (float): Current monotonic time
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def wait_time(self, amount, now):
+        """
+        Returns how many seconds to wait until the amount can be taken, 0 if
+        it can be taken now.
+
+        Parameters:
+        amount (float): Tokens needed
+        now (float): Current monotonic time
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return max(0.0, (min(amount, self.burst) - self.tokens) / self.rate)
+
+    def take(self, amount):
+        """
+        Takes tokens after wait_time returned 0.
+
+        Parameters:
+        amount (float): Tokens taken
+        """
+        self.tokens -= amount
+
+
+class FlowLimiter():
+    """
+    Limits the messages and bytes a client sends per second and counts how
+    often and for how long it was throttled. Isn't thread safe, every
+    connection is read by a single thread or task.
+    """
+    __slots__ = ("messages", "bytes", "throttles", "throttled_time")
+
+    def __init__(self, message_rate, message_burst, byte_rate, byte_burst, now):
+        """
+        Parameters:
+        message_rate (float): Messages per second, None for no limit
+        message_burst (int): Messages accepted at once
+        byte_rate (float): Bytes per second, None for no limit
+        byte_burst (int): Bytes accepted at once
+        now (float): Current monotonic time
+        """
+        self.messages = TokenBucket(message_rate, message_burst, now) if message_rate else None
+        self.bytes = TokenBucket(byte_rate, byte_burst, now) if byte_rate else None
+        self.throttles = 0
+        self.throttled_time = 0.0
+
+    def admit(self, size, now):
+        """
+        Accounts for a received message. Returns 0 if it is within the limits,
+        otherwise the seconds to wait before calling admit again.
+
+        Parameters:
+        size (int): Size of the message
+        now (float): Current monotonic time
+        """
+        wait = 0.0
+        if self.messages:
+            wait = self.messages.wait_time(1, now)
+        if self.bytes:
+            wait = max(wait, self.bytes.wait_time(size, now))
+        # Rounding can leave a negligible deficit after waiting
+        if wait > 1e-6:
+            self.throttles += 1
+            self.throttled_time += wait
+            return wait
+        if self.messages:
+            self.messages.take(1)
+        if self.bytes:
+            self.bytes.take(size)
+        return 0.0
+
+    def as_dict(self):
+        return {"throttles": self.throttles, "throttled_time": self.throttled_time}
@@ -0,0 +1,79 @@
+from const import *
+
+class MessageHistory():
+    """
+    Keeps the most recent chat messages in a ring buffer capped by the number of
+    messages and their total size. Every message gets a sequence number that keeps
+    increasing for the life of the server, so readers can track their position
+    with a single number that stays valid after old messages are dropped.
+
+    Isn't thread safe, the server guards it with its messages lock.
+    """
+    def __init__(self, max_messages=HISTORY_MAX_MESSAGES, max_bytes=HISTORY_MAX_BYTES,
+                 start_seq=0):
+        """
+        Parameters:
+        max_messages (int): Maximal number of retained messages
+        max_bytes (int): Maximal total size of the retained messages
+        start_seq (int): Sequence number of the first appended message
+        """
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.slots = [None] * max_messages
+        self.sizes = [0] * max_messages
+        # Sequence number of the oldest retained message and of the next appended one
+        self.first_seq = start_seq
+        self.next_seq = start_seq
+        self.size_bytes = 0
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    def append(self, message):
+        """
+        Adds a message, dropping the oldest ones if a cap is exceeded. Returns the
+        sequence number given to the message.
+
+        Parameters:
+        message (Message): The new message
+        """
+        size = message.size()
+        while len(self) and (len(self) == self.max_messages
+                             or self.size_bytes + size > self.max_bytes):
+            self._drop_oldest()
+
+        seq = self.next_seq
+        slot = seq % self.max_messages
+        message.seq = seq
+        self.slots[slot] = message
+        self.sizes[slot] = size
+        self.size_bytes += size
+        self.next_seq += 1
+        return seq
+
+    def _drop_oldest(self):
+        slot = self.first_seq % self.max_messages
+        self.slots[slot] = None
+        self.size_bytes -= self.sizes[slot]
+        self.first_seq += 1
+
+    def read(self, seq, limit=None, end_seq=None):
+        """
+        Returns messages starting with the sequence number seq as a tuple
+        (number of requested messages that were already dropped, list of messages,
+        sequence number to continue reading from).
+
+        Parameters:
+        seq (int): Sequence number of the first wanted message
+        limit (int): Maximal number of returned messages
+        end_seq (int): Sequence number following the last wanted message
+        """
+        if end_seq is None:
+            end_seq = self.next_seq
+        skipped = max(0, min(self.first_seq, end_seq) - seq)
+        seq += skipped
+        end = min(end_seq, self.next_seq)
+        if limit is not None:
+            end = min(end, seq + limit)
+        messages = [self.slots[s % self.max_messages] for s in range(seq, end)]
+        return skipped, messages, max(seq, end)
@@ -0,0 +1,308 @@
+from const import *
+
+import bisect
+import mmap
+import os
+import struct
+import threading
+
+# Header of a stored record: sequence number, unix timestamp, payload length
+RECORD_HEADER = struct.Struct("!QdI")
+# Entry of the sparse index: sequence number, unix timestamp, offset of the record
+INDEX_ENTRY = struct.Struct("!QdQ")
+
+def iter_records(buffer, offset, end):
+    """
+    Yields (sequence number, timestamp, payload offset, payload length) of the
+    complete records stored in buffer[offset:end].
+
+    Parameters:
+    buffer: bytes-like object holding the records
+    offset (int): Offset of the first record
+    end (int): End of the stored data
+    """
+    while offset + RECORD_HEADER.size <= end:
+        seq, timestamp, length = RECORD_HEADER.unpack_from(buffer, offset)
+        payload_offset = offset + RECORD_HEADER.size
+        if payload_offset + length > end:
+            return
+        yield seq, timestamp, payload_offset, length
+        offset = payload_offset + length
+
+class LogSegment():
+    """
+    One file of the message log holding the records starting with first_seq,
+    together with its sparse index kept in memory and in a separate file.
+    """
+    def __init__(self, directory, first_seq):
+        """
+        Parameters:
+        directory (str): Directory of the log
+        first_seq (int): Sequence number of the first record in the segment
+        """
+        self.first_seq = first_seq
+        name = "{:020d}".format(first_seq)
+        self.path = os.path.join(directory, name + ".log")
+        self.index_path = os.path.join(directory, name + ".idx")
+        self.index_seqs = []
+        self.index_times = []
+        self.index_offsets = []
+        self.size = 0
+        self.next_seq = first_seq
+
+    def load(self):
+        """Reads the index file and the size of the segment"""
+        self.size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as index_file:
+            data = index_file.read()
+        for offset in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+            seq, timestamp, record_offset = INDEX_ENTRY.unpack_from(data, offset)
+            if record_offset < self.size:
+                self.add_index_entry(seq, timestamp, record_offset)
+
+    def recover(self):
+        """
+        Finds the end of the last complete record, cutting off a record that was
+        only partially written before a crash, and drops the index entries of
+        the records cut off.
+        """
+        self.next_seq = self.first_seq
+        while True:
+            offset = self.index_offsets[-1] if self.index_offsets else 0
+            with open(self.path, "rb") as log_file:
+                log_file.seek(offset)
+                data = log_file.read()
+            end = 0
+            for seq, _, payload_offset, length in iter_records(data, 0, len(data)):
+                self.next_seq = seq + 1
+                end = payload_offset + length
+            if end or not self.index_offsets:
+                break
+            # The indexed record itself is torn, the one before it has to be found
+            self._drop_index_entries(offset)
+        if offset + end < self.size:
+            with open(self.path, "r+b") as log_file:
+                log_file.truncate(offset + end)
+            self.size = offset + end
+        self._drop_index_entries(self.size)
+        stored = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        if stored != len(self.index_offsets) * INDEX_ENTRY.size:
+            with open(self.index_path, "wb") as index_file:
+                for entry in zip(self.index_seqs, self.index_times, self.index_offsets):
+                    index_file.write(INDEX_ENTRY.pack(*entry))
+
+    def _drop_index_entries(self, offset):
+        """Drops the index entries of the records at or after offset"""
+        while self.index_offsets and self.index_offsets[-1] >= offset:
+            self.index_seqs.pop()
+            self.index_times.pop()
+            self.index_offsets.pop()
+
+    def add_index_entry(self, seq, timestamp, offset):
+        self.index_seqs.append(seq)
+        self.index_times.append(timestamp)
+        self.index_offsets.append(offset)
+
+    def offset_of_seq(self, seq):
+        """Returns the offset of an indexed record at or before seq"""
+        position = bisect.bisect_right(self.index_seqs, seq) - 1
+        return self.index_offsets[position] if position >= 0 else 0
+
+    def offset_of_time(self, timestamp):
+        """Returns the offset of an indexed record written before timestamp"""
+        position = bisect.bisect_left(self.index_times, timestamp) - 1
+        return self.index_offsets[position] if position >= 0 else 0
+
+
+class MessageLog():
+    """
+    Append-only message log on disk split into segment files. Writes are buffered
+    and synced to disk in batches by a background thread. Stored messages are
+    replayed by memory mapping the segments, so the stored bytes are sent as they
+    are without creating a Python object for every message.
+    """
+    def __init__(self, directory, segment_size=LOG_SEGMENT_SIZE,
+                 index_interval=LOG_INDEX_INTERVAL, sync_interval=LOG_SYNC_INTERVAL):
+        """
+        Parameters:
+        directory (str): Directory holding the segment files
+        segment_size (int): Size after which a new segment is started
+        index_interval (int): Every index_interval-th record is added to the index
+        sync_interval (float): Seconds between syncing written records to disk
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.closed = threading.Event()
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".log"):
+                segment = LogSegment(directory, int(name[:-len(".log")]))
+                segment.load()
+                self.segments.append(segment)
+        for segment, following in zip(self.segments, self.segments[1:]):
+            segment.next_seq = following.first_seq
+        if self.segments:
+            self.segments[-1].recover()
+        else:
+            self.segments.append(LogSegment(directory, 0))
+        self._open_active()
+
+        self.sync_thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self.sync_thread.start()
+
+    @property
+    def first_seq(self):
+        return self.segments[0].first_seq
+
+    @property
+    def next_seq(self):
+        return self.segments[-1].next_seq
+
+    def _open_active(self):
+        segment = self.segments[-1]
+        self.log_file = open(segment.path, "ab")
+        self.index_file = open(segment.index_path, "ab")
+
+    def append(self, message):
+        """
+        Stores a message that was given a sequence number by the history.
+
+        Parameters:
+        message (Message): The message to store
+        """
+        payload = message.payload()
+        timestamp = message.timestamp.timestamp()
+        with self.lock:
+            segment = self.segments[-1]
+            if segment.size >= self.segment_size:
+                self._roll(message.seq)
+                segment = self.segments[-1]
+            if (message.seq - segment.first_seq) % self.index_interval == 0:
+                segment.add_index_entry(message.seq, timestamp, segment.size)
+                self.index_file.write(INDEX_ENTRY.pack(message.seq, timestamp, segment.size))
+            self.log_file.write(RECORD_HEADER.pack(message.seq, timestamp, len(payload)))
+            self.log_file.write(payload)
+            segment.size += RECORD_HEADER.size + len(payload)
+            segment.next_seq = message.seq + 1
+            self.dirty = True
+
+    def _roll(self, first_seq):
+        """Closes the active segment and starts a new one"""
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+        self.log_file.close()
+        self.index_file.close()
+        self.segments.append(LogSegment(self.directory, first_seq))
+        self._open_active()
+
+    def sync(self):
+        """Writes the buffered records to disk"""
+        with self.lock:
+            if not self.dirty or self.log_file.closed:
+                return
+            self.log_file.flush()
+            self.index_file.flush()
+            self.dirty = False
+            # The file is synced outside of the lock so appends don't wait for the disk
+            log_fd = os.dup(self.log_file.fileno())
+        try:
+            os.fsync(log_fd)
+        finally:
+            os.close(log_fd)
+
+    def _sync_loop(self):
+        while not self.closed.wait(self.sync_interval):
+            self.sync()
+
+    def seq_at(self, timestamp):
+        """
+        Returns the sequence number of the first stored message written at or
+        after timestamp.
+
+        Parameters:
+        timestamp (float): Unix timestamp
+        """
+        with self.lock:
+            self.log_file.flush()
+            segments = [(s, s.size) for s in self.segments]
+        # The last segment that starts before the timestamp holds the answer
+        position = len(segments) - 1
+        while position > 0 and (not segments[position][0].index_times
+                                or segments[position][0].index_times[0] >= timestamp):
+            position -= 1
+        for segment, size in segments[position:]:
+            if size == 0:
+                continue
+            # Only the record headers from the indexed record on are read, the
+            # mapping doesn't load the rest of the segment
+            with open(segment.path, "rb") as log_file:
+                mapped = mmap.mmap(log_file.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                for seq, record_time, _, _ in iter_records(
+                        mapped, segment.offset_of_time(timestamp), size):
+                    if record_time >= timestamp:
+                        return seq
+            finally:
+                mapped.close()
+        return self.next_seq
+
+    def replay(self, first_seq, end_seq, batch_size=HISTORY_READ_BATCH):
+        """
+        Yields lists of stored payloads of the messages with sequence numbers from
+        first_seq up to end_seq. The payloads are memoryviews of the memory mapped
+        segments and are only valid until the next list is requested.
+
+        Parameters:
+        first_seq (int): Sequence number of the first message
+        end_seq (int): Sequence number following the last message
+        batch_size (int): Maximal number of payloads in one list
+        """
+        with self.lock:
+            self.log_file.flush()
+            segments = [(s, s.size) for s in self.segments
+                        if s.first_seq < end_seq and s.next_seq > first_seq]
+
+        for segment, size in segments:
+            if size == 0:
+                continue
+            with open(segment.path, "rb") as log_file:
+                mapped = mmap.mmap(log_file.fileno(), size, access=mmap.ACCESS_READ)
+            view = memoryview(mapped)
+            try:
+                batch = []
+                for seq, _, offset, length in iter_records(mapped, segment.offset_of_seq(first_seq), size):
+                    if seq < first_seq:
+                        continue
+                    if seq >= end_seq:
+                        break
+                    batch.append(view[offset:offset + length])
+                    if len(batch) == batch_size:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+            finally:
+                batch = None
+                view.release()
+                try:
+                    mapped.close()
+                except BufferError:
+                    # Payloads are still referenced by the caller, the mapping is
+                    # closed once they are garbage collected
+                    pass
+
+    def close(self):
+        """Syncs the log and closes its files"""
+        self.closed.set()
+        self.sync()
+        with self.lock:
+            self.log_file.close()
+            self.index_file.close()
@@ -0,0 +1,239 @@
+from const import *
+
+from bisect import bisect_left
+from time import monotonic
+import json
+import socket
+import threading
+
+# Upper bounds of the latency histogram buckets in seconds, 1 µs up to about 17 s
+LATENCY_BOUNDS = tuple(1e-6 * 2**i for i in range(25))
+
+class Histogram():
+    """
+    Counts values in buckets fixed on creation, so recording a value doesn't
+    allocate anything. Updates from several threads aren't locked, a lost
+    increment only makes the statistics slightly less precise.
+    """
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        """
+        Parameters:
+        bounds (tuple): Sorted upper bounds of the buckets, larger values are
+                        counted in an extra bucket
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """
+        Counts a value.
+
+        Parameters:
+        value (float): The value
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, point):
+        """
+        Returns the upper bound of the bucket holding the given percentile,
+        None if nothing was recorded.
+
+        Parameters:
+        point (float): Percentile between 0 and 100
+        """
+        if not self.count:
+            return None
+        wanted = point / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "buckets": [[bound, count] for bound, count
+                        in zip(self.bounds + (None,), self.counts) if count],
+        }
+
+
+class ServerMetrics():
+    """
+    Counters of one server that aren't tied to a single connection. Rates are
+    computed between two consecutive snapshots.
+    """
+    def __init__(self):
+        self.started = monotonic()
+        self.published = 0
+        # Connections closed for being idle
+        self.reaped = 0
+        # Times a client went over its flow limits
+        self.throttles = 0
+        # Messages sent to one user, they aren't counted as published
+        self.direct_messages = 0
+        # Time from publishing a message until the writer of a client sends it
+        self.fanout_latency = Histogram()
+        # Counters of the connections that were already closed
+        self.closed_totals = {}
+        self._last_time = self.started
+        self._last_totals = {}
+
+    def add_closed(self, totals):
+        """
+        Keeps the counters of a closed connection so that the totals don't drop.
+
+        Parameters:
+        totals (dict): Counter names mapped to the values of the connection
+        """
+        for name, value in totals.items():
+            self.closed_totals[name] = self.closed_totals.get(name, 0) + value
+
+    def rates(self, totals):
+        """
+        Returns the per second rates of the counters in totals since the last call.
+
+        Parameters:
+        totals (dict): Counter names mapped to their current values
+        """
+        now = monotonic()
+        elapsed = now - self._last_time
+        rates = {name: (value - self._last_totals.get(name, 0)) / elapsed if elapsed else 0.0
+                 for name, value in totals.items()}
+        self._last_time = now
+        self._last_totals = dict(totals)
+        return rates
+
+
+class StatsReporter(threading.Thread):
+    """
+    Makes the statistics of a server available outside of it: every connection
+    to the stats port receives one JSON snapshot, and with a path a snapshot is
+    appended to that file as a line of JSON every interval seconds.
+    """
+    def __init__(self, snapshot, port=STATS_PORT, path=STATS_FILE,
+                 interval=STATS_INTERVAL, host=STATS_HOST):
+        """
+        Parameters:
+        snapshot (callable): Returns the statistics as a dict
+        port (int): Port of the stats endpoint, None disables it
+        path (str): File the statistics are dumped to, None disables it
+        interval (float): Seconds between two dumps to the file
+        host (str): Interface of the stats endpoint
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.snapshot = snapshot
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.host = host
+        self.socket = None
+        self.stopped = threading.Event()
+
+    def bind(self):
+        """
+        Binds the stats endpoint. Returns False if the port can't be used.
+        """
+        if self.port is None:
+            return True
+        try:
+            self.socket = socket.socket()
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((self.host, self.port))
+            self.socket.listen()
+        except OSError as e:
+            print("Cannot open the stats port {}. Error: {}.".format(self.port, str(e)))
+            self.socket.close()
+            self.socket = None
+            return False
+        self.port = self.socket.getsockname()[1]
+        return True
+
+    def dump(self):
+        """Appends a snapshot to the stats file"""
+        with open(self.path, "a") as stats_file:
+            stats_file.write(json.dumps(self.snapshot()) + "\n")
+
+    def run(self):
+        """
+        Overwrites threading.Thread.run, answers the stats endpoint and dumps
+        the statistics until stopped.
+        """
+        next_dump = monotonic() + self.interval
+        while not self.stopped.is_set():
+            timeout = max(0, next_dump - monotonic()) if self.path else self.interval
+            if self.socket:
+                self.socket.settimeout(timeout)
+                try:
+                    connection, _ = self.socket.accept()
+                except socket.timeout:
+                    pass
+                except OSError:
+                    # The socket was closed by stop
+                    break
+                else:
+                    with connection:
+                        try:
+                            connection.sendall(bytes(json.dumps(self.snapshot()) + "\n",
+                                                     encoding="UTF-8"))
+                        except OSError:
+                            pass
+            else:
+                self.stopped.wait(timeout)
+            if self.path and monotonic() >= next_dump:
+                self.dump()
+                next_dump = monotonic() + self.interval
+
+    def stop(self):
+        """Stops the reporter, the statistics are dumped one last time"""
+        self.stopped.set()
+        if self.socket:
+            try:
+                # Wakes up socket.accept
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+        if self.is_alive():
+            self.join()
+        if self.path:
+            self.dump()
+
+def read_stats(host="localhost", port=STATS_PORT):
+    """
+    Returns the statistics served by the stats endpoint of a running server.
+
+    Parameters:
+    host (str): Address of the server
+    port (int): Stats port of the server
+    """
+    with socket.create_connection((host, port)) as connection:
+        data = b""
+        chunk = connection.recv(2**16)
+        while chunk:
+            data += chunk
+            chunk = connection.recv(2**16)
+    return json.loads(str(data, encoding="UTF-8"))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Prints the statistics of a running server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=STATS_PORT)
+    args = parser.parse_args()
+    print(json.dumps(read_stats(args.host, args.port), indent=2))
@@ -0,0 +1,185 @@
+from const import *
+from profiler import Profiler
+
+import collections
+import threading
+
+def username_of(usertag):
+    """
+    Returns the username part of a usertag. Usernames may contain "@", the
+    address follows the last one.
+
+    Parameters:
+    usertag (str): Username and address of a client
+    """
+    username, at, _ = usertag.rpartition("@")
+    return username if at else usertag
+
+
+class ClientRegistry():
+    """
+    Connected clients keyed by the Client object, with indexes from usertags and
+    usernames to their clients. Adding, removing and finding a client takes
+    constant time and the clients are iterated in the order they connected.
+
+    Isn't thread safe, the server guards it with its messages lock.
+    """
+    def __init__(self):
+        # Dict used as an ordered set
+        self.clients = {}
+        self.by_usertag = {}
+        self.by_username = {}
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(self.clients)
+
+    def __contains__(self, client):
+        return client in self.clients
+
+    def add(self, client):
+        """
+        Adds a client.
+
+        Parameters:
+        client (Client): The new client
+        """
+        self.clients[client] = None
+        self.by_usertag.setdefault(client.usertag, {})[client] = None
+        self.by_username.setdefault(username_of(client.usertag), {})[client] = None
+
+    def remove(self, client):
+        """
+        Removes a client.
+
+        Parameters:
+        client (Client): The client to remove
+        """
+        del self.clients[client]
+        for index, key in ((self.by_usertag, client.usertag),
+                           (self.by_username, username_of(client.usertag))):
+            sessions = index[key]
+            del sessions[client]
+            if not sessions:
+                del index[key]
+
+    def find(self, usertag):
+        """
+        Returns a list of the clients connected with the usertag.
+
+        Parameters:
+        usertag (str): Username and address of the client
+        """
+        return list(self.by_usertag.get(usertag, ()))
+
+    def find_username(self, username):
+        """
+        Returns a list of the clients of a user, from any address.
+
+        Parameters:
+        username (str): Name the clients connected with
+        """
+        return list(self.by_username.get(username, ()))
+
+    def find_target(self, target):
+        """
+        Returns a list of the clients a /msg target names: the clients of a
+        usertag if the target contains "@" and anybody connected with it,
+        otherwise the clients of the username, which may contain "@" too.
+
+        Parameters:
+        target (str): Usertag or username
+        """
+        if "@" in target:
+            clients = self.find(target)
+            if clients:
+                return clients
+        return self.find_username(target)
+
+    def usertags(self):
+        """Returns the usertags of all clients, one for every connection"""
+        return [client.usertag for client in self.clients]
+
+
+class PresenceNotifier():
+    """
+    Tells observers which users joined and left. Changes are collected for
+    PRESENCE_DELAY seconds and sent as one delta, a user joining and leaving
+    within the same window cancels out.
+
+    Observers with a notify_presence(joined, left) method receive the deltas,
+    observers with only a notify(clients) method receive the full list of
+    connected usertags.
+    """
+    def __init__(self, usertags, delay=PRESENCE_DELAY, profiler=None):
+        """
+        Parameters:
+        usertags (callable): Returns the usertags of all connected clients
+        delay (float): Seconds changes are collected before notifying
+        profiler (Profiler): Times the observers, None for no profiling
+        """
+        self.usertags = usertags
+        self.delay = delay
+        self.profiler = profiler or Profiler()
+        self.observers = []
+        self.lock = threading.Lock()
+        # Usertags mapped to the number of sessions that joined minus those that left
+        self.changes = collections.Counter()
+        self.timer = None
+
+    def add_observer(self, observer):
+        """
+        Adds an observer.
+
+        Parameters:
+        observer: An object with a 'notify_presence' or 'notify' method
+        """
+        self.observers.append(observer)
+
+    def changed(self, joined=(), left=()):
+        """
+        Records users that joined or left, observers are notified after the delay.
+
+        Parameters:
+        joined (iterable): Usertags of the new sessions
+        left (iterable): Usertags of the closed sessions
+        """
+        with self.lock:
+            for usertag in joined:
+                self.changes[usertag] += 1
+            for usertag in left:
+                self.changes[usertag] -= 1
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """Notifies the observers about the collected changes right away"""
+        with self.lock:
+            changes = self.changes
+            self.changes = collections.Counter()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        joined = [usertag for usertag, count in changes.items() for _ in range(count)]
+        left = [usertag for usertag, count in changes.items() for _ in range(-count)]
+        if not joined and not left:
+            return
+
+        usertags = None
+        for observer in self.observers:
+            try:
+                with self.profiler.span("observer.notify"):
+                    if hasattr(observer, "notify_presence"):
+                        observer.notify_presence(joined, left)
+                    else:
+                        if usertags is None:
+                            usertags = self.usertags()
+                        observer.notify(usertags)
+            except Exception:
+                pass
+                # If observer raises some kind of exception
+                # just ignore it
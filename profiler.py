@@ -0,0 +1,267 @@
+from const import *
+from metrics import Histogram
+
+from collections import Counter
+from datetime import datetime
+from time import monotonic, perf_counter, sleep
+import json
+import os
+import sys
+import threading
+import tracemalloc
+
+# Opt-in profiling of the server. Spans time named sections of the hot paths
+# into histograms, captures write stack samples of all the threads, tracemalloc
+# snapshots or the span histograms to files. A disabled profiler hands out one
+# shared span doing nothing and leaves the locks unwrapped, so the hot paths
+# only pay for a method call. Tracing allocations slows the server down many
+# times, unless PROFILE_TRACE_MEMORY is set it only runs during memory captures.
+
+class Span():
+    """Times a section of code into a histogram, used as a context manager"""
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.record(perf_counter() - self.start)
+
+
+class NoSpan():
+    """Span of a disabled profiler"""
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NO_SPAN = NoSpan()
+
+
+class TimedLock():
+    """
+    Wraps a lock and records how long acquiring it waited, to measure lock
+    contention. Supports the with statement only.
+    """
+    __slots__ = ("lock", "histogram")
+
+    def __init__(self, lock, histogram):
+        """
+        Parameters:
+        lock (threading.Lock): The wrapped lock
+        histogram (Histogram): Receives the waiting times
+        """
+        self.lock = lock
+        self.histogram = histogram
+
+    def __enter__(self):
+        start = perf_counter()
+        self.lock.acquire()
+        self.histogram.record(perf_counter() - start)
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class Profiler():
+    """
+    Collects the spans of a server and writes captures to a directory. Only
+    one capture runs at a time.
+    """
+    def __init__(self, directory=None, trace_memory=PROFILE_TRACE_MEMORY):
+        """
+        Parameters:
+        directory (str): Directory the captures are written to, None disables profiling
+        trace_memory (bool): Trace memory allocations from the start
+        """
+        self.directory = None
+        self.enabled = False
+        # Span names mapped to their histograms
+        self.spans = {}
+        self.capture_lock = threading.Lock()
+        if directory:
+            self.enable(directory, trace_memory)
+
+    def enable(self, directory, trace_memory=PROFILE_TRACE_MEMORY):
+        """
+        Turns profiling on. Has to be called before the server starts.
+
+        Parameters:
+        directory (str): Directory the captures are written to
+        trace_memory (bool): Trace memory allocations from now on, otherwise
+                             memory captures only see what was allocated
+                             while they ran
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.enabled = True
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+
+    def span(self, name):
+        """
+        Returns a context manager timing the code it wraps into the histogram
+        of the span name.
+
+        Parameters:
+        name (str): Name of the span, e.g. "fanout.deliver"
+        """
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self.histogram(name))
+
+    def histogram(self, name):
+        """
+        Returns the histogram of a span, creating it if needed.
+
+        Parameters:
+        name (str): Name of the span
+        """
+        histogram = self.spans.get(name)
+        if histogram is None:
+            histogram = self.spans.setdefault(name, Histogram())
+        return histogram
+
+    def timed_lock(self, lock, name):
+        """
+        Returns the lock wrapped to record its waiting times as a span, or the
+        lock itself if profiling is disabled.
+
+        Parameters:
+        lock (threading.Lock): The lock
+        name (str): Name of the span
+        """
+        if not self.enabled:
+            return lock
+        return TimedLock(lock, self.histogram(name))
+
+    def as_dict(self):
+        return {name: histogram.as_dict() for name, histogram in sorted(self.spans.items())}
+
+    def capture(self, kind, seconds=PROFILE_SAMPLE_SECONDS, extra=None):
+        """
+        Writes a capture to a new file of the profiling directory and returns
+        its path. Returns None if profiling is disabled or another capture is
+        running. Blocks for the given seconds while sampling or tracing.
+
+        Parameters:
+        kind (str): "cpu" samples the stacks of all threads, "memory" takes a
+                    tracemalloc snapshot, "spans" writes the span histograms
+        seconds (float): Duration of the cpu sampling, and of the memory
+                         tracing if it didn't run already
+        extra (dict): Sizes known to the server, added to memory captures
+        """
+        if kind not in ("cpu", "memory", "spans"):
+            raise ValueError("Unknown capture {}".format(kind))
+        if not self.enabled or not self.capture_lock.acquire(blocking=False):
+            return None
+        try:
+            path = os.path.join(self.directory, "{}-{}-{}".format(
+                kind, os.getpid(), datetime.now().strftime("%Y%m%d-%H%M%S-%f")))
+            if kind == "cpu":
+                path += ".folded"
+                write_samples(path, sample_stacks(seconds))
+            elif kind == "memory":
+                path += ".txt"
+                write_memory(path, snapshot_memory(seconds), extra or {})
+            else:
+                path += ".json"
+                with open(path, "w") as spans_file:
+                    json.dump(self.as_dict(), spans_file, indent=2)
+            return path
+        finally:
+            self.capture_lock.release()
+
+def sample_stacks(seconds, interval=PROFILE_SAMPLE_INTERVAL):
+    """
+    Samples the stacks of all the other threads every interval seconds and
+    returns a Counter of the stacks, outermost frame first. Threads blocked
+    in a system call are sampled too, so this shows wall clock time.
+
+    Parameters:
+    seconds (float): Duration of the sampling
+    interval (float): Seconds between two samples
+    """
+    own = threading.get_ident()
+    labels = {}
+    stacks = Counter()
+    deadline = monotonic() + seconds
+    while monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = "{}:{}".format(
+                        os.path.basename(code.co_filename), code.co_name)
+                stack.append(label)
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread"))
+            stacks[tuple(reversed(stack))] += 1
+        sleep(interval)
+    return stacks
+
+def snapshot_memory(seconds):
+    """
+    Returns a tracemalloc snapshot. If allocations aren't traced yet, they
+    are traced for the given seconds only, so the snapshot shows the memory
+    allocated in that time and still in use.
+
+    Parameters:
+    seconds (float): Duration of the tracing
+    """
+    if tracemalloc.is_tracing():
+        return tracemalloc.take_snapshot()
+    tracemalloc.start(PROFILE_TRACE_FRAMES)
+    try:
+        sleep(seconds)
+        return tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+def write_samples(path, stacks):
+    """
+    Writes sampled stacks in the folded format read by flame graph tools,
+    one "frame;frame;frame count" line per stack.
+
+    Parameters:
+    path (str): Path of the file
+    stacks (Counter): Stacks mapped to their number of samples
+    """
+    with open(path, "w") as samples_file:
+        for stack, count in stacks.most_common():
+            samples_file.write("{} {}\n".format(";".join(stack), count))
+
+def write_memory(path, snapshot, extra):
+    """
+    Writes the lines allocating the most memory and the sizes known to the
+    server. The full snapshot is dumped next to it for tracemalloc tools.
+
+    Parameters:
+    path (str): Path of the report
+    snapshot (tracemalloc.Snapshot): The snapshot
+    extra (dict): Names mapped to sizes in bytes
+    """
+    snapshot.dump(os.path.splitext(path)[0] + ".tracemalloc")
+    statistics = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    )).statistics("lineno")
+    with open(path, "w") as report:
+        for name, size in extra.items():
+            report.write("{}: {} bytes\n".format(name, size))
+        report.write("traced: {} bytes\n\n".format(sum(stat.size for stat in statistics)))
+        for stat in statistics[:PROFILE_TOP_LINES]:
+            frame = stat.traceback[0]
+            report.write("{}:{}: {} bytes in {} blocks\n".format(
+                frame.filename, frame.lineno, stat.size, stat.count))
@@ -1,44 +1,775 @@
+import collections
+import os
 import socket
+import struct
+import time
+import zlib
 
-class ConnectionBroken(RuntimeError):    
+class ConnectionBroken(RuntimeError):
     pass
 
-class MessageProtocol():
-    """ Wraps the socket protocol to communicate in messages varying in length"""
-    def __init__(self, socket, buffer_size=2**11,
-                 delimiter="<<END>>", ping_tag="<<PING>>", encoding="UTF-8"):
+# Framing modes. Delimited framing ends every message with a delimiter tag,
+# length framing prefixes every message with a fixed size header.
+FRAMING_DELIMITED = "delimited"
+FRAMING_LENGTH = "length"
+
+# Frame types
+FRAME_DATA = 0
+FRAME_PING = 1
+# zlib compressed frames, the decompressed payload holds one or more length prefixed frames
+FRAME_COMPRESSED = 2
+# Parts of a streamed message, the payload starts with the id of the stream
+FRAME_CHUNK = 3
+FRAME_CHUNK_END = 4
+# Session bookkeeping that isn't shown to the user, the payload is a Control
+FRAME_CONTROL = 5
+
+# Header of a length prefixed frame: frame type (1 byte), payload length (4 bytes)
+FRAME_HEADER = struct.Struct("!BI")
+MAX_FRAME_SIZE = 2**28
+# Received frames an asyncio connection buffers before it stops reading from the socket
+MAX_RECEIVED_FRAMES = 1024
+# Start of the payload of a chunk frame: stream id (4 bytes)
+CHUNK_HEADER = struct.Struct("!I")
+# Largest part of a streamed message sent in one frame
+STREAM_CHUNK_SIZE = 2**16
+# Bytes of other frames iter_stream keeps while reading a stream
+STREAM_SKIP_BYTES = 4 * 2**20
+
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+try:
+    IOV_MAX = min(os.sysconf("SC_IOV_MAX"), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# First message of a connection can be a hello listing the capabilities of the client,
+# the server answers with a hello containing the ones it agreed to use.
+HELLO_TAG = "<<HELLO>>"
+# Capabilities this side of the connection understands, most preferred value first
+SUPPORTED_CAPABILITIES = {"framing": (FRAMING_LENGTH, FRAMING_DELIMITED),
+                          "compression": ("zlib",),
+                          "streaming": ("chunks",),
+                          "resume": ("seq",)}
+
+# Flushes smaller than this are sent uncompressed even if compression was agreed
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 6
+
+def format_hello(capabilities):
+    """
+    Formats a hello message, e.g. "<<HELLO>>framing=length,delimited".
+
+    Parameters:
+    capabilities (dict): Capability names mapped to a value or a sequence of values
+    """
+    fields = []
+    for name, values in capabilities.items():
+        if isinstance(values, str):
+            values = (values,)
+        fields.append("{}={}".format(name, ",".join(values)))
+    return HELLO_TAG + ";".join(fields)
+
+def parse_hello(message):
+    """
+    Parses a hello message. Returns a dict mapping capability names to lists
+    of values or None if the message isn't a hello.
+
+    Parameters:
+    message (str): A received message
+    """
+    if message is None or not message.startswith(HELLO_TAG):
+        return None
+    capabilities = {}
+    for field in message[len(HELLO_TAG):].split(";"):
+        name, _, values = field.partition("=")
+        if name:
+            capabilities[name] = values.split(",")
+    return capabilities
+
+def choose_capabilities(offered, supported=SUPPORTED_CAPABILITIES):
+    """
+    Picks one value for every capability both sides understand. Returns a dict
+    mapping capability names to the chosen value.
+
+    Parameters:
+    offered (dict): Parsed hello of the other side
+    supported (dict): Capabilities understood by this side
+    """
+    chosen = {}
+    for name, values in offered.items():
+        for value in values:
+            if value in supported.get(name, ()):
+                chosen[name] = value
+                break
+    if chosen.get("framing") != FRAMING_LENGTH:
+        # Compressed data and chunks could contain the delimiter, control
+        # frames would look like messages
+        chosen.pop("compression", None)
+        chosen.pop("streaming", None)
+        chosen.pop("resume", None)
+    return chosen
+
+
+class StreamChunk():
+    """ A part of a streamed message, see BaseMessageProtocol.queue_chunk"""
+    __slots__ = ("stream_id", "data", "last")
+
+    def __init__(self, stream_id, data, last=False):
+        """
+        Parameters:
+        stream_id (int): Id of the stream, unique among the open streams of a connection
+        data (bytes): The part of the message, possibly empty
+        last (bool): True for the final part
+        """
+        self.stream_id = stream_id
+        self.data = data
+        self.last = last
+
+
+class Control():
+    """
+    Control message of a resumable session, e.g. Control("cursor", ["general", "42"]),
+    or an error reported by the server, e.g. Control("error", ["no_such_user", "bob"]).
+    Sent as FRAME_CONTROL frames, so it requires the resume capability.
+    """
+    __slots__ = ("command", "arguments")
+
+    def __init__(self, command, arguments=()):
+        """
+        Parameters:
+        command (str): Name of the control message
+        arguments (list): Its arguments, converted to str and without spaces
+        """
+        self.command = command
+        self.arguments = [str(argument) for argument in arguments]
+
+    def __str__(self):
+        return " ".join([self.command] + self.arguments)
+
+
+class FrameBuffer():
+    """
+    Receive buffer splitting a byte stream into frames. It does no I/O itself,
+    the free space returned by get_buffer is filled by the caller
+    (e.g. socket.recv_into) and acknowledged with buffer_updated. Bytes received
+    past the end of a frame are kept for the next one. The buffer grows with the
+    data actually received, not with the length a header announces, and goes
+    back to buffer_size once it is drained.
+    """
+    def __init__(self, buffer_size=2**11, delimiter=b"<<END>>", ping_tag=b"<<PING>>",
+                 framing=FRAMING_DELIMITED, max_frame_size=MAX_FRAME_SIZE):
+        """
+        Parameters:
+        buffer_size (int): Initial size of the buffer and the minimal free space per read.
+        delimiter (bytes): Tag ending a frame in the delimited framing.
+        ping_tag (bytes): Payload of a ping frame in the delimited framing.
+        framing (str): FRAMING_DELIMITED or FRAMING_LENGTH.
+        max_frame_size (int): Largest accepted payload in the length framing.
+        """
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.delimiter = delimiter
+        self.ping_tag = ping_tag
+        self.framing = framing
+        self.max_frame_size = max_frame_size
+        # Received data waiting to be parsed is stored in buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # Position up to which the delimited framing already searched for a delimiter
+        self.scanned = 0
+
+    def pending(self):
+        """Returns the number of received bytes that weren't returned as frames yet"""
+        return self.end - self.start
+
+    def get_buffer(self):
+        """Returns a memoryview of the free space at the end of the buffer"""
+        wanted = self.buffer_size
+        if self.framing == FRAMING_LENGTH and self.pending() >= FRAME_HEADER.size:
+            # Make room for more of the frame, at most doubling the received part,
+            # so a header alone can't make the buffer as large as it announces
+            _, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            length = min(length, self.max_frame_size)
+            remaining = FRAME_HEADER.size + length - self.pending()
+            wanted = max(wanted, min(remaining, self.pending()))
+
+        if len(self.buffer) - self.end < wanted:
+            pending = self.pending()
+            if len(self.buffer) >= pending + wanted:
+                # Move the unread data to the front
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+            else:
+                # A new buffer is allocated instead of resizing so that memoryviews
+                # still held by the caller don't prevent it
+                buffer = bytearray(max(pending + wanted, 2 * len(self.buffer)))
+                buffer[:pending] = self.buffer[self.start:self.end]
+                self.buffer = buffer
+            self.scanned -= self.start
+            self.start = 0
+            self.end = pending
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """
+        Marks bytes written to the memoryview from get_buffer as received.
+
+        Parameters:
+        nbytes (int): Number of bytes written
+        """
+        self.end += nbytes
+
+    def next_frame(self):
+        """
+        Returns the next complete frame as a (frame type, payload bytes) tuple,
+        or None if more data has to be received first.
+        """
+        if self.framing == FRAMING_LENGTH:
+            frame = self._next_length_frame()
+        else:
+            frame = self._next_delimited_frame()
+        if frame is not None and self.start == self.end:
+            self.start = self.end = self.scanned = 0
+            if len(self.buffer) > self.buffer_size:
+                # Large frames don't keep their buffer for the rest of the connection
+                self.buffer = bytearray(self.buffer_size)
+        return frame
+
+    def _next_length_frame(self):
+        if self.pending() < FRAME_HEADER.size:
+            return None
+        frame_type, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        if length > self.max_frame_size:
+            raise ConnectionBroken("Frame of {} bytes exceeds the limit".format(length))
+        payload_start = self.start + FRAME_HEADER.size
+        payload_end = payload_start + length
+        if payload_end > self.end:
+            return None
+        with memoryview(self.buffer) as view:
+            payload = bytes(view[payload_start:payload_end])
+        self.start = payload_end
+        return frame_type, payload
+
+    def _next_delimited_frame(self):
+        search_from = max(self.start, self.scanned - len(self.delimiter) + 1)
+        position = self.buffer.find(self.delimiter, search_from, self.end)
+        if position < 0:
+            self.scanned = self.end
+            return None
+        with memoryview(self.buffer) as view:
+            payload = bytes(view[self.start:position])
+        self.start = self.scanned = position + len(self.delimiter)
+        if payload == self.ping_tag:
+            return FRAME_PING, b""
+        return FRAME_DATA, payload
+
+    def pack_buffers(self, frame_type, payload):
+        """
+        Returns the frame in the current framing as a tuple of buffers, the payload
+        is included as it is without copying.
+
+        Parameters:
+        frame_type (int): FRAME_DATA or FRAME_PING
+        payload (bytes): Contents of the frame
+        """
+        if self.framing == FRAMING_LENGTH:
+            return FRAME_HEADER.pack(frame_type, len(payload)), payload
+        if frame_type == FRAME_PING:
+            payload = self.ping_tag
+        return payload, self.delimiter
+
+    def pack(self, frame_type, payload):
+        """
+        Returns the bytes of a frame in the current framing.
+
+        Parameters:
+        frame_type (int): FRAME_DATA or FRAME_PING
+        payload (bytes): Contents of the frame
+        """
+        return b"".join(self.pack_buffers(frame_type, payload))
+
+
+def send_buffers(sock, buffers):
+    """
+    Sends a list of buffers with as few system calls as possible. Uses scatter/gather
+    sendmsg where available so the buffers aren't joined into one bytes object.
+
+    Parameters:
+    sock (socket.socket): Connected socket
+    buffers (list): bytes-like objects to send in order
+    """
+    if not HAS_SENDMSG:
+        sock.sendall(b"".join(buffers))
+        return
+    buffers = [memoryview(b).cast("B") for b in buffers if len(b)]
+    index = 0
+    while index < len(buffers):
+        sent = sock.sendmsg(buffers[index:index + IOV_MAX])
+        # Skip the buffers that were sent completely, trim the one sent partially
+        while sent:
+            size = len(buffers[index])
+            if sent >= size:
+                sent -= size
+                index += 1
+            else:
+                buffers[index] = buffers[index][sent:]
+                sent = 0
+
+
+class WriteStats():
+    """ Counts the flushes of queued frames on one connection"""
+    __slots__ = ("flushes", "frames", "bytes", "largest_flush", "pings")
+
+    def __init__(self):
+        self.flushes = 0
+        self.frames = 0
+        self.bytes = 0
+        self.largest_flush = 0
+        self.pings = 0
+
+    def add(self, frames, nbytes):
+        """
+        Records one flush.
+
+        Parameters:
+        frames (int): Number of frames sent together
+        nbytes (int): Number of bytes sent together
+        """
+        self.flushes += 1
+        self.frames += frames
+        self.bytes += nbytes
+        self.largest_flush = max(self.largest_flush, nbytes)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ReadStats():
+    """ Counts the reads and received frames on one connection"""
+    __slots__ = ("reads", "bytes", "frames", "pings")
+
+    def __init__(self):
+        self.reads = 0
+        self.bytes = 0
+        self.frames = 0
+        self.pings = 0
+
+    def add_frame(self, frame):
+        """
+        Records a received frame.
+
+        Parameters:
+        frame (tuple): (frame type, payload bytes) tuple
+        """
+        self.frames += 1
+        if frame[0] == FRAME_PING:
+            self.pings += 1
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class CompressionStats():
+    """ Counts the compressed traffic of one connection and the time spent on it"""
+    __slots__ = ("frames_out", "raw_bytes_out", "bytes_out",
+                 "frames_in", "raw_bytes_in", "bytes_in", "cpu_time")
+
+    def __init__(self):
+        self.frames_out = 0
+        self.raw_bytes_out = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.raw_bytes_in = 0
+        self.bytes_in = 0
+        # Thread CPU seconds spent compressing and decompressing
+        self.cpu_time = 0.0
+
+    def as_dict(self):
+        stats = {name: getattr(self, name) for name in self.__slots__}
+        raw = self.raw_bytes_out + self.raw_bytes_in
+        stats["ratio"] = (self.bytes_out + self.bytes_in) / raw if raw else None
+        return stats
+
+
+def split_frames(data):
+    """
+    Returns the length prefixed frames packed in data as a list of
+    (frame type, payload bytes) tuples.
+
+    Parameters:
+    data (bytes): Complete frames
+    """
+    frames = []
+    offset = 0
+    with memoryview(data) as view:
+        while offset < len(data):
+            if offset + FRAME_HEADER.size > len(data):
+                raise ConnectionBroken("Truncated compressed frame")
+            frame_type, length = FRAME_HEADER.unpack_from(data, offset)
+            offset += FRAME_HEADER.size
+            if offset + length > len(data) or frame_type == FRAME_COMPRESSED:
+                raise ConnectionBroken("Invalid compressed frame")
+            frames.append((frame_type, bytes(view[offset:offset + length])))
+            offset += length
+    return frames
+
+
+class BaseMessageProtocol():
+    """ Message encoding and capability handling shared by the blocking and asyncio protocols"""
+    def __init__(self, buffer_size=2**11, delimiter="<<END>>", ping_tag="<<PING>>",
+                 encoding="UTF-8", framing=FRAMING_DELIMITED):
         """
         Parameters:
-        socket (socket.socket): connected socket.
         buffer_size (int): Should be a power of 2. Socket buffer size.
         delimiter (str): A tag placed at the end of messages when sending.
         ping_tag (str): A tag signifying that this side of the connection is still respoding.
         encoding (str): Message encoding.
+        framing (str): FRAMING_DELIMITED or FRAMING_LENGTH. Can be changed by negotiation.
         """
-        self.socket = socket
         self.buffer_size = buffer_size
         self.delimiter = delimiter
         self.ping_tag = ping_tag
         self.encoding = encoding
+        self.frames = FrameBuffer(buffer_size, bytes(delimiter, encoding=encoding),
+                                  bytes(ping_tag, encoding=encoding), framing)
+        self.capabilities = {}
+        # Frames queued to be sent with a single write
+        self.pending_buffers = []
+        self.pending_frames = 0
+        self.pending_bytes = 0
+        self.write_stats = WriteStats()
+        self.read_stats = ReadStats()
+        # time.monotonic of the last data received from the other side
+        self.last_read = time.monotonic()
+        # Id of the next stream sent through this connection
+        self.next_stream_id = 0
+        # Payload size in bytes of the last decoded frame
+        self.last_frame_size = 0
+        # Agreed compression, its streaming zlib contexts are created on first use
+        # since they take a few hundred kilobytes per connection
+        self.compression = None
+        self.compressor = None
+        self.decompressor = None
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.compression_stats = CompressionStats()
 
-    def get_message(self):
-        """Reads a message through the socket"""
+    @property
+    def framing(self):
+        return self.frames.framing
+
+    def queue_frame(self, frame_type, payload):
+        """
+        Queues a frame to be sent with the next flush.
+
+        Parameters:
+        frame_type (int): FRAME_DATA or FRAME_PING
+        payload (bytes): Contents of the frame
+        """
+        buffers = self.frames.pack_buffers(frame_type, payload)
+        self.pending_buffers.extend(buffers)
+        self.pending_frames += 1
+        self.pending_bytes += len(buffers[0]) + len(buffers[1])
+
+    def queue_message(self, message):
+        """
+        Queues a message to be sent with the next flush.
+
+        Parameters:
+        message (str): The message to send
+        """
+        self.queue_frame(FRAME_DATA, self.encode_message(message))
+
+    def queue_encoded(self, payloads):
+        """
+        Queues messages already encoded with encode_message. The payloads are
+        sent as they are, so the same bytes can be shared by many connections.
+
+        Parameters:
+        payloads (list): Encoded messages, one frame each
+        """
+        for payload in payloads:
+            if isinstance(payload, StreamChunk):
+                self.queue_chunk(payload)
+            elif isinstance(payload, Control):
+                self.queue_control(payload)
+            else:
+                self.queue_frame(FRAME_DATA, payload)
+
+    def queue_control(self, control):
+        """
+        Queues a control message. Requires the resume capability.
+
+        Parameters:
+        control (Control): The control message
+        """
+        self.queue_frame(FRAME_CONTROL, bytes(str(control), encoding=self.encoding))
+
+    def queue_chunk(self, chunk):
+        """
+        Queues a part of a streamed message. Requires the streaming capability,
+        the data is sent without copying it.
+
+        Parameters:
+        chunk (StreamChunk): The part to send
+        """
+        header = CHUNK_HEADER.pack(chunk.stream_id)
+        frame_header = FRAME_HEADER.pack(FRAME_CHUNK_END if chunk.last else FRAME_CHUNK,
+                                         len(header) + len(chunk.data))
+        self.pending_buffers.extend((frame_header, header, chunk.data))
+        self.pending_frames += 1
+        self.pending_bytes += len(frame_header) + len(header) + len(chunk.data)
+
+    def stream_chunks(self, parts):
+        """
+        Yields the StreamChunks of a new stream sending the given parts, split
+        into pieces of at most STREAM_CHUNK_SIZE bytes. Only one piece is held
+        in memory at a time if parts is a generator.
+
+        Parameters:
+        parts (iterable): str or bytes-like parts of the message
+        """
+        stream_id = self.next_stream_id
+        self.next_stream_id = (self.next_stream_id + 1) % 2**32
+        for part in parts:
+            if isinstance(part, str):
+                # Encode piece by piece so the whole text is never copied at once,
+                # a character takes at most 4 bytes
+                for start in range(0, len(part), STREAM_CHUNK_SIZE // 4):
+                    yield StreamChunk(stream_id, bytes(
+                        part[start:start + STREAM_CHUNK_SIZE // 4], encoding=self.encoding))
+            else:
+                with memoryview(part) as view:
+                    for start in range(0, len(view), STREAM_CHUNK_SIZE):
+                        yield StreamChunk(stream_id, bytes(view[start:start + STREAM_CHUNK_SIZE]))
+        yield StreamChunk(stream_id, b"", last=True)
+
+    def take_pending(self):
+        """
+        Returns the queued buffers and records the flush in write_stats. If
+        compression was agreed and enough data is queued, the frames are
+        returned compressed into a single frame.
+        """
+        buffers = self.pending_buffers
+        if self.pending_frames:
+            self.write_stats.add(self.pending_frames, self.pending_bytes)
+            if self.compression and self.pending_bytes >= self.compression_threshold:
+                buffers = self._compress(buffers)
+        self.pending_buffers = []
+        self.pending_frames = 0
+        self.pending_bytes = 0
+        return buffers
+
+    def _compress(self, buffers):
+        started = time.thread_time()
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        parts = [self.compressor.compress(buffer) for buffer in buffers]
+        # Sync flush keeps the context for the next frames but lets the other
+        # side decompress everything sent so far
+        parts.append(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        compressed = b"".join(parts)
+        stats = self.compression_stats
+        stats.cpu_time += time.thread_time() - started
+        stats.frames_out += 1
+        stats.raw_bytes_out += self.pending_bytes
+        stats.bytes_out += len(compressed)
+        return [FRAME_HEADER.pack(FRAME_COMPRESSED, len(compressed)), compressed]
+
+    def expand_frame(self, frame):
+        """
+        Returns the list of frames carried by a received frame, a compressed
+        frame is decompressed into the frames it holds.
+
+        Parameters:
+        frame (tuple): (frame type, payload bytes) tuple
+        """
+        if frame[0] != FRAME_COMPRESSED:
+            return [frame]
+        if self.compression is None:
+            raise ConnectionBroken("Compressed frame without agreed compression")
+        started = time.thread_time()
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
         try:
-            message = ""
-            while not message.endswith(self.delimiter):
-                partial = self.socket.recv(self.buffer_size)
-                if len(partial) == 0:                
-                    raise ConnectionBroken("Connection Stopped")
-                message += partial.decode(self.encoding)
-
-            message = message[:-len(self.delimiter)]
-            if message == self.ping_tag:
-                return None
-            return message
+            data = self.decompressor.decompress(frame[1], self.frames.max_frame_size)
+        except zlib.error as e:
+            raise ConnectionBroken(e)
+        if self.decompressor.unconsumed_tail:
+            raise ConnectionBroken("Compressed frame exceeds the limit")
+        stats = self.compression_stats
+        stats.cpu_time += time.thread_time() - started
+        stats.frames_in += 1
+        stats.bytes_in += len(frame[1])
+        stats.raw_bytes_in += len(data)
+        return split_frames(data)
+
+    def encode_message(self, message):
+        """
+        Returns the payload of a data frame carrying the message
+
+        Parameters:
+        message (str): The message to encode
+        """
+        if self.framing == FRAMING_DELIMITED:
+            # Remove the special tags if they are supplied directly
+            message = message.replace(self.ping_tag, "")
+            message = message.replace(self.delimiter, "")
+        return bytes(message, encoding=self.encoding)
+
+    def decode_frame(self, frame):
+        """
+        Returns the message carried by a frame or None for pings. Raises
+        ConnectionBroken if the payload isn't valid text, the peer is then
+        disconnected like for any other protocol violation.
+
+        Parameters:
+        frame (tuple): (frame type, payload bytes) tuple
+        """
+        self.last_frame_size = len(frame[1])
+        try:
+            return self._decode_frame(frame)
+        except UnicodeDecodeError as e:
+            raise ConnectionBroken("Invalid message: {}".format(str(e)))
+
+    def _decode_frame(self, frame):
+        frame_type, payload = frame
+        if frame_type == FRAME_PING:
+            return None
+        if frame_type == FRAME_CONTROL:
+            command, *arguments = str(payload, encoding=self.encoding).split(" ")
+            return Control(command, arguments)
+        if frame_type == FRAME_CHUNK or frame_type == FRAME_CHUNK_END:
+            if len(payload) < CHUNK_HEADER.size:
+                raise ConnectionBroken("Invalid chunk frame")
+            stream_id, = CHUNK_HEADER.unpack_from(payload)
+            return StreamChunk(stream_id, payload[CHUNK_HEADER.size:],
+                               frame_type == FRAME_CHUNK_END)
+        return str(payload, encoding=self.encoding)
+
+    def answer_hello(self, message, supported=SUPPORTED_CAPABILITIES):
+        """
+        Returns the hello answering the message and the chosen capabilities,
+        or (None, None) if the message isn't a hello.
+
+        Parameters:
+        message (str): First message received on the connection
+        supported (dict): Capabilities understood by this side
+        """
+        offered = parse_hello(message)
+        if offered is None:
+            return None, None
+        chosen = choose_capabilities(offered, supported)
+        return format_hello(chosen), chosen
+
+    def apply_capabilities(self, capabilities):
+        """
+        Switches the connection to agreed capabilities.
+
+        Parameters:
+        capabilities (dict): Capability names mapped to the agreed value
+        """
+        self.capabilities = dict(capabilities)
+        if "framing" in capabilities:
+            self.frames.framing = capabilities["framing"]
+        if capabilities.get("compression") == "zlib":
+            self.compression = "zlib"
+
+
+class MessageProtocol(BaseMessageProtocol):
+    """ Wraps the socket protocol to communicate in messages varying in length"""
+    def __init__(self, socket, buffer_size=2**11,
+                 delimiter="<<END>>", ping_tag="<<PING>>", encoding="UTF-8",
+                 framing=FRAMING_DELIMITED):
+        """
+        Parameters:
+        socket (socket.socket): connected socket.
+        buffer_size (int): Should be a power of 2. Socket buffer size.
+        delimiter (str): A tag placed at the end of messages when sending.
+        ping_tag (str): A tag signifying that this side of the connection is still respoding.
+        encoding (str): Message encoding.
+        framing (str): FRAMING_DELIMITED or FRAMING_LENGTH. Can be changed by negotiation.
+        """
+        super().__init__(buffer_size, delimiter, ping_tag, encoding, framing)
+        self.socket = socket
+        # Frames unpacked from a compressed frame or skipped by iter_stream
+        # that weren't returned yet
+        self.expanded = collections.deque()
+
+    def get_frame(self):
+        """Reads a frame through the socket, returns a (frame type, payload bytes) tuple"""
+        try:
+            while not self.expanded:
+                frame = self.frames.next_frame()
+                while frame is None:
+                    with self.frames.get_buffer() as buffer:
+                        received = self.socket.recv_into(buffer)
+                    if received == 0:
+                        raise ConnectionBroken("Connection Stopped")
+                    self.read_stats.reads += 1
+                    self.read_stats.bytes += received
+                    self.last_read = time.monotonic()
+                    self.frames.buffer_updated(received)
+                    frame = self.frames.next_frame()
+                self.expanded.extend(self.expand_frame(frame))
+            frame = self.expanded.popleft()
+            self.read_stats.add_frame(frame)
+            return frame
 
         except OSError as e:
             raise ConnectionBroken(e)
 
+    def get_message(self):
+        """
+        Reads a message through the socket. Returns a str, None for pings,
+        a StreamChunk for parts of streamed messages or a Control.
+        """
+        return self.decode_frame(self.get_frame())
+
+    def iter_stream(self, chunk):
+        """
+        Yields the data of a streamed message as it arrives, starting with its
+        first chunk returned by get_message. Other messages received in the
+        meantime are returned by the following get_message calls. They are
+        kept in memory until then, so a peer interleaving more than
+        STREAM_SKIP_BYTES bytes of them, e.g. a second concurrent stream,
+        breaks the connection.
+
+        Parameters:
+        chunk (StreamChunk): First received chunk of the stream
+        """
+        skipped = []
+        skipped_bytes = 0
+        try:
+            while True:
+                yield chunk.data
+                if chunk.last:
+                    return
+                frame = self.get_frame()
+                decoded = self.decode_frame(frame)
+                while not (isinstance(decoded, StreamChunk)
+                           and decoded.stream_id == chunk.stream_id):
+                    skipped.append(frame)
+                    skipped_bytes += len(frame[1])
+                    if skipped_bytes > STREAM_SKIP_BYTES:
+                        raise ConnectionBroken("Too much data interleaved with stream {}".format(
+                            chunk.stream_id))
+                    frame = self.get_frame()
+                    decoded = self.decode_frame(frame)
+                chunk = decoded
+        finally:
+            self.expanded.extendleft(reversed(skipped))
+
+    def send_stream(self, parts):
+        """
+        Sends a message as a stream of chunks, requires the streaming capability.
+
+        Parameters:
+        parts (iterable): str or bytes-like parts of the message
+        """
+        for chunk in self.stream_chunks(parts):
+            self.queue_chunk(chunk)
+            if self.pending_bytes >= STREAM_CHUNK_SIZE or chunk.last:
+                self.flush()
+
     def send_message(self, message):
         """
         Sends a message through the socket
@@ -46,23 +777,67 @@ class MessageProtocol():
         Parameters:
         message (str): The message to send
         """
-        # Remove the special tags if they are supplied directly
-        message = message.replace(self.ping_tag, "")
-        message = message.replace(self.delimiter, "")
-        try:
-            self.socket.sendall(bytes(message + self.delimiter, encoding=self.encoding))
-        except OSError as e:
-            raise ConnectionBroken(e)
+        self.queue_message(message)
+        self.flush()
+
+    def send_encoded(self, payloads):
+        """
+        Sends messages already encoded with encode_message, see queue_encoded.
+
+        Parameters:
+        payloads (list): Encoded messages, one frame each
+        """
+        self.queue_encoded(payloads)
+        self.flush()
 
     def ping(self):
         """
         Sends a ping message to inform the other side that the connection is alive.
         """
+        self.queue_frame(FRAME_PING, b"")
+        self.write_stats.pings += 1
+        self.flush()
+
+    def flush(self):
+        """Sends all queued frames with as few system calls as possible"""
+        buffers = self.take_pending()
+        if not buffers:
+            return
         try:
-            self.socket.sendall(bytes(self.ping_tag + self.delimiter, encoding=self.encoding))
+            send_buffers(self.socket, buffers)
         except OSError as e:
             raise ConnectionBroken(e)
 
+    def negotiate(self, capabilities=SUPPORTED_CAPABILITIES):
+        """
+        Client side of the handshake. Offers capabilities to the server and
+        switches to the ones it agreed to. Returns a dict of the agreed capabilities.
+
+        Parameters:
+        capabilities (dict): Capability names mapped to values in order of preference
+        """
+        self.send_message(format_hello(capabilities))
+        answer = parse_hello(self.get_message()) or {}
+        self.apply_capabilities({name: values[0] for name, values in answer.items() if values})
+        return self.capabilities
+
+    def accept_negotiation(self, supported=SUPPORTED_CAPABILITIES):
+        """
+        Server side of the handshake. Reads the first message of the connection,
+        if it's a hello answers it with the chosen capabilities and reads the next
+        one. Returns the first message that isn't a hello.
+
+        Parameters:
+        supported (dict): Capabilities understood by the server
+        """
+        message = self.get_message()
+        answer, chosen = self.answer_hello(message, supported)
+        if answer is None:
+            return message
+        self.send_message(answer)
+        self.apply_capabilities(chosen)
+        return self.get_message()
+
     def terminate(self):
         """ Terminates the connection. """
         try:
@@ -70,4 +845,13 @@ class MessageProtocol():
         except OSError:
             # If its already closed ignore it
             pass
-        self.socket.close()
\ No newline at end of file
+        self.socket.close()
+
+
+def __getattr__(name):
+    # The asyncio protocol lives in its own module so that the blocking
+    # protocol can be used without importing asyncio, which is slow to import
+    if name == "AsyncMessageProtocol":
+        from asyncProtocol import AsyncMessageProtocol
+        return AsyncMessageProtocol
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
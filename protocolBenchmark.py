@@ -0,0 +1,333 @@
+from const import *
+from protocol import MessageProtocol, ConnectionBroken, FRAMING_DELIMITED, FRAMING_LENGTH
+from benchmark import percentiles
+
+from time import perf_counter
+import argparse
+import json
+import platform
+import socket
+import sys
+import threading
+import time
+
+# Micro-benchmarks of MessageProtocol over socket.socketpair, without a server.
+# Every case is run a few times and the best run is kept. Reports are JSON, a
+# report given as baseline is compared case by case so protocol changes come
+# with before and after numbers:
+#   python protocolBenchmark.py --output before.json
+#   python protocolBenchmark.py --baseline before.json
+
+FRAMINGS = (FRAMING_DELIMITED, FRAMING_LENGTH)
+# Message sizes in bytes, from tiny chat lines to 64 MiB
+SIZES = (16, 2**10, 2**16, 2**20, 64 * 2**20)
+QUICK_SIZES = (16, 2**10, 2**16)
+BUFFER_SIZES = (2**11, 2**14, 2**17)
+# Bytes sent by one throughput run, at least one message
+TRANSFER_BYTES = 64 * 2**20
+QUICK_TRANSFER_BYTES = 2**20
+LATENCY_ROUNDS = 2000
+# Tiny frames sent with a single sendall, so every recv holds many of them
+COALESCED_FRAMES = 100000
+PINGS = 20000
+
+def make_text(size, alphabet="ascii"):
+    """
+    Returns a message of about size bytes when encoded in UTF-8.
+
+    Parameters:
+    size (int): Encoded size in bytes
+    alphabet (str): "ascii", or "utf8" for two and three byte characters
+    """
+    if alphabet == "ascii":
+        return "a" * size
+    # "é€" takes 5 bytes
+    return "é€" * (size // 5) + "a" * (size % 5)
+
+def connected_pair(framing, buffer_size=2**11):
+    """
+    Returns two MessageProtocol objects connected by a socket pair.
+
+    Parameters:
+    framing (str): FRAMING_DELIMITED or FRAMING_LENGTH
+    buffer_size (int): Receive buffer size of both ends
+    """
+    left, right = socket.socketpair()
+    return (MessageProtocol(left, buffer_size, framing=framing),
+            MessageProtocol(right, buffer_size, framing=framing))
+
+def in_background(target, *args):
+    """Runs a function in a daemon thread, a broken connection ends it quietly"""
+    def run():
+        try:
+            target(*args)
+        except ConnectionBroken:
+            pass
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def rates(count, nbytes, seconds):
+    return {"messages": count, "bytes": nbytes, "seconds": seconds,
+            "messages_per_second": count / seconds, "bytes_per_second": nbytes / seconds,
+            "metric": "messages_per_second", "higher_is_better": True}
+
+def measure_throughput(framing, text, count, buffer_size=2**11):
+    """
+    Sends count copies of a message from one thread and receives them in
+    this one, returns the rates.
+
+    Parameters:
+    framing (str): FRAMING_DELIMITED or FRAMING_LENGTH
+    text (str): The message
+    count (int): Number of messages
+    buffer_size (int): Receive buffer size
+    """
+    def send():
+        for _ in range(count):
+            sender.send_message(text)
+
+    sender, receiver = connected_pair(framing, buffer_size)
+    try:
+        started = perf_counter()
+        thread = in_background(send)
+        for _ in range(count):
+            received = receiver.get_message()
+        seconds = perf_counter() - started
+        thread.join()
+        if received != text:
+            raise RuntimeError("Received a different message")
+    finally:
+        sender.terminate()
+        receiver.terminate()
+    return rates(count, count * len(bytes(text, encoding="UTF-8")), seconds)
+
+def measure_latency(framing, text, rounds):
+    """
+    Sends a message and waits for it to be echoed, rounds times. Returns the
+    percentiles of the round trip times in seconds.
+
+    Parameters:
+    framing (str): FRAMING_DELIMITED or FRAMING_LENGTH
+    text (str): The message
+    rounds (int): Number of round trips
+    """
+    def echo():
+        for _ in range(rounds):
+            peer.send_message(peer.get_message())
+
+    client, peer = connected_pair(framing)
+    samples = []
+    try:
+        thread = in_background(echo)
+        for _ in range(rounds):
+            started = perf_counter()
+            client.send_message(text)
+            client.get_message()
+            samples.append(perf_counter() - started)
+        thread.join()
+    finally:
+        client.terminate()
+        peer.terminate()
+    result = percentiles(samples)
+    result.update(metric="p50", higher_is_better=False)
+    return result
+
+def measure_received(framing, queue, count):
+    """
+    Encodes count frames with queue, sends them with one sendall and returns
+    the rates of decoding them and the average frames per recv call.
+
+    Parameters:
+    framing (str): FRAMING_DELIMITED or FRAMING_LENGTH
+    queue (callable): Queues one frame on the sending MessageProtocol
+    count (int): Number of frames
+    """
+    sender, receiver = connected_pair(framing, 2**16)
+    try:
+        for _ in range(count):
+            queue(sender)
+        data = b"".join(sender.take_pending())
+        started = perf_counter()
+        thread = in_background(sender.socket.sendall, data)
+        for _ in range(count):
+            receiver.get_message()
+        seconds = perf_counter() - started
+        thread.join()
+    finally:
+        sender.terminate()
+        receiver.terminate()
+    result = rates(count, len(data), seconds)
+    result["frames_per_read"] = count / receiver.read_stats.reads
+    return result
+
+def measure_pings(framing, count):
+    """
+    Sends count pings, each flushed on its own like a keepalive, and returns
+    the rates of receiving them.
+
+    Parameters:
+    framing (str): FRAMING_DELIMITED or FRAMING_LENGTH
+    count (int): Number of pings
+    """
+    def send():
+        for _ in range(count):
+            sender.ping()
+
+    sender, receiver = connected_pair(framing)
+    try:
+        started = perf_counter()
+        thread = in_background(send)
+        for _ in range(count):
+            if receiver.get_message() is not None:
+                raise RuntimeError("Expected a ping")
+        seconds = perf_counter() - started
+        thread.join()
+    finally:
+        sender.terminate()
+        receiver.terminate()
+    return rates(count, 0, seconds)
+
+def cases(quick=False):
+    """
+    Yields (name, function) pairs of the benchmark cases, every function
+    returns the measurements of one run.
+
+    Parameters:
+    quick (bool): Small sizes and counts only, e.g. for testing
+    """
+    sizes = QUICK_SIZES if quick else SIZES
+    transfer = QUICK_TRANSFER_BYTES if quick else TRANSFER_BYTES
+    scale = 10 if quick else 1
+    for framing in FRAMINGS:
+        for alphabet in ("ascii", "utf8"):
+            for size in sizes:
+                text = make_text(size, alphabet)
+                yield ("throughput/{}/{}/{}".format(framing, alphabet, size),
+                       lambda framing=framing, text=text, count=max(1, transfer // size):
+                       measure_throughput(framing, text, count))
+        for size in sizes[:3]:
+            yield ("latency/{}/{}".format(framing, size),
+                   lambda framing=framing, text=make_text(size):
+                   measure_latency(framing, text, LATENCY_ROUNDS // scale))
+        yield ("coalesced/{}".format(framing),
+               lambda framing=framing, text=make_text(16):
+               measure_received(framing, lambda sender: sender.queue_message(text),
+                                COALESCED_FRAMES // scale))
+        yield ("ping/{}".format(framing),
+               lambda framing=framing: measure_pings(framing, PINGS // scale))
+        for buffer_size in BUFFER_SIZES:
+            yield ("buffer/{}/{}".format(framing, buffer_size),
+                   lambda framing=framing, buffer_size=buffer_size:
+                   measure_throughput(framing, make_text(2**16), transfer // 2**16,
+                                      buffer_size))
+
+def better(result, other):
+    """Returns True if result is a better run of the same case than other"""
+    if result["higher_is_better"]:
+        return result[result["metric"]] > other[result["metric"]]
+    return result[result["metric"]] < other[result["metric"]]
+
+def run_suite(quick=False, repeat=3, only=None):
+    """
+    Runs the benchmark cases and returns a report with the best run of each.
+
+    Parameters:
+    quick (bool): Small sizes and counts only
+    repeat (int): Runs of every case
+    only (str): Runs only the cases whose names contain this text
+    """
+    results = {}
+    for name, function in cases(quick):
+        if only and only not in name:
+            continue
+        best = None
+        for _ in range(repeat):
+            result = function()
+            if best is None or better(result, best):
+                best = result
+        results[name] = best
+    return {
+        "time": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {"quick": quick, "repeat": repeat, "only": only},
+        "results": results,
+    }
+
+def compare(report, baseline, tolerance=0.1):
+    """
+    Compares the cases found in both reports. Returns a dict mapping case names
+    to the baseline and current value of their metric, the relative change,
+    positive when the current run is better, and whether it's a regression of
+    more than tolerance.
+
+    Parameters:
+    report (dict): Current report from run_suite
+    baseline (dict): Earlier report
+    tolerance (float): Relative slowdown that still isn't a regression
+    """
+    comparison = {}
+    for name, result in report["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        metric = result["metric"]
+        if result["higher_is_better"]:
+            change = result[metric] / old[metric] - 1
+        else:
+            change = old[metric] / result[metric] - 1
+        comparison[name] = {"metric": metric, "baseline": old[metric],
+                            "current": result[metric], "change": change,
+                            "regression": change < -tolerance}
+    return comparison
+
+def summary(report, comparison=None):
+    """
+    Returns a human readable summary of a report, one line per case.
+
+    Parameters:
+    report (dict): Report from run_suite
+    comparison (dict): Result of compare, adds the changes
+    """
+    lines = []
+    for name, result in report["results"].items():
+        if result["metric"] == "p50":
+            line = "{:<36} p50 {:9.1f} µs  p99 {:9.1f} µs".format(
+                name, 1e6 * result["p50"], 1e6 * result["p99"])
+        else:
+            line = "{:<36} {:12.0f} msg/s {:10.1f} MiB/s".format(
+                name, result["messages_per_second"], result["bytes_per_second"] / 2**20)
+        if comparison and name in comparison:
+            line += "  {:+6.1f}%{}".format(100 * comparison[name]["change"],
+                                           "  REGRESSION" if comparison[name]["regression"]
+                                           else "")
+        lines.append(line)
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MessageProtocol micro-benchmarks")
+    parser.add_argument("--quick", action="store_true", help="Small sizes and counts only")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of every case, the best counts")
+    parser.add_argument("--only", default=None,
+                        help="Runs the cases whose names contain this text, e.g. latency/length")
+    parser.add_argument("--output", default=None, help="JSON file the report is written to")
+    parser.add_argument("--baseline", default=None,
+                        help="Report of an earlier run to compare with, regressions make "
+                             "the exit status 1")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative slowdown that isn't reported as a regression")
+    args = parser.parse_args()
+
+    report = run_suite(args.quick, args.repeat, args.only)
+    comparison = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            comparison = compare(report, json.load(baseline_file), args.tolerance)
+        report["comparison"] = comparison
+    print(summary(report, comparison))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    if comparison and any(change["regression"] for change in comparison.values()):
+        sys.exit(1)
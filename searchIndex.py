@@ -0,0 +1,189 @@
+from const import *
+from presence import username_of
+
+from array import array
+from bisect import bisect_left, bisect_right
+import re
+
+WORD = re.compile(r"\w+")
+
+def terms_of(text):
+    """
+    Returns the set of search terms of a text: its words in lower case, cut to
+    SEARCH_MAX_TERM_LENGTH characters.
+
+    Parameters:
+    text (str): The text
+    """
+    return {word[:SEARCH_MAX_TERM_LENGTH] for word in WORD.findall(text.lower())}
+
+def user_of(usertag):
+    """
+    Returns the key a usertag is indexed under, the username in lower case.
+
+    Parameters:
+    usertag (str): Username and address of the author
+    """
+    return username_of(usertag).lower()
+
+
+class SearchIndex():
+    """
+    Inverted index of the messages of a channel. Every term and every author
+    has a posting list of the sequence numbers of its messages, an array of
+    integers that stays sorted because messages are added in sequence order.
+    Queries intersect the posting lists from the newest message backwards, so
+    the most recent matches are found without looking at older ones.
+
+    Messages dropped from the history are evicted too: posting lists aren't
+    touched on every eviction but compacted once the evicted postings make up
+    half of them, so the work stays constant per message on average.
+
+    Isn't thread safe, the server guards it with its messages lock.
+    """
+    def __init__(self, start_seq=0):
+        """
+        Parameters:
+        start_seq (int): Sequence number of the first added message
+        """
+        self.terms = {}
+        self.users = {}
+        # Timestamps of the messages from base_seq on, made non decreasing so
+        # that a time range maps to a range of sequence numbers
+        self.times = array("d")
+        # Number of postings of every message from base_seq on, to count the evicted ones
+        self.counts = array("I")
+        # Sequence number of the first entry of times and counts, trimmed with
+        # the posting lists
+        self.base_seq = start_seq
+        self.first_seq = start_seq
+        self.next_seq = start_seq
+        # Postings stored and postings of evicted messages that are still stored
+        self.postings = 0
+        self.dead_postings = 0
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    def add(self, message):
+        """
+        Indexes a message that was just added to the history.
+
+        Parameters:
+        message (Message): The message, with its sequence number set
+        """
+        seq = message.seq
+        if seq < self.next_seq:
+            return
+        if seq > self.next_seq:
+            # Messages that were never indexed count as evicted
+            self.evict(self.next_seq)
+            self.compact()
+            self.base_seq = self.first_seq = self.next_seq = seq
+        keys = terms_of(message.message)
+        for term in keys:
+            self.terms.setdefault(term, array("q")).append(seq)
+        self.users.setdefault(user_of(message.usertag), array("q")).append(seq)
+        timestamp = message.timestamp.timestamp()
+        if self.times and timestamp < self.times[-1]:
+            timestamp = self.times[-1]
+        self.times.append(timestamp)
+        self.counts.append(len(keys) + 1)
+        self.postings += len(keys) + 1
+        self.next_seq = seq + 1
+
+    def evict(self, first_seq):
+        """
+        Forgets the messages before a sequence number, called when the history
+        drops them.
+
+        Parameters:
+        first_seq (int): Sequence number of the oldest retained message
+        """
+        first_seq = min(first_seq, self.next_seq)
+        if first_seq <= self.first_seq:
+            return
+        self.dead_postings += sum(self.counts[self.first_seq - self.base_seq:
+                                              first_seq - self.base_seq])
+        self.first_seq = first_seq
+        if self.dead_postings * 2 > self.postings:
+            self.compact()
+
+    def compact(self):
+        """Removes the postings of evicted messages and the terms left without any"""
+        for postings in (self.terms, self.users):
+            for key, seqs in list(postings.items()):
+                start = bisect_left(seqs, self.first_seq)
+                if start == len(seqs):
+                    del postings[key]
+                elif start:
+                    del seqs[:start]
+        del self.times[:self.first_seq - self.base_seq]
+        del self.counts[:self.first_seq - self.base_seq]
+        self.base_seq = self.first_seq
+        self.postings -= self.dead_postings
+        self.dead_postings = 0
+
+    def seq_range(self, since=None, until=None):
+        """
+        Returns the sequence numbers (first, end) of the indexed messages
+        posted in a time range.
+
+        Parameters:
+        since (datetime): Earliest time, None for no limit
+        until (datetime): Time the messages were posted before, None for no limit
+        """
+        first, end = self.first_seq, self.next_seq
+        lowest = self.first_seq - self.base_seq
+        if since is not None:
+            first = self.base_seq + bisect_left(self.times, since.timestamp(), lowest)
+        if until is not None:
+            end = self.base_seq + bisect_left(self.times, until.timestamp(), lowest)
+        return first, end
+
+    def search(self, text="", user=None, since=None, until=None, before=None,
+               limit=SEARCH_PAGE_SIZE):
+        """
+        Returns the sequence numbers of the newest messages matching a query,
+        newest first. Every term of the text and the author have to match.
+
+        Parameters:
+        text (str): Words the messages have to contain
+        user (str): Username of the author, or a usertag
+        since (datetime): Earliest time of the messages
+        until (datetime): Time the messages were posted before
+        before (int): Sequence number the results are older than, to get
+                      the following page
+        limit (int): Maximal number of results
+        """
+        first, end = self.seq_range(since, until)
+        if before is not None:
+            end = min(end, before)
+        if first >= end:
+            return []
+
+        lists = [self.terms.get(term) for term in terms_of(text)]
+        if user is not None:
+            lists.append(self.users.get(user_of(user)))
+        if not lists:
+            return list(range(end - 1, max(first, end - limit) - 1, -1))
+        if any(seqs is None for seqs in lists):
+            return []
+
+        # Walk the shortest list and look the others up
+        lists.sort(key=len)
+        shortest, others = lists[0], lists[1:]
+        results = []
+        position = bisect_left(shortest, end) - 1
+        while position >= 0 and len(results) < limit:
+            seq = shortest[position]
+            if seq < first:
+                break
+            for seqs in others:
+                found = bisect_right(seqs, seq) - 1
+                if found < 0 or seqs[found] != seq:
+                    break
+            else:
+                results.append(seq)
+            position -= 1
+        return results
@@ -1,5 +1,8 @@
-from serverThread import ServerThread
+from const import *
+from serverThread import create_server
 import tkinter as tk
+import argparse
+import queue
 
 WIDTH = 300
 HEIGHT = 500
@@ -8,15 +11,26 @@ class ServerApp(tk.Frame):
     """ 
     The chat server GUI. Starts the server and displays connected users.
     """
-    def __init__(self, master=None):
+    def __init__(self, master=None, engine=SERVER_ENGINE, workers=SERVER_WORKERS):
+        """
+        Parameters:
+        engine (str): Server engine, "thread" or "asyncio"
+        workers (int): Number of worker processes
+        """
         super().__init__(master)
-        self.server = ServerThread()
+        self.server = create_server(engine, workers=workers)
         self.server.add_observer(self)
+        # Presence changes passed by the server, applied by the Tk main loop
+        self.changes = queue.Queue()
+        # Usertags in the order of the listbox and the positions of every usertag
+        self.usertags = []
+        self.positions = {}
         self.create_elements()
 
     def start(self):
         """Starts the server thread and the GUI"""
         self.server.start()
+        self.after(RENDER_INTERVAL, self.render)
         self.mainloop()
 
     def stop(self):
@@ -38,24 +52,71 @@ class ServerApp(tk.Frame):
 
         self.pack(fill=tk.BOTH, expand=True)
 
-    def notify(self, clients):
+    def notify_presence(self, joined, left):
         """
-        Function used by the ServerThread to pass the usernames
-        of the connected users after connection/disconnections.
+        Function used by the ServerThread to pass the usernames of the users
+        that connected or disconnected. Runs in a server thread, so the changes
+        are only queued here and applied by render.
         
         Parameters:
-        clients (list): List of strings with usernames
+        joined (list): Usernames of the connected users
+        left (list): Usernames of the disconnected users
+        """
+        self.changes.put((joined, left))
+
+    def render(self):
         """
-        self.client_list.delete(0, tk.END)
-        for client in clients:
-            self.client_list.insert(tk.END, client)
+        Applies the queued presence changes to the listbox, every RENDER_INTERVAL
+        milliseconds on the Tk main loop. Every change touches a constant number
+        of rows no matter how many users are listed.
+        """
+        try:
+            while True:
+                joined, left = self.changes.get_nowait()
+                for usertag in left:
+                    self._remove_user(usertag)
+                for usertag in joined:
+                    self._add_user(usertag)
+        except queue.Empty:
+            pass
+        self.after(RENDER_INTERVAL, self.render)
+
+    def _add_user(self, usertag):
+        self.positions.setdefault(usertag, set()).add(len(self.usertags))
+        self.usertags.append(usertag)
+        self.client_list.insert(tk.END, usertag)
+
+    def _remove_user(self, usertag):
+        positions = self.positions.get(usertag)
+        if not positions:
+            return
+        position = positions.pop()
+        if not positions:
+            del self.positions[usertag]
+        last = len(self.usertags) - 1
+        if position != last:
+            # Move the last row in place of the removed one
+            moved = self.usertags[last]
+            self.positions[moved].remove(last)
+            self.positions[moved].add(position)
+            self.usertags[position] = moved
+            self.client_list.delete(position)
+            self.client_list.insert(position, moved)
+        self.usertags.pop()
+        self.client_list.delete(last)
                 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default=SERVER_ENGINE)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                        help="Number of worker processes sharing the port")
+    args = parser.parse_args()
+
     root = tk.Tk()
     root.wm_title("Chat server")
     root.minsize(WIDTH, HEIGHT)
     
-    app = ServerApp(root)
+    app = ServerApp(root, args.engine, args.workers)
     root.protocol("WM_DELETE_WINDOW", app.stop)
     app.start()
         
\ No newline at end of file
@@ -1,102 +1,1281 @@
 from const import *
-from protocol import MessageProtocol, ConnectionBroken
+from protocol import (MessageProtocol, ConnectionBroken, WriteStats, StreamChunk, Control,
+                      FRAMING_DELIMITED)
+from messageHistory import MessageHistory
+from channels import Channel, valid_channel_name
+from flowControl import FlowLimiter
+from metrics import ServerMetrics
+from presence import ClientRegistry, PresenceNotifier
+from profiler import Profiler
+from timerWheel import TimerWheel
 
 from datetime import datetime
+from time import monotonic, sleep, time
+import collections
+import itertools
+import secrets
 import socket
 import threading
 
 class Message():
-    """ Keeps track of contents of a message and metadata (username, time)"""
-    def __init__(self, usertag, timestamp, message):
+    """
+    Keeps track of contents of a message and metadata (username, time, channel).
+    The text and its encoded form are computed once and shared by all the recipients.
+    """
+    __slots__ = ("usertag", "timestamp", "message", "channel", "seq",
+                 "_text", "_payload", "_delimited_payload")
+
+    def __init__(self, usertag, timestamp, message, channel=DEFAULT_CHANNEL):
         self.usertag = usertag
         self.timestamp = timestamp
         self.message = message
+        self.channel = channel
+        # Sequence number given by the message history
+        self.seq = None
+        self._text = None
+        self._payload = None
+        self._delimited_payload = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = "[{:02d}:{:02d}:{:02d}]{}{}:{}".format(
+                self.timestamp.hour,
+                self.timestamp.minute,
+                self.timestamp.second,
+                "" if self.channel == DEFAULT_CHANNEL else "#{} ".format(self.channel),
+                self.usertag,
+                self.message
+            )
+        return self._text
+
+    def payload(self):
+        """Returns the message encoded in UTF-8, the encoding of all server connections"""
+        if self._payload is None:
+            self._payload = bytes(str(self), encoding="UTF-8")
+        return self._payload
+
+    def size(self):
+        """Returns the size of the encoded message in bytes"""
+        return len(self.payload())
+
+    def encode(self, connection):
+        """
+        Returns the message encoded for the framing of the connection. Delimited
+        connections need the special tags removed, so they get a separate copy.
+
+        Parameters:
+        connection: MessageProtocol or AsyncMessageProtocol the message will be sent through
+        """
+        if connection.framing == FRAMING_DELIMITED:
+            if self._delimited_payload is None:
+                self._delimited_payload = connection.encode_message(str(self))
+            return self._delimited_payload
+        return self.payload()
+
+class DirectMessage(Message):
+    """
+    Message sent to one user. It skips the history and the channels, the
+    server puts it straight into the outboxes of the recipient's sessions.
+    """
+    __slots__ = ("recipient",)
+
+    def __init__(self, usertag, timestamp, message, recipient):
+        super().__init__(usertag, timestamp, message)
+        self.recipient = recipient
 
     def __str__(self):
-        return "[{:02d}:{:02d}:{:02d}]{}:{}".format(
-            self.timestamp.hour,
-            self.timestamp.minute,
-            self.timestamp.second,
-            self.usertag,
-            self.message
-        )
+        if self._text is None:
+            self._text = "[{:02d}:{:02d}:{:02d}]{} to {}:{}".format(
+                self.timestamp.hour,
+                self.timestamp.minute,
+                self.timestamp.second,
+                self.usertag,
+                self.recipient,
+                self.message
+            )
+        return self._text
+
+def parse_time(text):
+    """
+    Parses a time given as HH:MM[:SS] today or as an ISO date and time.
+
+    Parameters:
+    text (str): The time
+    """
+    if text.count(":") and "-" not in text:
+        parsed = datetime.strptime(text, "%H:%M:%S" if text.count(":") == 2 else "%H:%M")
+        return datetime.combine(datetime.now().date(), parsed.time())
+    return datetime.fromisoformat(text)
+
+def is_local(usertag):
+    """
+    Returns True if a client connected from this machine.
+
+    Parameters:
+    usertag (str): Username and address of the client
+    """
+    return usertag.rpartition("@")[2] in ("127.0.0.1", "::1")
+
+class Outbox():
+    """
+    Wakes up the writer thread of one client when new messages are published
+    and holds messages meant only for that client.
+    """
+    def __init__(self):
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.pending = False
+        self.closed = False
+        # Time of the first wake up that wasn't flushed yet, for the fan-out latency
+        self.woken_at = None
+        # Bytes of streamed messages queued and not yet taken by the writer
+        self.stream_bytes = 0
+
+    def put(self, item):
+        """
+        Queues an item that isn't part of the history and wakes up the writer.
+
+        Parameters:
+        item: Message, HistoryRange or StreamChunk to send
+        """
+        with self.condition:
+            self.items.append(item)
+            if isinstance(item, StreamChunk):
+                self.stream_bytes += len(item.data)
+            self.pending = True
+            if self.woken_at is None:
+                self.woken_at = monotonic()
+            self.condition.notify()
+
+    def wake(self):
+        """Tells the writer that there are new messages in the history"""
+        with self.condition:
+            self.pending = True
+            if self.woken_at is None:
+                self.woken_at = monotonic()
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Blocks until the outbox is woken up or the timeout passes. Returns a list
+        of the queued items (possibly empty) or None once the outbox is closed.
+
+        Parameters:
+        timeout (float): Maximal time to wait in seconds, None waits indefinitely
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending or self.closed, timeout)
+            if self.closed:
+                return None
+            self.pending = False
+            self.stream_bytes = 0
+            items = list(self.items)
+            self.items.clear()
+            return items
+
+    def close(self):
+        """Stops the writer waiting on the outbox"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class HistoryRange():
+    """ Request to resend the history messages of a channel from first_seq up to end_seq"""
+    __slots__ = ("channel", "first_seq", "end_seq")
+
+    def __init__(self, channel, first_seq, end_seq):
+        self.channel = channel
+        self.first_seq = first_seq
+        self.end_seq = end_seq
+
+class RelayStream():
+    """ A streamed message being relayed from its sender to the recipients"""
+    __slots__ = ("stream_id", "recipients", "size")
+
+    def __init__(self, stream_id, recipients):
+        """
+        Parameters:
+        stream_id (int): Id of the stream towards the recipients
+        recipients (list): Clients receiving the stream
+        """
+        self.stream_id = stream_id
+        self.recipients = recipients
+        # Bytes received so far
+        self.size = 0
+
+class Session():
+    """ Subscriptions of a disconnected client kept until it resumes or the session expires"""
+    __slots__ = ("usertag", "channels", "channel", "expires")
+
+    def __init__(self, usertag, channels, channel, expires):
+        """
+        Parameters:
+        usertag (str): Username and address of the client
+        channels (list): Names of the subscribed channels
+        channel (str): Channel the messages of the client were posted to
+        expires (float): Monotonic time after which the session can't be resumed
+        """
+        self.usertag = usertag
+        self.channels = channels
+        self.channel = channel
+        self.expires = expires
 
 class Client():
     """
     Represents a connected client.
     """
 
-    def __init__(self, usertag):
+    def __init__(self, usertag, outbox, connection=None, number=None):
+        """
+        Parameters:
+        usertag (str): Username and address of the client
+        outbox: Outbox waking up the writer of the client
+        connection: Connection with the client
+        number (int): Number of the connection, unique on the server
+        """
         self.usertag = usertag
+        self.number = number
+        self.outbox = outbox
+        self.connection = connection
+        # Subscribed channels mapped to the sequence number of the next message to send
+        self.cursors = {}
+        # Channel the messages of the client are posted to
+        self.channel = DEFAULT_CHANNEL
+        # Time by which queued frames have to be flushed
+        self.flush_deadline = None
+        # Streams sent by the client mapped by their id to the RelayStream
+        self.streams = {}
+        # Session token, None if the connection can't resume sessions
+        self.token = None
+        # Limits the rate of the messages received from the client
+        self.limiter = None
+
+    def stats_key(self):
+        """Returns the key of the connection in the statistics, a user can connect several times"""
+        return "{}#{}".format(self.usertag, self.number)
 
 class ServerThread(threading.Thread):
     """
     Allows for running the server inside a separate thread. Starts more threads
     for each client connection.
     """
-    def __init__(self):
+    # Names accepted by configure
+    SETTINGS = ("idle_timeout", "stats_port", "stats_file", "message_rate", "message_burst",
+                "byte_rate", "byte_burst", "profile_directory")
+
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, log_directory=LOG_DIRECTORY):
+        """
+        Parameters:
+        host (str): Interface to listen on, empty for all interfaces
+        port (int): Port to listen on
+        log_directory (str): Directory of the persistent message log, None keeps
+                             the history only in memory
+        """
         threading.Thread.__init__(self)
-        self.messages = []
+        self.host = host
+        self.port = port
+        self.log = None
+        if log_directory:
+            # Optional subsystems are only imported when used, for a fast start
+            from messageLog import MessageLog
+            self.log = MessageLog(log_directory)
+        # The message log stores the default channel, its sequence numbers
+        # continue where the stored history ends
+        default = Channel(DEFAULT_CHANNEL,
+                          MessageHistory(start_seq=self.log.next_seq if self.log else 0))
+        self.channels = {DEFAULT_CHANNEL: default}
+        # Guards the channels and the list of connected clients so that every
+        # client receives the messages in the same order
         self.messages_lock = threading.Lock()
         self.socket = socket.socket()
         self.running = False
+        # Set once the server accepts connections
+        self.listening = threading.Event()
+        self.stopped = threading.Event()
 
-        self.connected_clients = []
-        self.observers = []
-        
+        self.connected_clients = ClientRegistry()
+        # Tokens of the sessions of disconnected clients mapped to the Session,
+        # in the order they expire
+        self.sessions = {}
+        # Closes connections that sent nothing for idle_timeout seconds
+        self.idle_timeout = IDLE_TIMEOUT
+        # Limits of every client, see FlowLimiter
+        self.message_rate = CLIENT_MESSAGE_RATE
+        self.message_burst = CLIENT_MESSAGE_BURST
+        self.byte_rate = CLIENT_BYTE_RATE
+        self.byte_burst = CLIENT_BYTE_BURST
+        self.timers = TimerWheel(now=monotonic())
+        # Profiling is enabled when the server starts with a profile directory
+        self.profile_directory = PROFILE_DIRECTORY
+        self.profiler = Profiler()
+        self.presence = PresenceNotifier(self.connected_usertags, profiler=self.profiler)
+        self.commands = {"history": self.command_history, "join": self.command_join,
+                         "leave": self.command_leave, "channels": self.command_channels,
+                         "search": self.command_search, "profile": self.command_profile,
+                         "msg": self.command_msg}
+        # Message bus shared with other worker processes, see workers.py
+        self.bus = None
+        # Allows several worker processes to listen on the same port
+        self.reuse_port = False
+        self.metrics = ServerMetrics()
+        # Ids of the relayed streams, unique across all the connections
+        self.stream_ids = itertools.count()
+        # Numbers of the connections, telling apart the sessions of one usertag
+        self.connection_numbers = itertools.count(1)
+        # Stats endpoint and file, see metrics.StatsReporter
+        self.stats_port = STATS_PORT
+        self.stats_file = STATS_FILE
+        self.reporter = None
+        # Seconds the clients get to receive their queued messages when stopping
+        self.drain_timeout = 0
+
+    @property
+    def history(self):
+        """History of the default channel"""
+        return self.channels[DEFAULT_CHANNEL].history
+
+    def configure(self, **settings):
+        """
+        Changes settings of the server before it is started.
+
+        Parameters:
+        settings: Attribute names mapped to their values, e.g. idle_timeout=60
+        """
+        for name, value in settings.items():
+            if name not in self.SETTINGS:
+                raise ValueError("Unknown server setting {}".format(name))
+            setattr(self, name, value)
+
+    def make_outbox(self):
+        """Creates the outbox for a new client"""
+        return Outbox()
+
+    def get_channel(self, name):
+        """
+        Returns the channel with the name, creating it if needed. Returns None
+        if the server already has MAX_CHANNELS channels. Has to be called with
+        the messages lock held.
+
+        Parameters:
+        name (str): Name of the channel
+        """
+        channel = self.channels.get(name)
+        if channel is None and len(self.channels) < MAX_CHANNELS:
+            channel = self.channels[name] = Channel(name)
+        return channel
+
+    def release_channel(self, channel):
+        """
+        Drops a channel nobody is subscribed to and no session can resume in,
+        so that it no longer counts towards MAX_CHANNELS. Has to be called with
+        the messages lock held.
+
+        Parameters:
+        channel (Channel): The channel
+        """
+        if channel.name != DEFAULT_CHANNEL and not channel.subscribers and not channel.sessions:
+            del self.channels[channel.name]
+
+    def subscribe(self, client, channel, cursor=None):
+        """
+        Subscribes a client to a channel, the last JOIN_HISTORY_MESSAGES messages
+        of the channel are sent to it. Has to be called with the messages lock held.
+
+        Parameters:
+        client (Client): The client
+        channel (Channel): The channel
+        cursor (int): Sequence number of the first message to send instead,
+                      given by a resuming client
+        """
+        if not channel.subscribe(client):
+            return
+        oldest = channel.history.first_seq
+        if self.log and channel.name == DEFAULT_CHANNEL:
+            oldest = self.log.first_seq
+        if cursor is None or cursor > channel.history.next_seq:
+            cursor = channel.history.next_seq - JOIN_HISTORY_MESSAGES
+        client.cursors[channel.name] = max(oldest, cursor)
+        client.outbox.wake()
 
-    def get_new_messages(self, previous_index):
+    def publish(self, message):
         """
-        Safely returns messages received from all clients to a particular client
-        thread.
+        Posts a new message to the chat. When the server is one of several worker
+        processes the message goes through the message bus, so that all the
+        workers deliver it in the same order.
 
         Parameters:
-        previous_index (int): The index of the newest message that was acquired by
-                        the client
+        message (Message): The new message
+        """
+        if self.bus:
+            self.bus.post(message)
+        else:
+            self.deliver(message)
+
+    def deliver(self, message):
+        """
+        Adds a message to the history of its channel and wakes up the writers
+        of the channel's subscribers.
+
+        Parameters:
+        message (Message): The new message
+        """
+        with self.profiler.span("fanout.deliver"), self.messages_lock:
+            # Channels without subscribers were dropped, nobody receives the message
+            channel = self.channels.get(message.channel)
+            if channel is None:
+                return
+            channel.append(message)
+            self.metrics.published += 1
+            if self.log and channel.name == DEFAULT_CHANNEL:
+                self.log.append(message)
+            for client in channel.subscribers:
+                client.outbox.wake()
+
+    def admit(self, client):
+        """
+        Checks the message last received from a client against its limits,
+        charging the size of its frame in bytes. Returns 0 if it can be
+        handled, otherwise the seconds the client's connection isn't read
+        from before checking again.
+
+        Parameters:
+        client (Client): The sender
+        """
+        wait = client.limiter.admit(client.connection.last_frame_size, monotonic())
+        if wait:
+            self.metrics.throttles += 1
+        return wait
+
+    def handle_message(self, client, text):
+        """
+        Publishes a message received from a client, or runs the command
+        if the message starts with a known "/command".
+
+        Parameters:
+        client (Client): The sender
+        text (str): The received message
+        """
+        if text.startswith("/"):
+            name, _, argument = text[1:].partition(" ")
+            command = self.commands.get(name)
+            if command:
+                command(client, argument.strip())
+                return
+        self.publish(Message(client.usertag, datetime.now(), text, client.channel))
+
+    def handle_chunk(self, client, chunk):
+        """
+        Relays a part of a message streamed by a client to the subscribers of
+        its channel at the time the stream started. Chunks are passed on as they
+        arrive, so the server never holds the whole message. Streams aren't
+        stored in the history.
+
+        Parameters:
+        client (Client): The sender
+        chunk (StreamChunk): The received part
+        """
+        stream = client.streams.get(chunk.stream_id)
+        if stream is None:
+            stream = client.streams[chunk.stream_id] = self.start_stream(client)
+        stream.size += len(chunk.data)
+        if chunk.last:
+            del client.streams[chunk.stream_id]
+        elif stream.size > STREAM_MAX_BYTES:
+            self.interrupt_stream(stream, stream.recipients)
+            stream.recipients = []
+            return
+        interrupted = [recipient for recipient in stream.recipients
+                       if recipient.outbox.stream_bytes > STREAM_BUFFER_BYTES]
+        if interrupted:
+            # Slow recipients would make the server buffer the whole message
+            self.interrupt_stream(stream, interrupted)
+            stream.recipients = [recipient for recipient in stream.recipients
+                                 if recipient not in interrupted]
+        for recipient in stream.recipients:
+            recipient.outbox.put(StreamChunk(stream.stream_id, chunk.data, chunk.last))
+
+    def start_stream(self, client):
+        """
+        Returns the RelayStream of a new stream sent by a client. Recipients get
+        the prefix of the message first, those whose connection doesn't support
+        streaming get a notice instead.
+
+        Parameters:
+        client (Client): The sender
         """
         with self.messages_lock:
-            out = "\n".join([str(m) for m in self.messages[previous_index:]])
-            new_index = len(self.messages)
-        return out, new_index
+            channel = self.channels[client.channel]
+            subscribers = list(channel.subscribers)
+        stream = RelayStream(next(self.stream_ids), [])
+        # Formatted like a normal message, the streamed text follows the prefix
+        prefix = bytes(str(Message(client.usertag, datetime.now(), "", channel.name)),
+                       encoding="UTF-8")
+        for recipient in subscribers:
+            if recipient.connection.capabilities.get("streaming"):
+                stream.recipients.append(recipient)
+                recipient.outbox.put(StreamChunk(stream.stream_id, prefix))
+            else:
+                self.reply(recipient, "{} sent a message too large for your client."
+                           .format(client.usertag))
+        return stream
+
+    def interrupt_stream(self, stream, recipients):
+        """
+        Ends a stream early for some of its recipients.
+
+        Parameters:
+        stream (RelayStream): The stream
+        recipients (list): Clients that won't receive the rest of the stream
+        """
+        for recipient in recipients:
+            recipient.outbox.put(StreamChunk(stream.stream_id, b"\n[transfer interrupted]",
+                                             last=True))
+
+    def reply(self, client, text):
+        """
+        Sends a server message to one client only.
+
+        Parameters:
+        client (Client): The recipient
+        text (str): The message
+        """
+        client.outbox.put(Message("Server", datetime.now(), text))
+
+    def send_error(self, client, code, detail, text):
+        """
+        Tells a client that its request failed. Clients supporting control
+        messages get Control("error", [code, detail]), the others the text.
+
+        Parameters:
+        client (Client): The client
+        code (str): Name of the error, e.g. "no_such_user"
+        detail (str): What the error is about, without spaces
+        text (str): Description of the error for the other clients
+        """
+        if client.connection and client.connection.capabilities.get("resume"):
+            client.outbox.put(Control("error", [code, detail]))
+        else:
+            self.reply(client, text)
+
+    def command_msg(self, client, argument):
+        """
+        /msg user text sends a message to all the sessions of a user, /msg
+        user@address text only to the sessions from that address. Costs the
+        same however many clients are connected. A worker that finds nobody
+        leaves it to the hub, the user may be connected to another worker.
+        """
+        target, _, text = argument.partition(" ")
+        text = text.strip()
+        if not target or not text:
+            self.reply(client, "Usage: /msg user text")
+            return
+        with self.messages_lock:
+            recipients = self.connected_clients.find_target(target)
+            if recipients:
+                self.metrics.direct_messages += 1
+        message = DirectMessage(client.usertag, datetime.now(), text, target)
+        if not recipients:
+            if self.bus:
+                self.bus.direct(message)
+            else:
+                self.send_error(client, "no_such_user", target,
+                                "{} is not connected.".format(target))
+            return
+        for recipient in recipients:
+            recipient.outbox.put(message)
+        if client not in recipients:
+            # The sender sees the message like the recipient
+            client.outbox.put(message)
+
+    def deliver_direct(self, message, to_sender=False):
+        """
+        Puts a direct message relayed by the hub of the worker processes into
+        the outboxes of its recipients connected to this worker, or once the
+        hub delivered it, into those of the sender's sessions on this worker.
+
+        Parameters:
+        message (DirectMessage): The message
+        to_sender (bool): Deliver the sender's copy
+        """
+        with self.messages_lock:
+            if to_sender:
+                clients = self.connected_clients.find(message.usertag)
+                self.metrics.direct_messages += 1
+            else:
+                clients = self.connected_clients.find_target(message.recipient)
+        for client in clients:
+            client.outbox.put(message)
+
+    def direct_failed(self, usertag, target):
+        """
+        Tells the sessions of a sender on this server that nobody with the
+        name of a /msg target is connected.
+
+        Parameters:
+        usertag (str): Usertag of the sender
+        target (str): Username or usertag the message was sent to
+        """
+        with self.messages_lock:
+            clients = self.connected_clients.find(usertag)
+        for client in clients:
+            self.send_error(client, "no_such_user", target, "{} is not connected.".format(target))
+
+    def command_history(self, client, argument):
+        """
+        /history [count] resends the last count messages of the current channel,
+        /history since HH:MM[:SS] resends the messages posted since that time today.
+        """
+        with self.messages_lock:
+            channel = self.channels[client.channel]
+            end_seq = channel.history.next_seq
+        try:
+            if argument.startswith("since "):
+                since = parse_time(argument[len("since "):].strip())
+                first_seq = self.seq_since(since, channel)
+            else:
+                first_seq = end_seq - (int(argument) if argument else JOIN_HISTORY_MESSAGES)
+        except ValueError:
+            self.reply(client, "Usage: /history [count] or /history since HH:MM")
+            return
+        client.outbox.put(HistoryRange(channel, max(first_seq, 0), end_seq))
+
+    def command_join(self, client, argument):
+        """
+        /join name subscribes to the channel and posts the following messages to it.
+        """
+        name = argument.lstrip("#")
+        if not valid_channel_name(name):
+            self.reply(client, "Usage: /join name, up to 32 letters, digits, - or _")
+            return
+        with self.messages_lock:
+            channel = self.get_channel(name)
+            if channel is not None:
+                joined = client.channel != name and name not in client.cursors
+                self.subscribe(client, channel)
+                client.channel = name
+        if channel is None:
+            self.reply(client, "Cannot create more channels.")
+        elif joined:
+            self.publish(Message("Server", datetime.now(),
+                                 "{} has joined #{}.".format(client.usertag, name), name))
+        else:
+            self.reply(client, "Posting to #{}.".format(name))
+
+    def command_leave(self, client, argument):
+        """
+        /leave [name] unsubscribes from the channel, the current one by default.
+        Messages are posted to the default channel afterwards.
+        """
+        name = argument.lstrip("#") or client.channel
+        if name == DEFAULT_CHANNEL:
+            self.reply(client, "The #{} channel can't be left.".format(DEFAULT_CHANNEL))
+            return
+        with self.messages_lock:
+            channel = self.channels.get(name)
+            left = channel is not None and channel.unsubscribe(client)
+            if left:
+                del client.cursors[name]
+                if client.channel == name:
+                    client.channel = DEFAULT_CHANNEL
+                self.release_channel(channel)
+        if not left:
+            self.reply(client, "Not subscribed to #{}.".format(name))
+            return
+        self.publish(Message("Server", datetime.now(),
+                             "{} has left #{}.".format(client.usertag, name), name))
+
+    def command_channels(self, client, argument):
+        """
+        /channels lists the channels with the number of their subscribers.
+        """
+        with self.messages_lock:
+            listing = ["#{} ({})".format(channel.name, len(channel))
+                       for channel in self.channels.values() if len(channel)]
+            current = client.channel
+        self.reply(client, "Channels: {}. Posting to #{}.".format(", ".join(listing), current))
+
+    def command_search(self, client, argument):
+        """
+        /search words [from:user] [since:HH:MM] [until:HH:MM] [in:#channel] [before:seq]
+        lists the newest messages of the current channel containing all the words.
+        """
+        words = []
+        options = {}
+        for word in argument.split():
+            name, colon, value = word.partition(":")
+            if colon and name in ("from", "since", "until", "in", "before") and value:
+                options[name] = value
+            else:
+                words.append(word)
+        name = options.get("in", client.channel).lstrip("#")
+        if name not in client.cursors:
+            self.reply(client, "Not subscribed to #{}.".format(name))
+            return
+        try:
+            since, until = (parse_time(options[key]) if key in options else None
+                            for key in ("since", "until"))
+            before = int(options["before"]) if "before" in options else None
+        except ValueError:
+            self.reply(client, "Usage: /search words [from:user] [since:HH:MM] "
+                               "[until:HH:MM] [in:#channel] [before:seq]")
+            return
+
+        with self.messages_lock:
+            channel = self.channels[name]
+            seqs = channel.index.search(" ".join(words), options.get("from"), since, until,
+                                        before)
+            found = []
+            for seq in seqs:
+                _, messages, _ = channel.history.read(seq, 1)
+                found.extend(messages)
+        lines = ["{} result(s) in #{}, newest first:".format(len(found), name)]
+        lines.extend(str(message) for message in found)
+        if len(found) == SEARCH_PAGE_SIZE:
+            lines.append("More: /search {} before:{}".format(
+                argument.replace("before:{}".format(before), "").strip(), found[-1].seq))
+        self.reply(client, "\n".join(lines))
+
+    def command_profile(self, client, argument):
+        """
+        /profile cpu [seconds], /profile memory or /profile spans writes a
+        profiling capture and replies with its path. Only for clients connected
+        from this machine.
+        """
+        kind, _, seconds = argument.partition(" ")
+        if not is_local(client.usertag):
+            self.reply(client, "Profiling is only available to local clients.")
+            return
+        if not self.profiler.enabled:
+            self.reply(client, "Profiling is disabled.")
+            return
+        try:
+            seconds = float(seconds) if seconds else PROFILE_SAMPLE_SECONDS
+            if kind not in ("cpu", "memory", "spans") or seconds <= 0:
+                raise ValueError(kind)
+        except ValueError:
+            self.reply(client, "Usage: /profile cpu [seconds], /profile memory or /profile spans")
+            return
+        self.capture(kind, seconds, lambda path: self.reply(
+            client, "Profile written to {}".format(path) if path
+            else "Another capture is running."))
+
+    def seq_since(self, since, channel):
+        """
+        Returns the sequence number of the first message of a channel posted at
+        or after a time.
+
+        Parameters:
+        since (datetime): The time
+        channel (Channel): The channel
+        """
+        if self.log and channel.name == DEFAULT_CHANNEL:
+            return self.log.seq_at(since.timestamp())
+        with self.messages_lock:
+            first_seq, _ = channel.index.seq_range(since)
+        return first_seq
+
+    def register(self, usertag, connection=None, resume=None):
+        """
+        Adds a newly connected client. The last JOIN_HISTORY_MESSAGES messages are
+        sent to the client and everyone is informed about the new user.
+        A client resuming its session is subscribed to its channels again and
+        only gets the messages after the sequence numbers it received last.
+        Returns the Client.
+
+        Parameters:
+        usertag (str): Username and address of the client
+        connection: Connection with the client
+        resume (Control): Resume request of a client supporting sessions, see parse_resume
+        """
+        client = Client(usertag, self.make_outbox(), connection, next(self.connection_numbers))
+        client.limiter = FlowLimiter(self.message_rate, self.message_burst,
+                                     self.byte_rate, self.byte_burst, monotonic())
+        token, cursors = self.parse_resume(resume)
+        with self.messages_lock:
+            self.expire_sessions()
+            resumed = session = self.sessions.pop(token, None)
+            replaced = None
+            for other in self.connected_clients.find(usertag):
+                if token and other.token == token:
+                    # The old connection wasn't noticed to be broken yet,
+                    # the new one takes its session over
+                    replaced = other
+                    replaced.token = None
+                    session = Session(usertag, list(other.cursors), other.channel, 0)
+            if session is not None and session.usertag != usertag:
+                session = None
+            self.connected_clients.add(client)
+            if resume is not None:
+                client.token = token if session else secrets.token_hex(16)
+                client.outbox.put(Control("session", [client.token]))
+            for name in session.channels if session else [DEFAULT_CHANNEL]:
+                # Without the session only the logged channel keeps its
+                # sequence numbers across restarts
+                trusted = session or (self.log and name == DEFAULT_CHANNEL)
+                channel = self.get_channel(name)
+                if channel is not None:
+                    self.subscribe(client, channel, cursors.get(name) if trusted else None)
+            if session and session.channel in client.cursors:
+                client.channel = session.channel
+            if resumed is not None:
+                # Only now, the channels mustn't be dropped before the client
+                # is subscribed to them again
+                self.forget_session(resumed)
+
+        if replaced:
+            replaced.connection.terminate()
+        self.presence.changed(joined=(usertag,))
+        if session is None:
+            joined_message = "{} has joined the chat.".format(usertag)
+            self.publish(Message("Server", datetime.now(), joined_message))
+        return client
+
+    def parse_resume(self, resume):
+        """
+        Returns the session token and a dict of the channel cursors from a resume
+        request, Control("resume", [token or "-", "channel:seq", ...]).
+
+        Parameters:
+        resume (Control): The request, None or another message is ignored
+        """
+        if not isinstance(resume, Control) or resume.command != "resume" or not resume.arguments:
+            return None, {}
+        token, *fields = resume.arguments
+        cursors = {}
+        for field in fields:
+            name, _, seq = field.rpartition(":")
+            try:
+                cursors[name] = int(seq)
+            except ValueError:
+                pass
+        return (token if token != "-" else None), cursors
+
+    def expire_sessions(self):
+        """Forgets sessions that can no longer be resumed, has to be called with the messages lock held"""
+        now = monotonic()
+        while self.sessions:
+            token = next(iter(self.sessions))
+            if self.sessions[token].expires > now:
+                break
+            self.forget_session(self.sessions.pop(token))
+
+    def forget_session(self, session):
+        """
+        Releases the channels kept for a session that was resumed or expired.
+        Has to be called with the messages lock held.
+
+        Parameters:
+        session (Session): The session
+        """
+        for name in session.channels:
+            channel = self.channels.get(name)
+            if channel is not None:
+                channel.sessions -= 1
+                self.release_channel(channel)
+
+    def unregister(self, client):
+        """
+        Removes a disconnected client.
+
+        Parameters:
+        client (Client): The disconnected client
+        """
+        with self.messages_lock:
+            self.connected_clients.remove(client)
+            channels = [self.channels[name] for name in client.cursors]
+            if client.token:
+                self.expire_sessions()
+                self.sessions[client.token] = Session(client.usertag, list(client.cursors),
+                                                      client.channel,
+                                                      monotonic() + SESSION_TIMEOUT)
+                for channel in channels:
+                    channel.sessions += 1
+            for channel in channels:
+                channel.unsubscribe(client)
+                self.release_channel(channel)
+            self.metrics.add_closed(self.connection_totals(client.connection))
+        for stream in client.streams.values():
+            self.interrupt_stream(stream, stream.recipients)
+        client.streams.clear()
+        client.outbox.close()
+        self.presence.changed(left=(client.usertag,))
+
+    def pending_batches(self, connection, client, items):
+        """
+        Yields lists of encoded payloads to send to the client: the next batch of
+        messages of every subscribed channel it hasn't received yet followed by
+        the items from its outbox.
+
+        Parameters:
+        connection: Connection with the client
+        client (Client): The client receiving the messages
+        items (list): Messages, history ranges and stream chunks from the client's outbox
+        """
+        ranges = []
+        with self.messages_lock:
+            for name, first_seq in client.cursors.items():
+                channel = self.channels[name]
+                next_seq = channel.history.next_seq
+                if first_seq == next_seq:
+                    continue
+                cursor = min(next_seq, max(first_seq, channel.history.first_seq)
+                                       + HISTORY_READ_BATCH)
+                client.cursors[name] = cursor
+                if cursor < next_seq:
+                    # Come back for the rest without waiting for a new message
+                    client.outbox.wake()
+                ranges.append(HistoryRange(channel, first_seq, cursor))
+        for item in ranges:
+            yield from self.history_batches(connection, item.channel, item.first_seq,
+                                            item.end_seq)
+            if client.token:
+                # Acknowledges the messages sent, the client resumes from there
+                yield [Control("cursor", [item.channel.name, item.end_seq])]
+
+        for item in items:
+            if isinstance(item, HistoryRange):
+                yield from self.history_batches(connection, item.channel, item.first_seq,
+                                                item.end_seq)
+            elif isinstance(item, (StreamChunk, Control)):
+                yield [item]
+            else:
+                yield [item.encode(connection)]
+
+    def history_batches(self, connection, channel, first_seq, end_seq):
+        """
+        Yields lists of encoded payloads of the history messages of a channel
+        with sequence numbers from first_seq up to end_seq. Messages no longer
+        kept in memory are replayed from the message log, if there is none a
+        notice about the skipped messages is sent instead.
+
+        Parameters:
+        connection: Connection with the client
+        channel (Channel): The channel
+        first_seq (int): Sequence number of the first message
+        end_seq (int): Sequence number following the last message
+        """
+        while first_seq < end_seq:
+            with self.messages_lock:
+                skipped, messages, next_seq = channel.history.read(
+                    first_seq, HISTORY_READ_BATCH, end_seq)
+            if skipped:
+                yield from self.stored_batches(connection, channel, first_seq,
+                                               first_seq + skipped)
+            if not messages:
+                break
+            with self.profiler.span("protocol.encode"):
+                payloads = [m.encode(connection) for m in messages]
+            yield payloads
+            first_seq = next_seq
+
+    def stored_batches(self, connection, channel, first_seq, end_seq):
+        """
+        Yields lists of payloads replayed from the message log, which only
+        stores the default channel.
+
+        Parameters:
+        connection: Connection with the client
+        channel (Channel): The channel
+        first_seq (int): Sequence number of the first message
+        end_seq (int): Sequence number following the last message
+        """
+        stored_seq = end_seq
+        if self.log and channel.name == DEFAULT_CHANNEL:
+            stored_seq = max(first_seq, self.log.first_seq)
+        if stored_seq > first_seq:
+            notice = "{} messages skipped.".format(stored_seq - first_seq)
+            yield [Message("Server", datetime.now(), notice, channel.name).encode(connection)]
+        if stored_seq >= end_seq:
+            return
+        for payloads in self.log.replay(stored_seq, end_seq):
+            if connection.framing == FRAMING_DELIMITED:
+                # Stored payloads still contain the special tags
+                payloads = [connection.encode_message(str(p, encoding="UTF-8"))
+                            for p in payloads]
+            yield payloads
+
+    def flush_timeout(self, connection, client):
+        """
+        Returns how long the writer of a client may wait for more messages before
+        the queued frames have to be flushed, 0 if they are due now, or None if
+        nothing is queued.
+
+        Parameters:
+        connection: Connection with the client
+        client (Client): The client receiving the messages
+        """
+        if not connection.pending_frames:
+            client.flush_deadline = None
+            return None
+        now = monotonic()
+        if client.flush_deadline is None:
+            client.flush_deadline = now + FLUSH_DELAY
+        return max(0, client.flush_deadline - now)
+
+    def writer_thread(self, connection, client):
+        """
+        Sends messages to the client as soon as they are published. Frames are
+        collected for up to FLUSH_DELAY seconds or FLUSH_BYTES bytes, so a burst
+        of messages is sent with a few system calls.
+
+        Parameters:
+        connection: socket wrapped inside the MessageProtocol class,
+        client (Client): The client receiving the messages
+        """
+        try:
+            items = client.outbox.get()
+            while items is not None:
+                for payloads in self.pending_batches(connection, client, items):
+                    connection.queue_encoded(payloads)
+                    if connection.pending_bytes >= FLUSH_BYTES:
+                        with self.profiler.span("protocol.flush"):
+                            connection.flush()
+                timeout = self.flush_timeout(connection, client)
+                if timeout == 0:
+                    with self.profiler.span("protocol.flush"):
+                        connection.flush()
+                    client.flush_deadline = timeout = None
+                if timeout is None:
+                    self.record_fanout(client)
+                items = client.outbox.get(timeout)
+        except ConnectionBroken:
+            # Stops the reading side as well
+            connection.terminate()
+
+    def record_fanout(self, client):
+        """
+        Records how long the messages took from being published until the
+        writer of the client sent them.
+
+        Parameters:
+        client (Client): The client whose queued frames were sent
+        """
+        woken_at = client.outbox.woken_at
+        if woken_at is not None:
+            client.outbox.woken_at = None
+            self.metrics.fanout_latency.record(monotonic() - woken_at)
+
+    def write_stats(self):
+        """
+        Returns the flush counts and sizes of the connected clients, summed up
+        under "total" and for each connection under its Client.stats_key.
+        """
+        with self.messages_lock:
+            clients = list(self.connected_clients)
+        total = WriteStats()
+        stats = {}
+        for client in clients:
+            client_stats = client.connection.write_stats
+            stats[client.stats_key()] = client_stats.as_dict()
+            total.flushes += client_stats.flushes
+            total.frames += client_stats.frames
+            total.bytes += client_stats.bytes
+            total.largest_flush = max(total.largest_flush, client_stats.largest_flush)
+        stats["total"] = total.as_dict()
+        return stats
+
+    def watch(self, connection):
+        """
+        Starts tracking the idle timeout of a new connection.
+
+        Parameters:
+        connection: Connection with a client
+        """
+        with self.messages_lock:
+            self.timers.add(connection, connection.last_read + self.idle_timeout)
+
+    def unwatch(self, connection):
+        """
+        Stops tracking the idle timeout of a closed connection.
+
+        Parameters:
+        connection: Connection with a client
+        """
+        with self.messages_lock:
+            self.timers.remove(connection)
+
+    def expire_idle(self):
+        """
+        Advances the timer wheel, returns the connections that received nothing
+        for idle_timeout seconds. Connections that were active since they were
+        scheduled are scheduled again from their last read, so received data
+        never has to touch the wheel.
+        """
+        now = monotonic()
+        idle = []
+        with self.messages_lock:
+            for connection in self.timers.advance(now):
+                deadline = connection.last_read + self.idle_timeout
+                if deadline <= now:
+                    idle.append(connection)
+                else:
+                    self.timers.add(connection, deadline)
+            self.metrics.reaped += len(idle)
+        return idle
+
+    def reaper_thread(self):
+        """
+        Closes the idle connections once per tick of the timer wheel until the
+        server stops. The reading thread of a closed connection then cleans up.
+        """
+        while not self.stopped.is_set():
+            for connection in self.expire_idle():
+                print("Closing connection idle for {} seconds".format(self.idle_timeout))
+                connection.terminate()
+            self.stopped.wait(max(0, self.timers.next_tick() - monotonic()))
+
+    def connection_totals(self, connection):
+        """
+        Returns the traffic counters of one connection.
+
+        Parameters:
+        connection: Connection with a client
+        """
+        read_stats = connection.read_stats
+        write_stats = connection.write_stats
+        compression_stats = connection.compression_stats
+        return {
+            "bytes_in": read_stats.bytes,
+            "frames_in": read_stats.frames,
+            "pings_in": read_stats.pings,
+            "bytes_out": write_stats.bytes,
+            "frames_out": write_stats.frames,
+            "pings_out": write_stats.pings,
+            "flushes": write_stats.flushes,
+            "compressed_raw_bytes": compression_stats.raw_bytes_in + compression_stats.raw_bytes_out,
+            "compressed_bytes": compression_stats.bytes_in + compression_stats.bytes_out,
+            "compression_cpu_time": compression_stats.cpu_time,
+        }
+
+    def runtime_stats(self):
+        """Returns the number of threads serving the clients"""
+        return {"threads": threading.active_count()}
+
+    def stats(self):
+        """
+        Returns a snapshot of the server statistics: traffic totals and their
+        rates since the previous snapshot, the fan-out latency, the size of the
+        history and the counters and queue depths of every connection.
+        """
+        with self.messages_lock:
+            clients = list(self.connected_clients)
+            history = {"messages": sum(len(c.history) for c in self.channels.values()),
+                       "bytes": sum(c.history.size_bytes for c in self.channels.values()),
+                       "channels": len(self.channels),
+                       "first_seq": self.history.first_seq, "next_seq": self.history.next_seq}
+            totals = dict(self.metrics.closed_totals)
+        totals["published"] = self.metrics.published
+
+        connections = {}
+        for client in clients:
+            connection = client.connection
+            for name, value in self.connection_totals(connection).items():
+                totals[name] = totals.get(name, 0) + value
+            connections[client.stats_key()] = {
+                "read": connection.read_stats.as_dict(),
+                "write": connection.write_stats.as_dict(),
+                # Messages waiting for the writer of the client
+                "backlog": sum(self.channels[name].history.next_seq - cursor
+                               for name, cursor in list(client.cursors.items())
+                               if name in self.channels),
+                "outbox": len(client.outbox.items),
+                "pending_frames": connection.pending_frames,
+                "flow": client.limiter.as_dict(),
+                "compression": (connection.compression_stats.as_dict()
+                                if connection.compression else None),
+            }
+
+        stats = {
+            "time": time(),
+            "uptime": monotonic() - self.metrics.started,
+            "clients": len(clients),
+            "history": history,
+            "totals": totals,
+            "rates": self.metrics.rates(totals),
+            "fanout_latency": self.metrics.fanout_latency.as_dict(),
+            "reaped": self.metrics.reaped,
+            "throttles": self.metrics.throttles,
+            "direct_messages": self.metrics.direct_messages,
+            "sessions": len(self.sessions),
+            "watched": len(self.timers),
+            "connections": connections,
+        }
+        if self.profiler.enabled:
+            stats["spans"] = self.profiler.as_dict()
+        stats.update(self.runtime_stats())
+        return stats
 
     def client_thread(self, connection, ip):   
         """
-        Communicates with one client
+        Communicates with one client. Messages from the client are read here
+        while a separate writer thread sends out the new messages.
         
         Parameters:
         connection: socket wrapped inside the MessageProtocol class,
         ip: The IP address of the connected client
         """
         client = None
+        writer = None
+        self.watch(connection)
         try:            
-            username = connection.get_message()
+            username = connection.accept_negotiation()
             usertag = "{}@{}".format(username, ip)
-            client = Client(usertag)
-            # Keeps track of the newest message that was sent out to the client
-            message_counter = 0
-        
-            joined_message = "{} has joined the chat.".format(usertag)
-            self.messages.append(Message("Server", datetime.now(), joined_message))                             
-            self.connected_clients.append(client)
-            self._notify_observers()
-            
-            while True:
-                # Send new messages to the client
-                data_to_send, message_counter = self.get_new_messages(message_counter)
-                if data_to_send:
-                    connection.send_message(data_to_send)
-                else:
-                    connection.ping()
+            # Clients supporting sessions follow their username with a resume request
+            resume = connection.get_message() if connection.capabilities.get("resume") else None
+            client = self.register(usertag, connection, resume)
+            writer = threading.Thread(target=self.writer_thread, args=(connection, client))
+            writer.start()
 
-                # Receive new messages from the client
+            while True:
+                # Pings only keep the connection alive
                 received_data = connection.get_message()
-                if received_data:           
-                    self.messages.append(Message(usertag, datetime.now(), received_data))                                
+                if received_data is None:
+                    continue
+                # Not reading while the client is over its limits lets TCP
+                # slow it down instead of buffering its messages
+                wait = self.admit(client)
+                while wait and not self.stopped.wait(wait):
+                    wait = self.admit(client)
+                with self.profiler.span("inbound.handle"):
+                    if isinstance(received_data, StreamChunk):
+                        self.handle_chunk(client, received_data)
+                    elif received_data:
+                        self.handle_message(client, received_data)
         except ConnectionBroken as e:
-            self.connected_clients.remove(client)
-            self._notify_observers()
-            connection.terminate()
             print("Client disonnected with error {}".format(str(e)))
+        finally:
+            # Runs for unexpected errors too, so no client is left registered
+            # with a writer waiting for messages
+            self.unwatch(connection)
+            if client:
+                self.unregister(client)
+            connection.terminate()
+            if writer:
+                writer.join()
+
+    def bind(self):
+        """
+        Binds the listening socket. Returns False if the port can't be used.
+        """
+        try:
+            if self.reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.socket.bind((self.host, self.port))
+            self.socket.listen()
+        except OSError as e:
+            print ("Cannot connect to port {}. Error: {}.".format(self.port, str(e)))
+            return False
+        if self.profile_directory:
+            self.profiler.enable(self.profile_directory)
+            # Waiting for the lock shows the contention between the clients
+            self.messages_lock = self.profiler.timed_lock(self.messages_lock, "lock.messages")
+        if self.stats_port is not None or self.stats_file:
+            from metrics import StatsReporter
+            self.reporter = StatsReporter(self.stats, self.stats_port, self.stats_file)
+            if self.reporter.bind():
+                self.reporter.start()
+        self.listening.set()
+        return True
 
     def run(self):
         """
@@ -104,17 +1283,19 @@ class ServerThread(threading.Thread):
         with clients and starts threads for each one.
         """
         self.running = True
-        try:
-            self.socket.bind((SERVER_HOST, SERVER_PORT))
-            self.socket.listen()
-        except OSError as e:                        
-            print ("Cannot connect to port {}. Error: {}.".format(SERVER_PORT, str(e)))
+        if not self.bind():
             return
+        reaper = threading.Thread(target=self.reaper_thread)
+        reaper.start()
 
         connections = []
         threads = []    
         while True:            
-            client_socket, address = self.socket.accept()
+            try:
+                client_socket, address = self.socket.accept()
+            except OSError:
+                # The listening socket was shut down
+                break
             ip = address[0]
             if not self.running:
                 # Loop needs to be stopped here in case of Ctrl+C
@@ -128,41 +1309,148 @@ class ServerThread(threading.Thread):
             thread.start()                
 
         # Clean up code
+        self.socket.close()        
+        if self.drain_timeout:
+            self.drain(self.drain_timeout)
         for connection in connections:
             connection.terminate()        
-        self.socket.close()        
 
         for thread in threads:
             thread.join()
-
+        self.stopped.set()
+        reaper.join()
+        self.presence.flush()
+        self.profiler.capture("spans")
+        if self.reporter:
+            self.reporter.stop()
+        if self.log:
+            self.log.close()
         
-    def stop(self):
-        """ Stops the server."""
+    def stop(self, drain_timeout=0):
+        """
+        Stops the server.
+
+        Parameters:
+        drain_timeout (float): Seconds the clients get to receive the messages
+                               queued for them before being disconnected
+        """
+        self.drain_timeout = drain_timeout
         self.running = False
-        
-        # Make a fake connection to stop blocking on socket.accept
-        # and be able to stop the server
+        self.stopped.set()
+
+        # Shutting the listening socket down stops socket.accept
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+            return
+        except OSError:
+            if self.reuse_port:
+                # A fake connection could reach another process listening on the port
+                return
+
+        # Some systems don't allow shutting down a listening socket, make
+        # a fake connection to stop blocking on socket.accept instead
         with socket.socket() as s:
-            s.connect((CLIENT_CONNECTION_POINT, SERVER_PORT))
+            s.connect((CLIENT_CONNECTION_POINT, self.port))
 
-    def add_observer(self, observer):
+    def drain(self, timeout):
+        """
+        Tells the clients that the server is shutting down and waits up to
+        timeout seconds until everything queued for them was sent.
+
+        Parameters:
+        timeout (float): Longest wait in seconds
+        """
+        self.deliver(Message("Server", datetime.now(), "Server is shutting down."))
+        deadline = monotonic() + timeout
+        while not self.drained() and monotonic() < deadline:
+            sleep(0.05)
+
+    def drained(self):
+        """Returns True if no client has messages waiting to be sent"""
+        with self.messages_lock:
+            for client in self.connected_clients:
+                if client.outbox.items or client.connection.pending_frames:
+                    return False
+                for name, cursor in client.cursors.items():
+                    if cursor < self.channels[name].history.next_seq:
+                        return False
+        return True
+
+    def capture(self, kind, seconds=PROFILE_SAMPLE_SECONDS, done=None):
         """
-        Adds an observer that will be notified when new messages from the server
-        arrive
+        Writes a profiling capture in a background thread, see Profiler.capture.
 
         Parameters:
-        observer: An object with a 'notify' method
+        kind (str): "cpu", "memory" or "spans"
+        seconds (float): Duration of a cpu capture
+        done (callable): Called with the path of the file, or None if nothing
+                         was written, in the thread owning the outboxes
         """
-        self.observers.append(observer)
+        def run():
+            extra = self.memory_sizes() if kind == "memory" else None
+            path = self.profiler.capture(kind, seconds, extra)
+            if done:
+                self.call_soon(done, path)
+        threading.Thread(target=run, daemon=True).start()
 
-    def _notify_observers(self):
+    def memory_sizes(self):
+        """Returns the bytes held by the history, the search index and the client buffers"""
+        with self.messages_lock:
+            clients = list(self.connected_clients)
+            sizes = {
+                "history": sum(c.history.size_bytes for c in self.channels.values()),
+                # Postings are 8 byte integers
+                "index": sum(c.index.postings * 8 for c in self.channels.values()),
+            }
+        sizes["outboxes"] = sum(client.outbox.stream_bytes for client in clients)
+        sizes["pending_frames"] = sum(client.connection.pending_bytes for client in clients)
+        return sizes
+
+    def call_soon(self, callback, *args):
         """
-        Notifies all observers that the connected client list has changed.
+        Calls a callback from another thread in the thread owning the outboxes,
+        which for this engine can be any thread.
+
+        Parameters:
+        callback (callable): The callback
+        args: Arguments of the callback
         """
-        for observer in self.observers:
-            try:
-                observer.notify([c.usertag for c in self.connected_clients])
-            except Exception:
-                pass
-                # If observer raises some kind of exception
-                # just ignore it
\ No newline at end of file
+        callback(*args)
+
+    def add_observer(self, observer):
+        """
+        Adds an observer that will be notified when clients connect or disconnect,
+        see PresenceNotifier.
+
+        Parameters:
+        observer: An object with a 'notify_presence' or 'notify' method
+        """
+        self.presence.add_observer(observer)
+
+    def connected_usertags(self):
+        """Returns the usertags of the connected clients"""
+        with self.messages_lock:
+            return self.connected_clients.usertags()
+
+def create_server(engine=SERVER_ENGINE, host=SERVER_HOST, port=SERVER_PORT,
+                  log_directory=LOG_DIRECTORY, workers=SERVER_WORKERS):
+    """
+    Creates a server thread running the chosen engine.
+
+    Parameters:
+    engine (str): "thread" for a thread per client, "asyncio" for a single event loop
+    host (str): Interface to listen on, empty for all interfaces
+    port (int): Port to listen on
+    log_directory (str): Directory of the persistent message log or None
+    workers (int): Number of worker processes sharing the port, 1 runs the server
+                   in this process
+    """
+    if workers > 1:
+        from workers import MultiProcessServer
+        return MultiProcessServer(engine, host, port, workers)
+    if engine == "asyncio":
+        from asyncServerThread import AsyncServerThread
+        return AsyncServerThread(host, port, log_directory)
+    if engine == "thread":
+        return ServerThread(host, port, log_directory)
+    raise ValueError("Unknown server engine {}".format(engine))
@@ -1,10 +1,37 @@
 import protocol
-import server
-import client
+import serverThread
+import clientThread
+import messageHistory
+import messageLog
+import benchmark
+import protocolBenchmark
+import asyncClient
+import metrics
+import presence
+import timerWheel
+import channels
+import flowControl
+import profiler
+import daemon
+from const import PING_DELAY, CLIENT_MESSAGE_RATE, CLIENT_MESSAGE_BURST
 
 import unittest
+import unittest.mock
 import socket
 import random
+import threading
+import time
+import tempfile
+import json
+import asyncio
+import shutil
+import os
+import signal
+import subprocess
+import sys
+import contextlib
+import io
+from datetime import datetime, timedelta
 
 class TestProtocol(unittest.TestCase):
     def setUp(self):        
@@ -61,5 +88,1178 @@ class TestProtocol(unittest.TestCase):
         with self.assertRaises(protocol.ConnectionBroken):
             self.connection2.get_message()        
 
+class TestLengthFraming(TestProtocol):
+    def setUp(self):
+        socket1, socket2 = socket.socketpair()
+        self.connection1 = protocol.MessageProtocol(socket1, framing=protocol.FRAMING_LENGTH)
+        self.connection2 = protocol.MessageProtocol(socket2, framing=protocol.FRAMING_LENGTH)
+
+    def test_escaping_special(self):
+        # Length prefixed frames don't need the special tags removed
+        self.connection1.send_message("<<PING>>")
+        self.assertEqual(self.connection2.get_message(), "<<PING>>")
+        self.connection2.send_message("<<END>>")
+        self.assertEqual(self.connection1.get_message(), "<<END>>")
+
+    def test_send_encoded(self):
+        payloads = [self.connection1.encode_message(m) for m in ("a", "", "привет")]
+        self.connection1.send_encoded(payloads)
+        self.assertEqual(self.connection2.get_message(), "a")
+        self.assertEqual(self.connection2.get_message(), "")
+        self.assertEqual(self.connection2.get_message(), "привет")
+
+    def test_coalesced_flush(self):
+        for i in range(100):
+            self.connection1.queue_message(str(i))
+        self.connection1.ping()
+        for i in range(100):
+            self.assertEqual(self.connection2.get_message(), str(i))
+        self.assertIsNone(self.connection2.get_message())
+        stats = self.connection1.write_stats
+        self.assertEqual((stats.flushes, stats.frames), (1, 101))
+
+    def test_ping(self):
+        self.connection1.ping()
+        self.connection1.send_message("Hello")
+        self.assertIsNone(self.connection2.get_message())
+        self.assertEqual(self.connection2.get_message(), "Hello")
+
+
+class TestFrameBuffer(unittest.TestCase):
+    def feed(self, frames, data, chunk_size):
+        received = []
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i + chunk_size]
+            with frames.get_buffer() as buffer:
+                buffer[:len(chunk)] = chunk
+            frames.buffer_updated(len(chunk))
+            frame = frames.next_frame()
+            while frame is not None:
+                received.append(frame)
+                frame = frames.next_frame()
+        return received
+
+    def test_coalesced_frames(self):
+        for framing in (protocol.FRAMING_DELIMITED, protocol.FRAMING_LENGTH):
+            frames = protocol.FrameBuffer(framing=framing)
+            data = b"".join(frames.pack(protocol.FRAME_DATA, bytes([65 + i]) * i)
+                            for i in range(20))
+            data += frames.pack(protocol.FRAME_PING, b"")
+            received = self.feed(frames, data, len(data))
+            self.assertEqual(len(received), 21)
+            self.assertEqual(received[5], (protocol.FRAME_DATA, b"FFFFF"))
+            self.assertEqual(received[-1], (protocol.FRAME_PING, b""))
+
+    def test_split_multibyte_characters(self):
+        for framing in (protocol.FRAMING_DELIMITED, protocol.FRAMING_LENGTH):
+            frames = protocol.FrameBuffer(buffer_size=4, framing=framing)
+            payload = "привет мир".encode("UTF-8") * 50
+            data = frames.pack(protocol.FRAME_DATA, payload) * 3
+            received = self.feed(frames, data, 3)
+            self.assertEqual(received, [(protocol.FRAME_DATA, payload)] * 3)
+
+    def fill(self, frames, data):
+        # Writes as much as the free space takes, like recv_into
+        received = []
+        while data:
+            with frames.get_buffer() as buffer:
+                size = min(len(buffer), len(data))
+                buffer[:size] = data[:size]
+            frames.buffer_updated(size)
+            data = data[size:]
+            frame = frames.next_frame()
+            if frame is not None:
+                received.append(frame)
+        return received
+
+    def test_header_doesnt_allocate_frame(self):
+        frames = protocol.FrameBuffer(framing=protocol.FRAMING_LENGTH)
+        header = protocol.FRAME_HEADER.pack(protocol.FRAME_DATA, protocol.MAX_FRAME_SIZE)
+        self.fill(frames, header)
+        with frames.get_buffer():
+            pass
+        self.assertLessEqual(len(frames.buffer), 2 * frames.buffer_size)
+
+    def test_buffer_grows_and_shrinks(self):
+        frames = protocol.FrameBuffer(framing=protocol.FRAMING_LENGTH)
+        payload = bytes(2**20)
+        received = self.fill(frames, frames.pack(protocol.FRAME_DATA, payload))
+        self.assertEqual(received, [(protocol.FRAME_DATA, payload)])
+        self.assertEqual(len(frames.buffer), frames.buffer_size)
+
+
+class TestMessage(unittest.TestCase):
+    def test_encoded_once(self):
+        delimited = protocol.MessageProtocol(None)
+        length = protocol.MessageProtocol(None, framing=protocol.FRAMING_LENGTH)
+        message = serverThread.Message("user", datetime(2020, 1, 1, 12, 5, 9), "hi <<END>>")
+        self.assertEqual(str(message), "[12:05:09]user:hi <<END>>")
+        self.assertIs(message.encode(length), message.encode(length))
+        self.assertIs(message.encode(delimited), message.encode(delimited))
+        self.assertEqual(message.encode(length), b"[12:05:09]user:hi <<END>>")
+        self.assertEqual(message.encode(delimited), b"[12:05:09]user:hi ")
+        with self.assertRaises(AttributeError):
+            message.extra = None
+
+
+class TestMessageHistory(unittest.TestCase):
+    def message(self, text):
+        return serverThread.Message("user", datetime(2020, 1, 1), text)
+
+    def test_count_cap(self):
+        history = messageHistory.MessageHistory(max_messages=4, max_bytes=2**20)
+        for i in range(10):
+            self.assertEqual(history.append(self.message(str(i))), i)
+        self.assertEqual(len(history), 4)
+        skipped, messages, cursor = history.read(3)
+        self.assertEqual(skipped, 3)
+        self.assertEqual([m.message for m in messages], ["6", "7", "8", "9"])
+        self.assertEqual(cursor, 10)
+        self.assertEqual(history.read(10), (0, [], 10))
+
+    def test_byte_cap(self):
+        history = messageHistory.MessageHistory(max_messages=100, max_bytes=100)
+        for i in range(10):
+            history.append(self.message("x" * 20))
+        self.assertLessEqual(history.size_bytes, 100)
+        self.assertEqual(len(history), 100 // history.sizes[0])
+
+    def test_read_limit(self):
+        history = messageHistory.MessageHistory(max_messages=10, max_bytes=2**20)
+        for i in range(5):
+            history.append(self.message(str(i)))
+        skipped, messages, cursor = history.read(1, limit=2)
+        self.assertEqual((skipped, cursor), (0, 3))
+        self.assertEqual([m.seq for m in messages], [1, 2])
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.channel = channels.Channel("test", messageHistory.MessageHistory(100, 2**20))
+        self.start = datetime(2020, 1, 1)
+        for i in range(300):
+            user = "alice@1.2.3.4" if i % 2 else "bob@1.2.3.4"
+            text = "Message {} about {}".format(i, "cats" if i % 3 else "Dogs and cats")
+            self.channel.append(serverThread.Message(user, self.start + timedelta(minutes=i),
+                                                     text))
+
+    def test_terms_and_user(self):
+        index = self.channel.index
+        self.assertEqual(index.search("dogs", limit=3), [297, 294, 291])
+        self.assertEqual(index.search("CATS dogs", "alice", limit=3), [297, 291, 285])
+        self.assertEqual(index.search("message 250"), [250])
+        self.assertEqual(index.search("horses"), [])
+
+    def test_username_with_at(self):
+        # Indexed under the same username as the registry of connected clients
+        self.channel.append(serverThread.Message("Eve@Home@1.2.3.4", self.start, "Hello"))
+        self.assertEqual(self.channel.index.search(user="eve@home@5.6.7.8"), [300])
+        self.assertEqual(self.channel.index.search(user="eve"), [])
+        self.assertEqual(presence.username_of("Eve@Home@1.2.3.4"), "Eve@Home")
+
+    def test_time_range_and_pages(self):
+        index = self.channel.index
+        until = self.start + timedelta(minutes=290)
+        self.assertEqual(index.search(until=until, limit=2), [289, 288])
+        since = self.start + timedelta(minutes=295)
+        self.assertEqual(index.search("cats", since=since), [299, 298, 297, 296, 295])
+        self.assertEqual(index.search("cats", since=since, before=297), [296, 295])
+
+    def test_follows_history_retention(self):
+        index = self.channel.index
+        self.assertEqual(len(index), 100)
+        self.assertEqual(index.search("message 150"), [])
+        self.assertEqual(index.search(limit=1000)[-1], 200)
+        # Postings of dropped messages are compacted away
+        self.assertLessEqual(index.postings, 2 * 100 * 6)
+        self.assertNotIn("50", index.terms)
+        index.compact()
+        self.assertNotIn("150", index.terms)
+        self.assertEqual(len(index.times), 100)
+
+
+class TestChannel(unittest.TestCase):
+    def test_history_byte_cap(self):
+        channel = channels.Channel("room")
+        text = "x" * 2**10
+        for i in range(1000):
+            channel.append(serverThread.Message("user", datetime(2020, 1, 1), text))
+        self.assertLessEqual(channel.history.size_bytes, channels.CHANNEL_HISTORY_BYTES)
+        self.assertLess(len(channel.history), 1000)
+        self.assertEqual(channel.history.next_seq, 1000)
+
+
+class TestMessageLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, log, count, start=0):
+        history = messageHistory.MessageHistory(start_seq=start)
+        for i in range(start, start + count):
+            message = serverThread.Message("user", datetime.fromtimestamp(1000 + i), str(i))
+            history.append(message)
+            log.append(message)
+
+    def replayed(self, log, first_seq, end_seq):
+        return [str(p, "UTF-8") for batch in log.replay(first_seq, end_seq, batch_size=7)
+                for p in batch]
+
+    def test_replay_across_segments(self):
+        log = messageLog.MessageLog(self.directory, segment_size=256, index_interval=4)
+        self.write(log, 100)
+        self.assertGreater(len(log.segments), 1)
+        replayed = self.replayed(log, 35, 60)
+        self.assertEqual(len(replayed), 25)
+        self.assertTrue(replayed[0].endswith("user:35"))
+        self.assertTrue(replayed[-1].endswith("user:59"))
+        self.assertEqual(log.seq_at(1000 + 42.5), 43)
+        self.assertEqual(log.seq_at(0), 0)
+        self.assertEqual(log.seq_at(1000 + log.segments[1].first_seq),
+                         log.segments[1].first_seq)
+        self.assertEqual(log.seq_at(1000 + 100), 100)
+        log.close()
+
+    def test_reopen_and_recover(self):
+        log = messageLog.MessageLog(self.directory, segment_size=256, index_interval=4)
+        self.write(log, 50)
+        log.close()
+        # Simulate a record cut off by a crash
+        with open(log.segments[-1].path, "ab") as log_file:
+            log_file.write(messageLog.RECORD_HEADER.pack(50, 1050, 100) + b"partial")
+
+        log = messageLog.MessageLog(self.directory, segment_size=256, index_interval=4)
+        self.assertEqual(log.next_seq, 50)
+        self.write(log, 10, start=50)
+        replayed = self.replayed(log, 45, 60)
+        self.assertEqual(len(replayed), 15)
+        self.assertTrue(replayed[-1].endswith("user:59"))
+        log.close()
+
+    def test_recover_torn_indexed_record(self):
+        log = messageLog.MessageLog(self.directory, index_interval=4)
+        self.write(log, 10)
+        log.close()
+        segment = log.segments[-1]
+        self.assertEqual(segment.index_seqs, [0, 4, 8])
+        # The crash hit the record the last index entry points to
+        with open(segment.path, "r+b") as log_file:
+            log_file.truncate(segment.index_offsets[-1] + 5)
+
+        log = messageLog.MessageLog(self.directory, index_interval=4)
+        self.assertEqual(log.next_seq, 8)
+        self.assertEqual(log.segments[-1].index_seqs, [0, 4])
+        self.write(log, 2, start=8)
+        self.assertEqual(log.segments[-1].index_seqs, [0, 4, 8])
+        replayed = self.replayed(log, 0, 10)
+        self.assertEqual(len(replayed), 10)
+        self.assertTrue(replayed[-1].endswith("user:9"))
+        log.close()
+
+        log = messageLog.MessageLog(self.directory, index_interval=4)
+        self.assertEqual(log.next_seq, 10)
+        log.close()
+
+
+class TestNegotiation(unittest.TestCase):
+    def setUp(self):
+        socket1, socket2 = socket.socketpair()
+        self.client = protocol.MessageProtocol(socket1)
+        self.server = protocol.MessageProtocol(socket2)
+
+    def tearDown(self):
+        self.client.terminate()
+        self.server.terminate()
+
+    def test_negotiate_length_framing(self):
+        server_thread = threading.Thread(target=lambda: self.received.append(
+            self.server.accept_negotiation()))
+        self.received = []
+        server_thread.start()
+        agreed = self.client.negotiate()
+        self.client.send_message("username")
+        server_thread.join()
+        self.assertEqual(agreed, {"framing": protocol.FRAMING_LENGTH, "compression": "zlib",
+                                  "streaming": "chunks", "resume": "seq"})
+        self.assertEqual(self.server.framing, protocol.FRAMING_LENGTH)
+        self.assertEqual(self.received, ["username"])
+
+    def test_compression_needs_length_framing(self):
+        offered = {"framing": [protocol.FRAMING_DELIMITED], "compression": ["zlib"]}
+        self.assertEqual(protocol.choose_capabilities(offered),
+                         {"framing": protocol.FRAMING_DELIMITED})
+
+    def test_without_negotiation(self):
+        self.client.send_message("username")
+        self.assertEqual(self.server.accept_negotiation(), "username")
+        self.assertEqual(self.server.framing, protocol.FRAMING_DELIMITED)
+
+class TestCompression(TestLengthFraming):
+    def setUp(self):
+        super().setUp()
+        for connection in (self.connection1, self.connection2):
+            connection.apply_capabilities({"framing": protocol.FRAMING_LENGTH,
+                                           "compression": "zlib"})
+
+    def test_large_message_compressed(self):
+        message = "compressible text " * 1000
+        self.connection1.send_message(message)
+        self.assertEqual(self.connection2.get_message(), message)
+        stats = self.connection1.compression_stats
+        self.assertEqual(stats.frames_out, 1)
+        self.assertLess(stats.bytes_out, stats.raw_bytes_out / 10)
+        self.assertEqual(self.connection2.compression_stats.raw_bytes_in, stats.raw_bytes_out)
+
+    def test_small_message_uncompressed(self):
+        self.connection1.send_message("Hi")
+        self.assertEqual(self.connection2.get_message(), "Hi")
+        self.assertEqual(self.connection1.compression_stats.frames_out, 0)
+
+    def test_batch_compressed_together(self):
+        messages = ["Message number {}".format(i) for i in range(100)]
+        for message in messages:
+            self.connection1.queue_message(message)
+        self.connection1.ping()
+        self.assertEqual(self.connection1.compression_stats.frames_out, 1)
+        received = [self.connection2.get_message() for _ in range(101)]
+        self.assertEqual(received, messages + [None])
+        # The context is kept between flushes
+        self.connection1.send_message(messages[0] * 40)
+        self.assertEqual(self.connection2.get_message(), messages[0] * 40)
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        socket1, socket2 = socket.socketpair()
+        self.connection1 = protocol.MessageProtocol(socket1, framing=protocol.FRAMING_LENGTH)
+        self.connection2 = protocol.MessageProtocol(socket2, framing=protocol.FRAMING_LENGTH)
+
+    def tearDown(self):
+        self.connection1.terminate()
+        self.connection2.terminate()
+
+    def test_stream_roundtrip(self):
+        message = "привет " * protocol.STREAM_CHUNK_SIZE
+        sender = threading.Thread(target=self.connection1.send_stream, args=([message],))
+        sender.start()
+        first = self.connection2.get_message()
+        self.assertIsInstance(first, protocol.StreamChunk)
+        received = b"".join(self.connection2.iter_stream(first))
+        sender.join()
+        self.assertEqual(str(received, encoding="UTF-8"), message)
+
+    def test_interleaved_messages(self):
+        chunks = list(self.connection1.stream_chunks([b"abc" * 10]))
+        self.connection1.queue_chunk(chunks[0])
+        self.connection1.queue_message("between")
+        self.connection1.queue_chunk(chunks[1])
+        self.connection1.flush()
+        first = self.connection2.get_message()
+        self.assertEqual(b"".join(self.connection2.iter_stream(first)), b"abc" * 10)
+        # Messages received while reading the stream aren't lost
+        self.assertEqual(self.connection2.get_message(), "between")
+
+    def test_interleaved_data_bounded(self):
+        chunks = list(self.connection1.stream_chunks([b"abc" * 10]))
+        other = protocol.StreamChunk(chunks[0].stream_id + 1, b"y" * protocol.STREAM_CHUNK_SIZE)
+        self.connection1.queue_chunk(chunks[0])
+        def send():
+            try:
+                for _ in range(protocol.STREAM_SKIP_BYTES // protocol.STREAM_CHUNK_SIZE + 1):
+                    self.connection1.queue_chunk(other)
+                    self.connection1.flush()
+            except protocol.ConnectionBroken:
+                pass
+        sender = threading.Thread(target=send)
+        sender.start()
+        first = self.connection2.get_message()
+        with self.assertRaises(protocol.ConnectionBroken):
+            b"".join(self.connection2.iter_stream(first))
+        self.connection2.terminate()
+        sender.join()
+
+    def test_streaming_needs_length_framing(self):
+        offered = {"framing": [protocol.FRAMING_DELIMITED], "streaming": ["chunks"]}
+        self.assertEqual(protocol.choose_capabilities(offered),
+                         {"framing": protocol.FRAMING_DELIMITED})
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+class MessageCollector():
+    def __init__(self):
+        self.messages = []
+
+    def notify(self, messages):
+        self.messages.extend(messages)
+
+    def wait_for(self, text, timeout=5, count=1):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if sum(text in m for m in self.messages) >= count:
+                return True
+            time.sleep(0.05)
+        return False
+
+class UserListCollector():
+    def __init__(self):
+        self.latest = []
+
+    def notify(self, clients):
+        self.latest = list(clients)
+
+
+class TestServer(unittest.TestCase):
+    engine = "thread"
+
+    def setUp(self):
+        self.clients = []
+        self.start_server()
+
+    def tearDown(self):
+        self.stop_server()
+
+    def start_server(self, log_directory=None, stats_file=None, profile_directory=None):
+        self.port = free_port()
+        self.server = serverThread.create_server(self.engine, "localhost", self.port,
+                                                 log_directory)
+        self.server.configure(profile_directory=profile_directory)
+        if stats_file:
+            self.server.stats_port = 0
+            self.server.stats_file = stats_file
+        self.users = MessageCollector()
+        self.server.add_observer(self.users)
+        self.server.start()
+        self.assertTrue(self.server.listening.wait(5))
+
+    def stop_server(self):
+        for c in self.clients:
+            c.stop()
+            c.join(5)
+        self.clients = []
+        if self.server:
+            self.server.stop()
+            self.server.join(5)
+            self.server = None
+
+    def connect(self, username):
+        collector = MessageCollector()
+        client = clientThread.ClientThread(username, "localhost", self.port)
+        client.add_observer(collector)
+        client.start()
+        self.clients.append(client)
+        return client, collector
+
+    def test_broadcast(self):
+        alice, alice_messages = self.connect("alice")
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 has joined"))
+        bob, bob_messages = self.connect("bob")
+        self.assertTrue(alice_messages.wait_for("bob@127.0.0.1 has joined"))
+        alice.send_message("Hello bob")
+        self.assertTrue(bob_messages.wait_for("alice@127.0.0.1:Hello bob"))
+        self.assertTrue(self.users.wait_for("bob@127.0.0.1"))
+        self.assertEqual(self.users.messages[-1], "bob@127.0.0.1")
+        stats = self.server.write_stats()
+        self.assertGreater(stats["total"]["frames"], 0)
+        self.assertIn("alice@127.0.0.1#1", stats)
+
+    def test_push_without_waiting_for_ping(self):
+        alice, alice_messages = self.connect("alice")
+        bob, bob_messages = self.connect("bob")
+        self.assertTrue(alice_messages.wait_for("bob@127.0.0.1 has joined"))
+        self.assertTrue(bob_messages.wait_for("bob@127.0.0.1 has joined"))
+        for i in range(5):
+            alice.send_message("Message {}".format(i))
+        # Delivery doesn't depend on the ping delay of the receiving client
+        self.assertTrue(bob_messages.wait_for("Message 4", timeout=min(PING_DELAY / 2, 0.5)))
+
+    def test_history_survives_restart(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.stop_server()
+        self.start_server(directory)
+        alice, alice_messages = self.connect("alice")
+        alice.send_message("Stored message")
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1:Stored message"))
+
+        self.stop_server()
+        self.start_server(directory)
+        bob, bob_messages = self.connect("bob")
+        self.assertTrue(bob_messages.wait_for("alice@127.0.0.1:Stored message"))
+        bob.send_message("/history 2")
+        self.assertTrue(bob_messages.wait_for("alice@127.0.0.1:Stored message", count=2))
+
+    def test_stats(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        stats_file = "{}/stats.jsonl".format(directory)
+        self.stop_server()
+        self.start_server(stats_file=stats_file)
+        alice, alice_messages = self.connect("alice")
+        alice.send_message("Counted message")
+        self.assertTrue(alice_messages.wait_for("Counted message"))
+        # A second session of the same user is reported separately
+        self.connect("alice")
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 has joined", count=2))
+
+        stats = metrics.read_stats("localhost", self.server.reporter.port)
+        self.assertEqual(stats["clients"], 2)
+        self.assertEqual(sorted(stats["connections"]), ["alice@127.0.0.1#1", "alice@127.0.0.1#2"])
+        self.assertEqual(stats["totals"]["published"], 3)
+        self.assertGreater(stats["totals"]["frames_in"], 0)
+        self.assertGreater(stats["fanout_latency"]["count"], 0)
+        connection = stats["connections"]["alice@127.0.0.1#1"]
+        self.assertEqual(connection["backlog"], 0)
+        self.assertGreater(connection["write"]["bytes"], 0)
+        self.assertIsNotNone(connection["compression"])
+
+        self.stop_server()
+        with open(stats_file) as f:
+            dumped = [json.loads(line) for line in f]
+        self.assertEqual(dumped[-1]["totals"]["published"], 3)
+
+    def test_channels(self):
+        alice, alice_messages = self.connect("alice")
+        bob, bob_messages = self.connect("bob")
+        self.assertTrue(alice_messages.wait_for("bob@127.0.0.1 has joined"))
+        alice.send_message("/join room")
+        self.assertTrue(alice_messages.wait_for("#room Server:alice@127.0.0.1 has joined #room."))
+        alice.send_message("Only for the room")
+        self.assertTrue(alice_messages.wait_for("#room alice@127.0.0.1:Only for the room"))
+        bob.send_message("In general")
+        self.assertTrue(alice_messages.wait_for("]bob@127.0.0.1:In general"))
+        self.assertFalse(bob_messages.wait_for("Only for the room", timeout=0.2))
+
+        # Joining sends the history of the channel
+        bob.send_message("/join #room")
+        self.assertTrue(bob_messages.wait_for("#room alice@127.0.0.1:Only for the room"))
+        self.assertEqual(self.server.stats()["history"]["channels"], 2)
+        bob.send_message("/leave")
+        self.assertTrue(alice_messages.wait_for("bob@127.0.0.1 has left #room."))
+        bob.send_message("Back in general")
+        self.assertTrue(alice_messages.wait_for("]bob@127.0.0.1:Back in general"))
+        bob.send_message("/leave general")
+        self.assertTrue(bob_messages.wait_for("can't be left"))
+
+    def test_empty_channels_dropped(self):
+        alice, alice_messages = self.connect("alice")
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 has joined"))
+        with unittest.mock.patch.object(serverThread, "MAX_CHANNELS", 4):
+            for i in range(10):
+                alice.send_message("/join a{}".format(i))
+                alice.send_message("/leave a{}".format(i))
+            alice.send_message("/join last")
+            self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 has joined #last."))
+        self.assertFalse(any("Cannot create" in m for m in alice_messages.messages))
+        self.assertEqual(sorted(self.server.channels), ["general", "last"])
+
+    def test_streamed_message(self):
+        alice, alice_messages = self.connect("alice")
+        bob, bob_messages = self.connect("bob")
+        self.assertTrue(alice_messages.wait_for("bob@127.0.0.1 has joined"))
+        self.assertTrue(bob_messages.wait_for("bob@127.0.0.1 has joined"))
+        message = "x" * (clientThread.STREAM_THRESHOLD + 1)
+        alice.send_message(message)
+        # Streams are saved to a file, only their beginning is shown
+        self.assertTrue(bob_messages.wait_for("bytes in total, saved to ", timeout=10))
+        self.assertTrue(any("]alice@127.0.0.1:xxxx" in m for m in bob_messages.messages))
+        note = [m for m in bob_messages.messages if "saved to" in m][0]
+        path = note.rpartition("saved to ")[2].rstrip("]")
+        self.addCleanup(os.remove, path)
+        with open(path, encoding="UTF-8") as saved:
+            self.assertTrue(saved.read().endswith("]alice@127.0.0.1:" + message))
+        self.assertEqual(self.server.metrics.published, 2)
+
+    def test_resume_session(self):
+        alice, alice_messages = self.connect("alice")
+        bob, bob_messages = self.connect("bob")
+        self.assertTrue(alice_messages.wait_for("bob@127.0.0.1 has joined"))
+        bob.send_message("/join room")
+        self.assertTrue(bob_messages.wait_for("#room Server:bob@127.0.0.1 has joined #room."))
+        deadline = time.monotonic() + 5
+        while "room" not in bob.client.cursors and time.monotonic() < deadline:
+            time.sleep(0.05)
+        token = bob.client.token
+        self.assertIsNotNone(token)
+
+        # Drop the connection, the client reconnects by itself
+        bob.loop.call_soon_threadsafe(bob.client.connection.terminate)
+        self.assertTrue(bob_messages.wait_for("Client disonnected"))
+        alice.send_message("While away")
+        self.assertTrue(bob_messages.wait_for("alice@127.0.0.1:While away"))
+        alice.send_message("/join room")
+        alice.send_message("Room message")
+        self.assertTrue(bob_messages.wait_for("#room alice@127.0.0.1:Room message"))
+        self.assertEqual(bob.client.token, token)
+        # Only the delta was sent and nobody saw the reconnection as a new join
+        self.assertEqual(sum("bob@127.0.0.1 has joined" in m for m in bob_messages.messages), 2)
+        self.assertEqual(sum("alice@127.0.0.1 has joined the" in m
+                             for m in bob_messages.messages), 1)
+        self.assertEqual(sum("bob@127.0.0.1 has joined the" in m
+                             for m in alice_messages.messages), 1)
+
+    def test_resume_alone_in_channel(self):
+        bob, bob_messages = self.connect("bob")
+        bob.send_message("/join room")
+        for i in range(3):
+            bob.send_message("Room {}".format(i))
+        self.assertTrue(bob_messages.wait_for("#room bob@127.0.0.1:Room 2"))
+        deadline = time.monotonic() + 5
+        while bob.client.cursors.get("room") != 4 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.server.channels["room"].history.next_seq, 4)
+
+        bob.loop.call_soon_threadsafe(bob.client.connection.terminate)
+        self.assertTrue(bob_messages.wait_for("Client disonnected"))
+        deadline = time.monotonic() + 5
+        while (self.server.sessions or not len(self.server.connected_clients)) \
+                and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # The channel and its history outlived the resume
+        self.assertEqual(self.server.channels["room"].history.next_seq, 4)
+        bob.send_message("/history 10")
+        self.assertTrue(bob_messages.wait_for("#room bob@127.0.0.1:Room 0", count=2))
+
+    def test_search(self):
+        alice, alice_messages = self.connect("alice")
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 has joined"))
+        for text in ("Lunch at noon", "Meeting moved", "Lunch is ready"):
+            alice.send_message(text)
+        self.assertTrue(alice_messages.wait_for("Lunch is ready"))
+        alice.send_message("/search lunch from:alice")
+        self.assertTrue(alice_messages.wait_for("2 result(s) in #general"))
+        results = alice_messages.messages[-2:]
+        self.assertIn("Lunch is ready", results[0])
+        self.assertIn("Lunch at noon", results[1])
+        alice.send_message("/search since:soon")
+        self.assertTrue(alice_messages.wait_for("Usage: /search"))
+
+    def test_direct_message(self):
+        alice, alice_messages = self.connect("alice")
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 has joined"))
+        bob, bob_messages = self.connect("bob")
+        carol, carol_messages = self.connect("carol")
+        self.assertTrue(alice_messages.wait_for("carol@127.0.0.1 has joined"))
+        self.assertTrue(bob_messages.wait_for("carol@127.0.0.1 has joined"))
+        published = self.server.metrics.published
+        alice.send_message("/msg bob Just between us")
+        self.assertTrue(bob_messages.wait_for("alice@127.0.0.1 to bob:Just between us"))
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 to bob:Just between us"))
+        alice.send_message("/msg nobody Hello?")
+        self.assertTrue(alice_messages.wait_for("Server error: no_such_user nobody"))
+        carol.send_message("Public")
+        self.assertTrue(bob_messages.wait_for("Public"))
+        self.assertFalse(any("Just between us" in m for m in carol_messages.messages))
+        self.assertEqual(self.server.metrics.published, published + 1)
+        self.assertEqual(self.server.metrics.direct_messages, 1)
+        # A username containing "@" is found when no usertag matches
+        eve, eve_messages = self.connect("eve@home")
+        self.assertTrue(eve_messages.wait_for("eve@home@127.0.0.1 has joined"))
+        alice.send_message("/msg eve@home Found you")
+        self.assertTrue(eve_messages.wait_for("alice@127.0.0.1 to eve@home:Found you"))
+
+    def test_flow_control(self):
+        self.stop_server()
+        self.start_server()
+        alice, alice_messages = self.connect("alice")
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 has joined"))
+        self.server.connected_clients.find("alice@127.0.0.1")[0].limiter = \
+            flowControl.FlowLimiter(10, 2, None, None, time.monotonic())
+        started = time.monotonic()
+        for i in range(6):
+            alice.send_message("Limited {}".format(i))
+        self.assertTrue(alice_messages.wait_for("Limited 5"))
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertGreater(self.server.metrics.throttles, 0)
+        flow = self.server.stats()["connections"]["alice@127.0.0.1#1"]["flow"]
+        self.assertGreater(flow["throttled_time"], 0)
+
+    def test_byte_limit_counts_bytes(self):
+        alice, alice_messages = self.connect("alice")
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 has joined"))
+        limiter = flowControl.FlowLimiter(None, None, 1, 10**6, time.monotonic())
+        self.server.connected_clients.find("alice@127.0.0.1")[0].limiter = limiter
+        # 100 characters, 200 bytes in UTF-8
+        alice.send_message("é" * 100)
+        self.assertTrue(alice_messages.wait_for("é" * 100))
+        self.assertAlmostEqual(10**6 - limiter.bytes.tokens, 200, delta=5)
+
+    def test_profile(self):
+        alice, alice_messages = self.connect("alice")
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 has joined"))
+        alice.send_message("/profile spans")
+        self.assertTrue(alice_messages.wait_for("Profiling is disabled."))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.stop_server()
+        self.start_server(profile_directory=directory)
+        alice, alice_messages = self.connect("alice")
+        self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 has joined"))
+        alice.send_message("Profiled")
+        self.assertTrue(alice_messages.wait_for("Profiled"))
+        for command in ("spans", "cpu 0.1", "memory 0.1"):
+            alice.send_message("/profile " + command)
+            self.assertTrue(alice_messages.wait_for("Profile written to"))
+            path = alice_messages.messages[-1].rpartition("Profile written to ")[2]
+            self.assertGreater(os.path.getsize(path), 0)
+            alice_messages.messages.clear()
+            if command == "spans":
+                with open(path) as spans_file:
+                    spans = json.load(spans_file)
+                self.assertGreater(spans["fanout.deliver"]["count"], 0)
+                self.assertGreater(spans["lock.messages"]["count"], 0)
+        self.assertIn("inbound.handle", self.server.stats()["spans"])
+
+    def test_invalid_payload_disconnects(self):
+        with socket.create_connection(("localhost", self.port)) as raw:
+            raw.sendall(b"mallory<<END>>")
+            deadline = time.monotonic() + 5
+            while (time.monotonic() < deadline
+                   and "mallory@127.0.0.1" not in self.server.connected_usertags()):
+                time.sleep(0.01)
+            self.assertIn("mallory@127.0.0.1", self.server.connected_usertags())
+            raw.sendall(b"\xff\xfe bad<<END>>")
+        deadline = time.monotonic() + 5
+        while (time.monotonic() < deadline
+               and "mallory@127.0.0.1" in self.server.connected_usertags()):
+            time.sleep(0.01)
+        self.assertEqual(self.server.connected_usertags(), [])
+        self.assertEqual(len(self.server.timers), 0)
+
+    def test_idle_connection_closed(self):
+        self.server.idle_timeout = 0.3
+        self.server.timers = timerWheel.TimerWheel(0.05, 8, time.monotonic())
+        with socket.create_connection(("localhost", self.port)) as silent:
+            silent.settimeout(5)
+            started = time.monotonic()
+            self.assertEqual(silent.recv(100), b"")
+            self.assertGreaterEqual(time.monotonic() - started, 0.25)
+        self.assertEqual(self.server.metrics.reaped, 1)
+
+class TestAsyncServer(TestServer):
+    engine = "asyncio"
+
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.port = free_port()
+        self.server = serverThread.create_server("asyncio", "localhost", self.port, None)
+        self.server.configure(message_rate=None, byte_rate=None)
+        self.server.start()
+        self.assertTrue(self.server.listening.wait(5))
+
+    def tearDown(self):
+        self.server.stop()
+        self.server.join(5)
+
+    def test_pipelined_sends(self):
+        async def scenario():
+            client = asyncClient.AsyncClient("bot", "localhost", self.port)
+            received = []
+            async def read():
+                async for message in client.messages():
+                    received.extend(message.split("\n"))
+                    if any("bot@127.0.0.1:Message 999" in m for m in received):
+                        return
+            reader = asyncio.get_running_loop().create_task(read())
+            # Sends don't wait for anything from the server
+            await asyncio.gather(*(client.send("Message {}".format(i)) for i in range(1000)))
+            await asyncio.wait_for(reader, 10)
+            flushes = client.connection.write_stats.flushes
+            client.close()
+            return received, flushes
+
+        received, flushes = asyncio.run(scenario())
+        posted = [m.split(":", 3)[-1] for m in received if "bot@127.0.0.1:Message" in m]
+        self.assertEqual(posted, ["Message {}".format(i) for i in range(1000)])
+        self.assertLess(flushes, 10)
+
+    def test_unsent_messages_survive_reconnect(self):
+        async def scenario():
+            client = asyncClient.AsyncClient("bot", "localhost", self.port)
+            received = []
+            async def read():
+                async for message in client.messages():
+                    received.extend(message.split("\n"))
+                    if any("bot@127.0.0.1:After" in m for m in received):
+                        return
+            reader = asyncio.get_running_loop().create_task(read())
+            await client.send("Before")
+            while not any("bot@127.0.0.1:Before" in m for m in received):
+                await asyncio.sleep(0.01)
+            # The connection is lost before the queued messages are flushed
+            client.connection.transport.abort()
+            await client.send("After")
+            await asyncio.wait_for(reader, 10)
+            client.close()
+            return received
+
+        received = asyncio.run(scenario())
+        self.assertEqual(sum("bot@127.0.0.1:After" in m for m in received), 1)
+
+    def test_gives_up_without_server(self):
+        async def scenario():
+            client = asyncClient.AsyncClient("bot", "localhost", free_port(), reconnect=False)
+            async for _ in client.messages():
+                pass
+
+        with self.assertRaises(protocol.ConnectionBroken):
+            asyncio.run(scenario())
+
+
+class TestDaemon(unittest.TestCase):
+    def test_settings_from_environment(self):
+        args = daemon.parse_arguments([], {"CHAT_PORT": "1234", "CHAT_ENGINE": "asyncio"})
+        self.assertEqual((args.port, args.engine), (1234, "asyncio"))
+        args = daemon.parse_arguments(["--port", "4321"], {"CHAT_PORT": "1234"})
+        self.assertEqual(args.port, 4321)
+
+    def test_stats_port_needs_single_worker(self):
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            daemon.parse_arguments(["--workers", "2"], {"CHAT_STATS_PORT": "9000"})
+
+    def test_headless(self):
+        output = subprocess.check_output(
+            [sys.executable, "-c", "import daemon, sys; print('tkinter' in sys.modules)"],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), b"False")
+
+    def test_sigterm_drains(self):
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, "daemon.py", "--host", "localhost", "--port", str(port)],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE)
+        self.addCleanup(process.stdout.close)
+        self.assertIn(b"Listening", process.stdout.readline())
+        collector = MessageCollector()
+        client = clientThread.ClientThread("alice", "localhost", port)
+        client.add_observer(collector)
+        client.start()
+        try:
+            self.assertTrue(collector.wait_for("alice@127.0.0.1 has joined"))
+            process.send_signal(signal.SIGTERM)
+            self.assertTrue(collector.wait_for("Server is shutting down."))
+            self.assertEqual(process.wait(10), 0)
+        finally:
+            client.stop()
+            client.join(5)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+
+class TestWorkers(unittest.TestCase):
+    def setUp(self):
+        self.port = free_port()
+        self.server = serverThread.create_server("thread", "localhost", self.port, workers=2)
+        self.users = UserListCollector()
+        self.server.add_observer(self.users)
+        self.server.start()
+        self.assertTrue(self.server.listening.wait(10))
+        self.clients = []
+
+    def tearDown(self):
+        for client, _ in self.clients:
+            client.stop()
+            client.join(5)
+        self.server.stop()
+        self.server.join(10)
+        self.assertFalse(self.server.is_alive())
+
+    def test_broadcast_across_workers(self):
+        for name in ("alice", "bob", "carol", "dave"):
+            collector = MessageCollector()
+            client = clientThread.ClientThread(name, "localhost", self.port)
+            client.add_observer(collector)
+            client.start()
+            self.clients.append((client, collector))
+        for _, collector in self.clients:
+            self.assertTrue(collector.wait_for("dave@127.0.0.1 has joined"))
+        self.clients[0][0].send_message("first")
+        self.clients[3][0].send_message("second")
+        orders = set()
+        for _, collector in self.clients:
+            self.assertTrue(collector.wait_for("second"))
+            self.assertTrue(collector.wait_for("first"))
+            orders.add(tuple(m.rsplit(":", 1)[-1] for m in collector.messages
+                             if m.endswith(("first", "second"))))
+        # Messages posted on different workers arrive in the same order everywhere
+        self.assertEqual(len(orders), 1)
+        # The observer sees the clients of all the workers
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and len(self.users.latest) < 4:
+            time.sleep(0.05)
+        self.assertEqual(sorted(self.users.latest), ["{}@127.0.0.1".format(name)
+                         for name in ("alice", "bob", "carol", "dave")])
+
+    def test_worker_failure_stops_all(self):
+        # Workers cannot share the port with a socket lacking SO_REUSEPORT
+        with socket.socket() as taken:
+            taken.bind(("localhost", 0))
+            taken.listen()
+            server = serverThread.create_server("thread", "localhost",
+                                                taken.getsockname()[1], workers=2)
+            self.addCleanup(server.stop)
+            with contextlib.redirect_stdout(io.StringIO()):
+                server.start()
+                server.join(10)
+        self.assertFalse(server.is_alive())
+        self.assertFalse(server.listening.is_set())
+
+    def test_direct_messages_across_workers(self):
+        names = ("alice", "bob", "carol", "dave", "erin", "frank")
+        for name in names:
+            collector = MessageCollector()
+            client = clientThread.ClientThread(name, "localhost", self.port)
+            client.add_observer(collector)
+            client.start()
+            self.clients.append((client, collector))
+        for _, collector in self.clients:
+            self.assertTrue(collector.wait_for("frank@127.0.0.1 has joined"))
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and len(self.server.connected_usertags()) < 6:
+            time.sleep(0.05)
+        alice, alice_messages = self.clients[0]
+        # Recipients on the other worker are reached through the hub
+        for name, (_, collector) in zip(names[1:], self.clients[1:]):
+            alice.send_message("/msg {} Hi {}".format(name, name))
+            self.assertTrue(collector.wait_for("alice@127.0.0.1 to {}:Hi {}".format(name, name)))
+            self.assertTrue(alice_messages.wait_for("alice@127.0.0.1 to {}:Hi".format(name)))
+        alice.send_message("/msg nobody Hello?")
+        self.assertTrue(alice_messages.wait_for("Server error: no_such_user nobody"))
+
+    def test_route_direct(self):
+        server = serverThread.create_server("thread", "localhost", self.port, workers=2)
+        server.worker_clients[0].update(["bob@10.0.0.2"])
+        server.worker_clients[1].update(["bob@10.0.0.3", "eve@home@10.0.0.3"])
+        server.worker_clients[1].subtract(["bob@10.0.0.3"])
+        self.assertEqual(server.route_direct("bob"), [0])
+        self.assertEqual(server.route_direct("bob@10.0.0.3"), [])
+        self.assertEqual(server.route_direct("eve@home"), [1])
+        self.assertEqual(server.route_direct("eve@home@10.0.0.3"), [1])
+
+    def test_configure_checks_settings(self):
+        server = serverThread.create_server("thread", "localhost", self.port, workers=2)
+        server.configure(idle_timeout=60, stats_port=None)
+        with self.assertRaises(ValueError):
+            server.configure(idle_timeot=60)
+        with self.assertRaises(ValueError):
+            server.configure(stats_port=9000)
+        self.assertEqual(server.settings, {"idle_timeout": 60, "stats_port": None})
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = metrics.Histogram((1, 2, 4, 8))
+        for value in (0.5, 1.5, 3, 3, 100):
+            histogram.record(value)
+        self.assertEqual(histogram.counts, [1, 1, 2, 0, 1])
+        self.assertEqual(histogram.percentile(50), 4)
+        self.assertEqual(histogram.percentile(100), 100)
+        self.assertIsNone(metrics.Histogram().percentile(50))
+
+    def test_protocol_counters(self):
+        socket1, socket2 = socket.socketpair()
+        connection1 = protocol.MessageProtocol(socket1)
+        connection2 = protocol.MessageProtocol(socket2)
+        connection1.send_message("Hello")
+        connection1.ping()
+        connection2.get_message()
+        connection2.get_message()
+        self.assertEqual(connection1.write_stats.pings, 1)
+        self.assertEqual(connection2.read_stats.frames, 2)
+        self.assertEqual(connection2.read_stats.pings, 1)
+        self.assertEqual(connection2.read_stats.bytes, connection1.write_stats.bytes)
+        connection1.terminate()
+        connection2.terminate()
+
+class PresenceCollector():
+    def __init__(self):
+        self.deltas = []
+
+    def notify_presence(self, joined, left):
+        self.deltas.append((joined, left))
+
+class TestPresence(unittest.TestCase):
+    class FakeClient():
+        def __init__(self, usertag):
+            self.usertag = usertag
+
+    def test_registry(self):
+        registry = presence.ClientRegistry()
+        alice1, alice2, bob = (self.FakeClient(u) for u in ("alice", "alice", "bob"))
+        for client in (alice1, bob, alice2):
+            registry.add(client)
+        self.assertEqual(registry.usertags(), ["alice", "bob", "alice"])
+        self.assertEqual(registry.find("alice"), [alice1, alice2])
+        registry.remove(alice1)
+        registry.remove(bob)
+        self.assertEqual(registry.find("bob"), [])
+        self.assertEqual(list(registry), [alice2])
+        self.assertEqual(len(registry), 1)
+
+        remote = self.FakeClient("alice@10.0.0.2")
+        registry.add(remote)
+        self.assertEqual(registry.find_username("alice"), [alice2, remote])
+        registry.remove(alice2)
+        self.assertEqual(registry.find_username("alice"), [remote])
+        self.assertEqual(registry.find_username("bob"), [])
+
+    def test_find_target(self):
+        registry = presence.ClientRegistry()
+        alice, eve = (self.FakeClient(u) for u in ("alice@10.0.0.2", "eve@home@10.0.0.3"))
+        registry.add(alice)
+        registry.add(eve)
+        self.assertEqual(registry.find_target("alice"), [alice])
+        self.assertEqual(registry.find_target("alice@10.0.0.2"), [alice])
+        self.assertEqual(registry.find_target("alice@10.0.0.9"), [])
+        # Usernames containing "@" are found when no usertag matches
+        self.assertEqual(registry.find_target("eve@home"), [eve])
+
+    def test_deltas_batched(self):
+        notifier = presence.PresenceNotifier(lambda: ["alice", "carol"], delay=60)
+        deltas = PresenceCollector()
+        full = MessageCollector()
+        notifier.add_observer(deltas)
+        notifier.add_observer(full)
+        notifier.changed(joined=["alice", "bob"])
+        notifier.changed(joined=["carol"], left=["bob"])
+        self.assertEqual(deltas.deltas, [])
+        notifier.flush()
+        self.assertEqual(deltas.deltas, [(["alice", "carol"], [])])
+        self.assertEqual(full.messages, ["alice", "carol"])
+        # Nothing changed since
+        notifier.flush()
+        self.assertEqual(len(deltas.deltas), 1)
+
+    def test_delay(self):
+        notifier = presence.PresenceNotifier(list, delay=0.01)
+        deltas = PresenceCollector()
+        notifier.add_observer(deltas)
+        notifier.changed(left=["alice"])
+        deadline = time.monotonic() + 5
+        while not deltas.deltas and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(deltas.deltas, [([], ["alice"])])
+
+class TestFlowLimiter(unittest.TestCase):
+    def test_rates(self):
+        limiter = flowControl.FlowLimiter(10, 2, 100, 100, now=0)
+        self.assertEqual(limiter.admit(10, 0), 0)
+        self.assertEqual(limiter.admit(10, 0), 0)
+        # Out of messages for a tenth of a second
+        self.assertAlmostEqual(limiter.admit(10, 0), 0.1)
+        self.assertEqual(limiter.admit(10, 0.1), 0)
+        # Oversized messages pass once the bucket is full and leave it in debt
+        self.assertAlmostEqual(limiter.admit(500, 0.2), 0.1)
+        self.assertEqual(limiter.admit(500, 1.0), 0)
+        self.assertAlmostEqual(limiter.admit(1, 1.0), 4.01)
+        self.assertEqual(limiter.throttles, 3)
+
+    def test_no_limits(self):
+        limiter = flowControl.FlowLimiter(None, 0, None, 0, now=0)
+        for _ in range(1000):
+            self.assertEqual(limiter.admit(2**20, 0), 0)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_disabled(self):
+        disabled = profiler.Profiler()
+        self.assertIs(disabled.span("deliver"), profiler.NO_SPAN)
+        lock = threading.Lock()
+        self.assertIs(disabled.timed_lock(lock, "lock"), lock)
+        self.assertIsNone(disabled.capture("spans"))
+
+    def test_spans_and_samples(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        enabled = profiler.Profiler(directory, trace_memory=False)
+        for _ in range(3):
+            with enabled.span("deliver"):
+                pass
+        with enabled.timed_lock(threading.Lock(), "lock"):
+            pass
+        self.assertEqual(enabled.as_dict()["deliver"]["count"], 3)
+        self.assertEqual(enabled.as_dict()["lock"]["count"], 1)
+
+        sleeper = threading.Thread(target=time.sleep, args=(0.3,), name="sleeper")
+        sleeper.start()
+        path = enabled.capture("cpu", 0.1)
+        sleeper.join()
+        with open(path) as samples:
+            self.assertTrue(any(line.startswith("sleeper;") for line in samples))
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_expiry(self):
+        wheel = timerWheel.TimerWheel(tick=1, slots=4)
+        wheel.add("a", 2.5)
+        wheel.add("b", 9.5)
+        wheel.add("c", 3)
+        wheel.add("gone", 1)
+        wheel.remove("gone")
+        self.assertEqual(len(wheel), 3)
+        self.assertEqual(wheel.advance(2), [])
+        self.assertEqual(wheel.advance(3), ["a", "c"])
+        # "b" shares a slot with earlier ticks but stays until its deadline
+        self.assertEqual(wheel.advance(7), [])
+        self.assertEqual(wheel.advance(100), ["b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_reschedule(self):
+        wheel = timerWheel.TimerWheel(tick=1, slots=8)
+        wheel.add("a", 2)
+        wheel.add("a", 5)
+        self.assertEqual(wheel.advance(4), [])
+        self.assertEqual(wheel.advance(5), ["a"])
+        # Deadlines in the past expire with the next tick
+        wheel.add("late", 1)
+        self.assertEqual(wheel.advance(6), ["late"])
+
+class TestBenchmark(unittest.TestCase):
+    def test_percentiles(self):
+        result = benchmark.percentiles(list(range(1, 1001)))
+        self.assertEqual((result["p50"], result["p99"], result["p999"]), (500, 990, 999))
+        self.assertEqual(benchmark.percentiles([]), {"count": 0})
+
+    def test_run(self):
+        report = benchmark.run_benchmark("thread", clients=5, senders=2, rate=20,
+                                         duration=0.5, drain=5)
+        results = report["results"]
+        self.assertEqual(results["clients"]["connected"], 5)
+        self.assertGreater(results["posted"], 0)
+        self.assertEqual(results["lost"], 0)
+        self.assertEqual(results["latency"]["count"], results["expected_deliveries"])
+        json.dumps(report)
+
+    def test_run_without_rate_limits(self):
+        # Throttled senders would fall seconds behind after the burst
+        report = benchmark.run_benchmark("thread", clients=2, senders=1,
+                                         rate=4 * CLIENT_MESSAGE_RATE, duration=2, drain=10)
+        results = report["results"]
+        self.assertFalse(report["config"]["rate_limits"])
+        self.assertGreater(results["posted"], 2 * CLIENT_MESSAGE_BURST)
+        self.assertEqual(results["lost"], 0)
+        self.assertLess(results["latency"]["p99"], 1)
+
+    def test_protocol_suite(self):
+        report = protocolBenchmark.run_suite(quick=True, repeat=1, only="length")
+        results = report["results"]
+        self.assertIn("throughput/length/utf8/1024", results)
+        self.assertGreater(results["coalesced/length"]["frames_per_read"], 1)
+        self.assertEqual(results["latency/length/16"]["count"],
+                         protocolBenchmark.LATENCY_ROUNDS // 10)
+        baseline = json.loads(json.dumps(report))
+        baseline["results"]["ping/length"]["messages_per_second"] *= 2
+        baseline["results"]["latency/length/16"]["p50"] /= 2
+        comparison = protocolBenchmark.compare(report, baseline)
+        self.assertTrue(comparison["ping/length"]["regression"])
+        self.assertAlmostEqual(comparison["ping/length"]["change"], -0.5)
+        self.assertTrue(comparison["latency/length/16"]["regression"])
+        self.assertFalse(comparison["buffer/length/2048"]["regression"])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
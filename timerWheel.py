@@ -0,0 +1,85 @@
+from const import *
+
+import math
+
+class TimerWheel():
+    """
+    Hashed timer wheel tracking deadlines of many items with constant time
+    insertion and removal. Time is split into ticks, every slot of the wheel
+    holds the items whose deadline falls on a tick mapped to it. Advancing the
+    wheel only looks at the slots of the ticks that passed, items whose
+    deadline is a full turn or more away stay in their slot.
+
+    Isn't thread safe, the server guards it with its messages lock.
+    """
+    def __init__(self, tick=TIMER_TICK, slots=TIMER_WHEEL_SLOTS, now=0.0):
+        """
+        Parameters:
+        tick (float): Length of one tick in seconds, the precision of the deadlines
+        slots (int): Number of slots, a turn of the wheel takes tick * slots seconds
+        now (float): Current time
+        """
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        # Slot holding each item
+        self.positions = {}
+        # Tick processed by the last call of advance
+        self.current = math.floor(now / tick)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def add(self, item, deadline):
+        """
+        Schedules an item, replacing its previous deadline.
+
+        Parameters:
+        item: A hashable item
+        deadline (float): Time at which the item expires
+        """
+        self.remove(item)
+        # Deadlines in the past expire with the next tick
+        tick = max(math.ceil(deadline / self.tick), self.current + 1)
+        slot = self.slots[tick % len(self.slots)]
+        slot[item] = deadline
+        self.positions[item] = slot
+
+    def remove(self, item):
+        """
+        Unschedules an item if it is scheduled.
+
+        Parameters:
+        item: The item
+        """
+        slot = self.positions.pop(item, None)
+        if slot is not None:
+            del slot[item]
+
+    def advance(self, now):
+        """
+        Moves the wheel to the current time. Returns a list of the items whose
+        deadlines passed, they are removed from the wheel.
+
+        Parameters:
+        now (float): Current time
+        """
+        expired = []
+        target = math.floor(now / self.tick)
+        # After a pause longer than a turn every slot is visited once
+        last = min(target, self.current + len(self.slots))
+        for tick in range(self.current + 1, last + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for item, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[item]
+                    del self.positions[item]
+                    expired.append(item)
+        self.current = target
+        return expired
+
+    def next_tick(self):
+        """Returns the time of the next tick"""
+        return (self.current + 1) * self.tick
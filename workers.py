@@ -0,0 +1,357 @@
+from const import *
+from protocol import MessageProtocol, ConnectionBroken, FRAMING_LENGTH
+from serverThread import create_server, Message, DirectMessage, ServerThread
+from presence import PresenceNotifier, username_of
+
+from datetime import datetime
+import collections
+import json
+import multiprocessing
+import socket
+import threading
+
+# Runs the server in several worker processes listening on the same port with
+# SO_REUSEPORT, so the kernel spreads the connections between them. Workers
+# don't broadcast messages themselves: they post them to the hub in the parent
+# process over a UNIX socket pair, the hub sends every message to all the
+# workers in one order and each worker delivers it to its own clients. Direct
+# messages nobody on the sender's worker receives go to the hub as well, which
+# passes them to the workers of the recipients and tells the sender's worker
+# whether anybody got them.
+#
+# Events on the bus are JSON objects sent as length prefixed frames:
+#   worker -> hub: {"type": "post", "usertag", "timestamp", "message", "channel"}
+#                  {"type": "direct", "usertag", "timestamp", "message", "target"}
+#                  {"type": "presence", "joined": [usertags], "left": [usertags]}
+#                  {"type": "listening", "ok": bool}
+#   hub -> worker: {"type": "message", "usertag", "timestamp", "message", "channel"}
+#                  {"type": "direct" | "direct_sent", "usertag", "timestamp", "message",
+#                   "target"}
+#                  {"type": "direct_failed", "usertag", "timestamp", "message", "target"}
+#                  {"type": "stop", "drain": seconds}
+#                  {"type": "capture", "kind": "cpu" | "memory" | "spans", "seconds"}
+
+class WorkerBus():
+    """
+    Connection of a worker process to the hub. Installed as the bus and as an
+    observer of the worker's server.
+    """
+    def __init__(self, bus_socket, server):
+        """
+        Parameters:
+        bus_socket (socket.socket): Socket connected to the hub
+        server (ServerThread): Server of this worker
+        """
+        self.connection = MessageProtocol(bus_socket, framing=FRAMING_LENGTH)
+        self.send_lock = threading.Lock()
+        self.server = server
+        server.bus = self
+        server.add_observer(self)
+
+    def send(self, event):
+        """
+        Sends an event to the hub.
+
+        Parameters:
+        event (dict): The event
+        """
+        with self.send_lock:
+            self.connection.send_message(json.dumps(event))
+
+    def post(self, message):
+        """
+        Posts a message published on this worker to the hub.
+
+        Parameters:
+        message (Message): The new message
+        """
+        self.send({"type": "post", "usertag": message.usertag,
+                   "timestamp": message.timestamp.timestamp(), "message": message.message,
+                   "channel": message.channel})
+
+    def direct(self, message):
+        """
+        Asks the hub to deliver a direct message to recipients connected to
+        other workers.
+
+        Parameters:
+        message (DirectMessage): The message nobody on this worker receives
+        """
+        self.send({"type": "direct", "usertag": message.usertag,
+                   "timestamp": message.timestamp.timestamp(), "message": message.message,
+                   "target": message.recipient})
+
+    def notify_presence(self, joined, left):
+        """
+        Observer of the server, reports the clients that connected to or
+        disconnected from this worker to the hub.
+
+        Parameters:
+        joined (list): Usertags of the new clients
+        left (list): Usertags of the disconnected clients
+        """
+        self.send({"type": "presence", "joined": joined, "left": left})
+
+    def run(self):
+        """
+        Delivers the messages ordered by the hub until the hub stops the worker.
+        Returns the seconds the clients get to receive their queued messages.
+        """
+        try:
+            while True:
+                event = json.loads(self.connection.get_message())
+                if event["type"] == "message":
+                    self.server.deliver(Message(event["usertag"],
+                                                datetime.fromtimestamp(event["timestamp"]),
+                                                event["message"], event["channel"]))
+                elif event["type"] in ("direct", "direct_sent"):
+                    self.server.deliver_direct(
+                        DirectMessage(event["usertag"], datetime.fromtimestamp(event["timestamp"]),
+                                      event["message"], event["target"]),
+                        to_sender=event["type"] == "direct_sent")
+                elif event["type"] == "direct_failed":
+                    self.server.direct_failed(event["usertag"], event["target"])
+                elif event["type"] == "stop":
+                    return event.get("drain", 0)
+                elif event["type"] == "capture":
+                    self.server.capture(event["kind"], event["seconds"])
+        except ConnectionBroken:
+            # The hub is gone
+            pass
+        return 0
+
+def worker_main(bus_socket, engine, host, port, settings):
+    """
+    Entry point of a worker process.
+
+    Parameters:
+    bus_socket (socket.socket): Socket connected to the hub
+    engine (str): Server engine of the worker
+    host (str): Interface to listen on
+    port (int): Port shared by all the workers
+    settings (dict): Settings of the server, see ServerThread.configure
+    """
+    server = create_server(engine, host, port, log_directory=None, workers=1)
+    server.configure(**settings)
+    server.reuse_port = True
+    bus = WorkerBus(bus_socket, server)
+    server.start()
+    while not server.listening.wait(0.1) and server.is_alive():
+        pass
+    drain_timeout = 0
+    try:
+        bus.send({"type": "listening", "ok": server.listening.is_set()})
+        drain_timeout = bus.run()
+    except ConnectionBroken:
+        pass
+    server.stop(drain_timeout)
+    server.join()
+    bus.connection.terminate()
+
+
+class MultiProcessServer(threading.Thread):
+    """
+    Runs the server in worker processes and the hub of their message bus in a
+    thread of this process. Offers the same add_observer contract as
+    ServerThread, observers learn about the clients of all the workers.
+    The persistent message log isn't used by the workers. If any worker fails
+    to start, all of them are stopped and listening is never set.
+    """
+    def __init__(self, engine=SERVER_ENGINE, host=SERVER_HOST, port=SERVER_PORT,
+                 workers=SERVER_WORKERS):
+        """
+        Parameters:
+        engine (str): Server engine of the workers, "thread" or "asyncio"
+        host (str): Interface to listen on, empty for all interfaces
+        port (int): Port to listen on
+        workers (int): Number of worker processes
+        """
+        threading.Thread.__init__(self)
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.running = False
+        self.listening = threading.Event()
+        self.presence = PresenceNotifier(self.connected_usertags)
+
+        # Held while sending to the workers so that all of them get the same order
+        self.bus_lock = threading.Lock()
+        self.buses = []
+        self.processes = []
+        # Sessions of each usertag connected to each worker
+        self.worker_clients = [collections.Counter() for _ in range(workers)]
+        self.listening_workers = 0
+        self.settings = {}
+
+    def run(self):
+        """
+        Overwrites threading.Thread.run, starts the workers and relays the events
+        of their message bus until they stop.
+        """
+        self.running = True
+        context = multiprocessing.get_context()
+        for _ in range(self.workers):
+            hub_socket, worker_socket = socket.socketpair()
+            process = context.Process(target=worker_main, daemon=True,
+                                      args=(worker_socket, self.engine, self.host, self.port,
+                                            self.settings))
+            process.start()
+            worker_socket.close()
+            self.buses.append(MessageProtocol(hub_socket, framing=FRAMING_LENGTH))
+            self.processes.append(process)
+        if not self.running:
+            # Stopped while the workers were starting
+            self.broadcast({"type": "stop"})
+
+        readers = [threading.Thread(target=self.read_worker, args=(index,))
+                   for index in range(self.workers)]
+        for reader in readers:
+            reader.start()
+        for process in self.processes:
+            process.join()
+        for bus in self.buses:
+            bus.terminate()
+        for reader in readers:
+            reader.join()
+        self.presence.flush()
+
+    def read_worker(self, index):
+        """
+        Handles the events sent by one worker.
+
+        Parameters:
+        index (int): Index of the worker
+        """
+        try:
+            while True:
+                event = json.loads(self.buses[index].get_message())
+                if event["type"] == "post":
+                    event["type"] = "message"
+                    self.broadcast(event)
+                elif event["type"] == "direct":
+                    workers = self.route_direct(event["target"])
+                    if workers:
+                        self.send_to(workers, event)
+                    event["type"] = "direct_sent" if workers else "direct_failed"
+                    self.send_to([index], event)
+                elif event["type"] == "presence":
+                    with self.bus_lock:
+                        self.worker_clients[index].update(event["joined"])
+                        self.worker_clients[index].subtract(event["left"])
+                    self.presence.changed(event["joined"], event["left"])
+                elif event["type"] == "listening":
+                    if not event["ok"]:
+                        # Running with fewer workers than asked for would go unnoticed
+                        print("Worker {} cannot listen on port {}.".format(index, self.port))
+                        self.stop()
+                        continue
+                    with self.bus_lock:
+                        self.listening_workers += 1
+                        if self.listening_workers == self.workers:
+                            self.listening.set()
+        except ConnectionBroken:
+            # The worker stopped, its clients are gone too
+            with self.bus_lock:
+                left = list(self.worker_clients[index].elements())
+                self.worker_clients[index].clear()
+            self.presence.changed(left=left)
+            if not self.listening.is_set():
+                # Died while starting
+                self.stop()
+
+    def route_direct(self, target):
+        """
+        Returns the indexes of the workers with clients a /msg target names,
+        see ClientRegistry.find_target.
+
+        Parameters:
+        target (str): Usertag or username
+        """
+        with self.bus_lock:
+            if "@" in target:
+                workers = [index for index, clients in enumerate(self.worker_clients)
+                           if clients[target] > 0]
+                if workers:
+                    return workers
+            return [index for index, clients in enumerate(self.worker_clients)
+                    if any(count > 0 and username_of(usertag) == target
+                           for usertag, count in clients.items())]
+
+    def broadcast(self, event):
+        """
+        Sends an event to all the workers.
+
+        Parameters:
+        event (dict): The event
+        """
+        self.send_to(range(len(self.buses)), event)
+
+    def send_to(self, indexes, event):
+        """
+        Sends an event to some of the workers.
+
+        Parameters:
+        indexes (iterable): Indexes of the workers
+        event (dict): The event
+        """
+        data = json.dumps(event)
+        with self.bus_lock:
+            for index in indexes:
+                try:
+                    self.buses[index].send_message(data)
+                except ConnectionBroken:
+                    pass
+
+    def configure(self, **settings):
+        """
+        Changes settings of the servers of the workers before they are started,
+        see ServerThread.configure. The statistics aren't available, the
+        workers would compete for the same port and file.
+
+        Parameters:
+        settings: Attribute names mapped to their values
+        """
+        for name, value in settings.items():
+            if name not in ServerThread.SETTINGS:
+                raise ValueError("Unknown server setting {}".format(name))
+            if name in ("stats_port", "stats_file") and value is not None:
+                raise ValueError("Server statistics aren't available with several workers")
+        self.settings.update(settings)
+
+    def capture(self, kind, seconds=PROFILE_SAMPLE_SECONDS):
+        """
+        Makes every worker write a profiling capture, see ServerThread.capture.
+        The workers name the files after their process ids.
+
+        Parameters:
+        kind (str): "cpu", "memory" or "spans"
+        seconds (float): Duration of a cpu capture
+        """
+        self.broadcast({"type": "capture", "kind": kind, "seconds": seconds})
+
+    def stop(self, drain_timeout=0):
+        """
+        Stops the workers.
+
+        Parameters:
+        drain_timeout (float): Seconds the clients get to receive the messages
+                               queued for them before being disconnected
+        """
+        self.running = False
+        self.broadcast({"type": "stop", "drain": drain_timeout})
+
+    def add_observer(self, observer):
+        """
+        Adds an observer that will be notified when the connected clients change,
+        see PresenceNotifier.
+
+        Parameters:
+        observer: An object with a 'notify_presence' or 'notify' method
+        """
+        self.presence.add_observer(observer)
+
+    def connected_usertags(self):
+        """Returns the usertags of the clients connected to all the workers"""
+        with self.bus_lock:
+            return [usertag for worker in self.worker_clients for usertag in worker.elements()]